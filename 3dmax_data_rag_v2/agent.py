@@ -5,12 +5,16 @@ import os
 import re
 import html
 from sentence_transformers import SentenceTransformer
+from mmap_store import open_store, range_search_top_k, similarity_thresholds, store_exists
+from embedding_cache import EmbeddingCache
 
 
 class Agent3DMax:
-    def __init__(self, vector_db_path="vector_db"):
+    def __init__(self, vector_db_path="vector_db", cache_size=1024, cache_path=None):
         """Initialize the 3D Max Agent with the vector database."""
         self.vector_db_path = vector_db_path
+        self.cache_size = cache_size  # Query embeddings kept in memory
+        self.cache_path = cache_path  # Optional sqlite file for warm restarts
         self.load_resources()
         self.load_model()
 
@@ -18,11 +22,29 @@ class Agent3DMax:
         """Load the vector database resources."""
         print(f"Loading resources from {self.vector_db_path}...")
 
+        # Prefer the memory-mapped store: nothing is deserialized into the process heap
+        if store_exists(self.vector_db_path):
+            store = open_store(self.vector_db_path)
+            self.index = store.index
+            self.documents = store.documents
+            self.metadata = store.metadata
+            self.metric = store.metric
+            self.calibration = store.calibration
+            print(f"Mapped store with {self.index.ntotal} vectors")
+            self.set_thresholds()
+            return
+
+        # Fall back to the pickled database
         # Load FAISS index
         index_path = os.path.join(self.vector_db_path, "faiss_index.bin")
         self.index = faiss.read_index(index_path)
         print(f"Loaded FAISS index with {self.index.ntotal} vectors")
 
+        # Inner-product indexes hold normalized vectors
+        self.metric = "cosine" if self.index.metric_type == faiss.METRIC_INNER_PRODUCT else "l2"
+        self.calibration = None
+        self.set_thresholds()
+
         # Load documents
         with open(os.path.join(self.vector_db_path, "documents.pkl"), "rb") as f:
             self.documents = pickle.load(f)
@@ -33,12 +55,47 @@ class Agent3DMax:
             self.metadata = pickle.load(f)
         print(f"Loaded metadata for {len(self.metadata)} Q&A pairs")
 
+    def set_thresholds(self):
+        """Pick the similarity thresholds for the database metric."""
+        self.threshold, self.good_threshold = similarity_thresholds(self.metric, self.calibration)
+        print(f"Using {self.metric} scores, thresholds {self.threshold:.3f} / {self.good_threshold:.3f}")
+
     def load_model(self):
         """Load the sentence transformer model for embeddings."""
         model_name = "paraphrase-multilingual-mpnet-base-v2"
         print(f"Loading embedding model: {model_name}")
         self.model = SentenceTransformer(model_name)
 
+        # Query embeddings are cached, optionally spilled to disk for warm restarts
+        self.embedding_cache = EmbeddingCache(model_name, max_size=self.cache_size, path=self.cache_path)
+
+    def prepare_queries(self, query_embeddings):
+        """Convert query embeddings to a float32 matrix, normalized for cosine scores."""
+        query_embeddings = np.array(query_embeddings, dtype=np.float32, ndmin=2)
+        if self.metric == "cosine":
+            faiss.normalize_L2(query_embeddings)
+        return query_embeddings
+
+    def search_index(self, query_embeddings, top_k, min_similarity):
+        """
+        Search the index for the top_k neighbours of every query row.
+
+        Cosine databases run a range search, so candidates below min_similarity
+        are dropped inside the index. Returns (scores, indices) like index.search.
+        """
+        if self.metric == "cosine":
+            return range_search_top_k(self.index, query_embeddings, min_similarity, top_k)
+        return self.index.search(query_embeddings, top_k)
+
+    def similarity(self, score):
+        """Similarity of an index score: cosine scores as they are, L2 distances mapped to (0, 1]."""
+        if self.metric == "cosine":
+            return score
+
+        # For L2 distance, smaller is better, so we use an exponential decay function
+        # This gives more separation between close matches and distant matches
+        return np.exp(-score / 10.0)  # Adjusted scale factor
+
     def clean_text(self, text):
         """Clean HTML tags from text and standardize whitespace."""
         # Remove HTML tags
@@ -53,31 +110,67 @@ class Agent3DMax:
         """Generate an embedding for a query."""
         # Clean the query
         clean_query = self.clean_text(query)
-        # Generate embedding
-        embedding = self.model.encode([clean_query])[0]
+        # Reuse the embedding of a repeated question
+        embedding = self.embedding_cache.get(clean_query)
+        if embedding is None:
+            # Generate embedding
+            embedding = self.model.encode([clean_query])[0]
+            self.embedding_cache.put(clean_query, embedding)
         return embedding
 
-    def search(self, query, top_k=3, threshold=0.15):
+    def generate_embeddings(self, queries, batch_size=32):
+        """Generate embeddings for a list of queries with one model call for the uncached ones."""
+        clean_queries = [self.clean_text(query) for query in queries]
+        return self.embedding_cache.encode(
+            clean_queries, lambda texts: self.model.encode(texts, batch_size=batch_size)
+        )
+
+    def search(self, query, top_k=3, threshold=None):
         """Search for the most relevant Q&A pairs for a query."""
+        threshold = self.threshold if threshold is None else threshold
+
         # Generate query embedding
         query_embedding = self.generate_embedding(query)
 
         # Convert to float32 as required by FAISS
-        query_embedding = np.array([query_embedding]).astype('float32')
+        query_embedding = self.prepare_queries(query_embedding)
 
         # Search the index
-        distances, indices = self.index.search(query_embedding, top_k)
+        distances, indices = self.search_index(query_embedding, top_k, threshold)
 
-        # Process results
+        return self._collect_results(distances[0], indices[0], threshold)
+
+    def search_many(self, queries, top_k=3, threshold=None, batch_size=64):
+        """Search for the most relevant Q&A pairs for many queries, one matrix search per batch."""
+        threshold = self.threshold if threshold is None else threshold
+        queries = list(queries)
+        all_results = []
+
+        for start in range(0, len(queries), batch_size):
+            batch = queries[start:start + batch_size]
+
+            # Embed the whole batch at once and search all rows together
+            query_embeddings = self.prepare_queries(self.generate_embeddings(batch, batch_size=batch_size))
+            distances, indices = self.search_index(query_embeddings, top_k, threshold)
+
+            for row in range(len(batch)):
+                all_results.append(self._collect_results(distances[row], indices[row], threshold))
+
+        return all_results
+
+    def _collect_results(self, distances, indices, threshold):
+        """Turn one row of index search output into result dicts."""
         results = []
-        for i in range(len(indices[0])):
-            idx = indices[0][i]
-            distance = distances[0][i]
+        for i in range(len(indices)):
+            idx = indices[i]
+            distance = distances[i]
+
+            # FAISS pads missing neighbours with -1
+            if idx < 0:
+                continue
 
-            # Better similarity calculation from L2 distance
-            # For L2 distance, smaller is better, so we use an exponential decay function
-            # This gives more separation between close matches and distant matches
-            similarity = np.exp(-distance / 10.0)  # Adjusted scale factor
+            # Cosine score, or a similarity derived from the L2 distance
+            similarity = self.similarity(distance)
 
             # Skip results below threshold
             if similarity < threshold:
@@ -121,11 +214,19 @@ class Agent3DMax:
 
         return "\n\n".join(response)
 
-    def answer_question(self, query, threshold=0.15):
+    def answer_question(self, query, threshold=None):
         """Answer a question about 3D Max."""
         # Search for relevant Q&A pairs
         results = self.search(query, top_k=3, threshold=threshold)
+        return self.compose_answer(results)
+
+    def answer_questions(self, queries, threshold=None, batch_size=64):
+        """Answer many questions about 3D Max, embedding and searching them in batches."""
+        all_results = self.search_many(queries, top_k=3, threshold=threshold, batch_size=batch_size)
+        return [self.compose_answer(results) for results in all_results]
 
+    def compose_answer(self, results):
+        """Build the answer text from search results."""
         if not results:
             return (
                 "Извините, я не нашел ответ на ваш вопрос в документации. "
@@ -136,7 +237,7 @@ class Agent3DMax:
         best_match = results[0]
 
         # Check if it's a good match or a tentative match
-        if best_match['similarity'] > 0.4:  # Adjusted threshold for "good" match
+        if best_match['similarity'] > self.good_threshold:
             return self.format_response(best_match)
         else:
             # It's a tentative match
@@ -159,6 +260,7 @@ def main():
 
         # Check for exit command
         if query.lower() in ["выход", "exit", "quit", "q"]:
+            agent.embedding_cache.close()
             print("До свидания!")
             break
 
@@ -0,0 +1,410 @@
+"""
+Retrieval benchmark for the 3D Max agents.
+
+Measures Agent3DMax.search (agent.py) and every search mode of the enhanced
+agent on a labeled question set: p50/p95/p99 latency, QPS, recall@1/3 and
+resident memory. Each mode runs in its own process, so memory numbers do not
+leak from one mode into the next.
+
+By default the database is built from the Q&A data with HashingEmbedder, a
+fixed local stand-in for the SentenceTransformer model, so the benchmark runs
+offline and gives the same rankings on every machine. With --db an existing
+database is benchmarked with the real model instead.
+
+The report is written as JSON with sorted keys, so two runs can be diffed
+directly or compared with --compare.
+
+Usage:
+    python benchmark_agents.py --input data/qa_data.json --output benchmark.json
+    python benchmark_agents.py --compare benchmark_before.json --output benchmark.json
+"""
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import shutil
+import sys
+import time
+import zlib
+
+import faiss
+import numpy as np
+
+from create_vector_db import (base_index, calibrate_scores, create_faiss_index, iter_qa_pairs,
+                              prepare_documents, print_index_report, save_vector_db, tune_index)
+from embedding_cache import EmbeddingCache
+from keyword_index import write_keyword_index
+from mmap_store import write_store
+
+# "agent" is agent.py, the others are the search modes of enhanced_agent.py
+BENCHMARK_MODES = ("agent", "vector", "hybrid", "bm25", "fusion")
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+class HashingEmbedder:
+    """
+    Deterministic stand-in for the SentenceTransformer model.
+
+    Words and character trigrams are hashed with crc32 into a fixed number of
+    signed buckets and the result is L2-normalized. There is nothing to
+    download and the vectors are identical on every run and machine.
+    """
+
+    def __init__(self, dimension=384):
+        self.dimension = dimension
+
+    def get_sentence_embedding_dimension(self):
+        return self.dimension
+
+    def _features(self, text):
+        """Words and character trigrams of a lowercase text."""
+        words = WORD_PATTERN.findall(text.lower())
+        for word in words:
+            yield word
+            padded = f" {word} "
+            for i in range(len(padded) - 2):
+                yield padded[i:i + 3]
+
+    def encode(self, texts, batch_size=32, show_progress_bar=False, **kwargs):
+        """Embed a list of texts, mirroring SentenceTransformer.encode."""
+        if isinstance(texts, str):
+            texts = [texts]
+
+        embeddings = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                bucket = zlib.crc32(feature.encode("utf-8"))
+                # Signed by the hash's top bit: unrelated features sharing a bucket add up to zero in expectation
+                embeddings[row, bucket % self.dimension] += 1.0 if bucket & 0x80000000 else -1.0
+
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-12)
+
+
+def load_labeled_questions(questions_file=None, metadata=None, num_questions=200, seed=0):
+    """
+    Load the labeled questions as (question, expected Q&A id) pairs.
+
+    questions_file is a JSON list of {"question": ..., "expected_id": ...}.
+    Without one, a fixed random sample of the database questions is used, each
+    labeled with its own Q&A id.
+    """
+    if questions_file:
+        with open(questions_file, "r", encoding="utf-8") as f:
+            return [(item["question"], item["expected_id"]) for item in json.load(f)]
+
+    sample = random.Random(seed).sample(metadata, min(num_questions, len(metadata)))
+    return [(meta["question"], meta["id"]) for meta in sample]
+
+
+def build_benchmark_db(input_file, db_dir, embedder, index_type="flat", metric="l2", k=3, target_recall=0.95):
+    """
+    Build a vector database from the Q&A data with the given embedder.
+
+    Approximate indexes get the search parameter create_vector_db.py would
+    deploy, tuned to target_recall at recall@k on the database questions.
+
+    Returns:
+        (metadata, index_info) with the Q&A metadata and the index type and params
+    """
+    documents, metadata = prepare_documents(iter_qa_pairs(input_file))
+    if not documents:
+        raise ValueError(f"No Q&A pairs found in {input_file}")
+    print(f"Embedding {len(documents)} documents with {type(embedder).__name__}")
+
+    embeddings = np.ascontiguousarray(embedder.encode(documents), dtype=np.float32)
+    if metric == "cosine":
+        faiss.normalize_L2(embeddings)
+
+    index = create_faiss_index(embeddings, index_type, metric=metric)
+
+    # Small corpora may have fallen back to exact search
+    if isinstance(base_index(index), faiss.IndexFlat):
+        index_type = "flat"
+    index_info = {"type": index_type}
+
+    # Every question is a query, where create_vector_db.py uses a sample
+    queries = None
+    if index_type != "flat" or (metric == "cosine" and len(documents) > 1):
+        queries = np.ascontiguousarray(embedder.encode([meta["question"] for meta in metadata]), dtype=np.float32)
+        if metric == "cosine":
+            faiss.normalize_L2(queries)
+
+    # Approximate indexes are measured at their tuned setting, not the FAISS default
+    if index_type != "flat":
+        params, report = tune_index(index, embeddings, queries, k=k, target_recall=target_recall, metric=metric)
+        print_index_report(report, k)
+        print(f"Selected search parameters: {params}")
+        index_info["params"] = params
+
+    # Calibrate cosine thresholds on every question
+    calibration = None
+    if metric == "cosine" and len(documents) > 1:
+        calibration = calibrate_scores(embeddings, queries, list(range(len(metadata))))
+
+    if os.path.exists(db_dir):
+        shutil.rmtree(db_dir)
+    save_vector_db(index, documents, metadata, db_dir)
+    write_store(embeddings, documents, metadata, db_dir, index_info=index_info,
+                metric=metric, calibration=calibration)
+    write_keyword_index(documents, db_dir)
+    return metadata, index_info
+
+
+def current_rss_mb():
+    """Resident memory of this process in MB."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB, NaN where it cannot be measured."""
+    try:
+        # Unix only
+        import resource
+    except ImportError:
+        # psutil is optional, on Windows it reports the peak working set
+        try:
+            import psutil
+        except ImportError:
+            return float("nan")
+        memory = psutil.Process().memory_info()
+        return getattr(memory, "peak_wset", memory.rss) / 2 ** 20
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def load_agent(mode, db_dir, use_hashing_embedder, cache_size=0):
+    """Create the agent benchmarked by a mode."""
+    if mode == "agent":
+        from agent import Agent3DMax
+        kwargs = {}
+    else:
+        from enhanced_agent import Agent3DMax
+        kwargs = {"search_mode": mode}
+
+    if use_hashing_embedder:
+        class BenchmarkAgent(Agent3DMax):
+            def load_model(self):
+                """Use the deterministic stand-in model instead of downloading one."""
+                self.model = HashingEmbedder()
+                self.embedding_cache = EmbeddingCache("HashingEmbedder", max_size=self.cache_size)
+
+        return BenchmarkAgent(db_dir, cache_size=cache_size, **kwargs)
+
+    return Agent3DMax(db_dir, cache_size=cache_size, **kwargs)
+
+
+def percentile_ms(latencies, q):
+    """Percentile of latencies in seconds, in milliseconds."""
+    return float(np.percentile(latencies, q)) * 1000 if latencies else 0.0
+
+
+def run_mode(mode, db_dir, questions, use_hashing_embedder, top_k=3, repeat=3, warmup=10, cache_size=0):
+    """
+    Benchmark one search mode in the current process.
+
+    Returns:
+        dict with latency percentiles, QPS, recall@1/@top_k and memory usage
+    """
+    rss_before = current_rss_mb()
+    start = time.perf_counter()
+    agent = load_agent(mode, db_dir, use_hashing_embedder, cache_size)
+    load_seconds = time.perf_counter() - start
+    rss_loaded = current_rss_mb()
+
+    texts = [question for question, _ in questions]
+
+    # Warm up caches and lazily mapped pages before timing
+    for text in texts[:warmup]:
+        agent.search(text, top_k=top_k)
+
+    # Single-query latency, as seen by the interactive assistant
+    latencies = []
+    ranked_ids = []
+    for round_number in range(repeat):
+        for text in texts:
+            start = time.perf_counter()
+            results = agent.search(text, top_k=top_k)
+            latencies.append(time.perf_counter() - start)
+            if round_number == 0:
+                ranked_ids.append([result["metadata"]["id"] for result in results])
+
+    # Throughput of the batched path
+    start = time.perf_counter()
+    agent.search_many(texts, top_k=top_k)
+    batch_seconds = time.perf_counter() - start
+
+    hits_at_1 = sum(ids[:1] == [expected] for ids, (_, expected) in zip(ranked_ids, questions))
+    hits_at_k = sum(expected in ids[:top_k] for ids, (_, expected) in zip(ranked_ids, questions))
+
+    return {
+        "queries": len(texts),
+        "repeat": repeat,
+        "load_seconds": load_seconds,
+        "latency_ms_p50": percentile_ms(latencies, 50),
+        "latency_ms_p95": percentile_ms(latencies, 95),
+        "latency_ms_p99": percentile_ms(latencies, 99),
+        "latency_ms_mean": float(np.mean(latencies)) * 1000 if latencies else 0.0,
+        "qps": len(latencies) / sum(latencies) if latencies else 0.0,
+        "batch_qps": len(texts) / batch_seconds if batch_seconds > 0 else 0.0,
+        "recall_at_1": hits_at_1 / len(questions) if questions else 0.0,
+        f"recall_at_{top_k}": hits_at_k / len(questions) if questions else 0.0,
+        "rss_mb_loaded": rss_loaded - rss_before,
+        "rss_mb": current_rss_mb(),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def _run_mode_quietly(args):
+    """Run a mode in a worker process, keeping the agents' loading output off the report."""
+    with open(os.devnull, "w") as devnull:
+        stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            return run_mode(*args)
+        finally:
+            sys.stdout = stdout
+
+
+def run_benchmark(modes, db_dir, questions, use_hashing_embedder, top_k=3, repeat=3, warmup=10, cache_size=0):
+    """Benchmark every mode in a fresh process and collect the results by mode."""
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for mode in modes:
+        print(f"Benchmarking {mode}...")
+        with context.Pool(1) as pool:
+            results[mode] = pool.apply(
+                _run_mode_quietly,
+                ((mode, db_dir, questions, use_hashing_embedder, top_k, repeat, warmup, cache_size),)
+            )
+    return results
+
+
+def print_report(results, top_k):
+    """Print the benchmark results as a table."""
+    print(f"\n{'Mode':<8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'QPS':>9} {'Batch QPS':>10} "
+          f"{'R@1':>6} {f'R@{top_k}':>6} {'RSS MB':>8}")
+    for mode, row in results.items():
+        print(f"{mode:<8} {row['latency_ms_p50']:>8.3f} {row['latency_ms_p95']:>8.3f} "
+              f"{row['latency_ms_p99']:>8.3f} {row['qps']:>9.1f} {row['batch_qps']:>10.1f} "
+              f"{row['recall_at_1']:>6.3f} {row[f'recall_at_{top_k}']:>6.3f} {row['rss_mb']:>8.1f}")
+
+
+def print_comparison(previous, current):
+    """Print the relative change of every metric against a previous report."""
+    print("\nChange against the previous report:")
+    for mode, row in current["results"].items():
+        before = previous.get("results", {}).get(mode)
+        if before is None:
+            print(f"{mode:<8} not in the previous report")
+            continue
+
+        changes = []
+        for metric in ("latency_ms_p50", "latency_ms_p95", "qps", "batch_qps", "recall_at_1", "rss_mb"):
+            if metric in before and before[metric]:
+                changes.append(f"{metric} {100.0 * (row[metric] - before[metric]) / before[metric]:+.1f}%")
+        print(f"{mode:<8} " + ", ".join(changes))
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the 3D Max agents")
+    parser.add_argument("--input", type=str, default="data/qa_data.json",
+                        help="Q&A JSON file the benchmark database is built from")
+    parser.add_argument("--questions", type=str, default=None,
+                        help='Labeled questions, a JSON list of {"question": ..., "expected_id": ...}')
+    parser.add_argument("--num-questions", type=int, default=200,
+                        help="Questions sampled from the Q&A data when no --questions file is given")
+    parser.add_argument("--db", type=str, default=None,
+                        help="Benchmark an existing database with the real model instead")
+    parser.add_argument("--work-dir", type=str, default="benchmark_db",
+                        help="Where the benchmark database is built")
+    parser.add_argument("--index", type=str, default="flat",
+                        help="Index type of the benchmark database")
+    parser.add_argument("--metric", type=str, default="l2", choices=("l2", "cosine"),
+                        help="Metric of the benchmark database")
+    parser.add_argument("--modes", type=str, default=",".join(BENCHMARK_MODES),
+                        help="Comma-separated modes to benchmark")
+    parser.add_argument("--top-k", type=int, default=3,
+                        help="Results per query, recall is reported at 1 and top-k")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Timed passes over the question set")
+    parser.add_argument("--warmup", type=int, default=10,
+                        help="Untimed queries before measuring")
+    parser.add_argument("--cache-size", type=int, default=0,
+                        help="Query embedding cache size, 0 measures every query uncached")
+    parser.add_argument("--output", type=str, default="benchmark.json",
+                        help="JSON report path")
+    parser.add_argument("--compare", type=str, default=None,
+                        help="Previous JSON report to compare against")
+    args = parser.parse_args()
+
+    modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+    unknown = [mode for mode in modes if mode not in BENCHMARK_MODES]
+    if unknown:
+        raise ValueError(f"Unsupported benchmark modes: {', '.join(unknown)}")
+
+    # Build a deterministic database, or use an existing one with the real model
+    use_hashing_embedder = args.db is None
+    if use_hashing_embedder:
+        db_dir = args.work_dir
+        metadata, index_info = build_benchmark_db(args.input, db_dir, HashingEmbedder(), args.index, args.metric,
+                                                  k=args.top_k)
+    else:
+        from mmap_store import open_store
+        db_dir = args.db
+        store = open_store(db_dir)
+        metadata, index_info = list(store.metadata), store.manifest["index"]
+
+    questions = load_labeled_questions(args.questions, metadata, args.num_questions)
+    print(f"Benchmarking {len(questions)} labeled questions against {db_dir}")
+
+    results = run_benchmark(modes, db_dir, questions, use_hashing_embedder, top_k=args.top_k,
+                            repeat=args.repeat, warmup=args.warmup, cache_size=args.cache_size)
+    print_report(results, args.top_k)
+
+    report = {
+        "config": {
+            "embedder": "hashing" if use_hashing_embedder else "sentence-transformers",
+            "input": args.input if use_hashing_embedder else None,
+            "db": db_dir,
+            "index": args.index if use_hashing_embedder else None,
+            "index_info": index_info,
+            "metric": args.metric if use_hashing_embedder else None,
+            "questions": args.questions,
+            "num_questions": len(questions),
+            "top_k": args.top_k,
+            "repeat": args.repeat,
+            "cache_size": args.cache_size,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "faiss": getattr(faiss, "__version__", "unknown"),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, sort_keys=True)
+    print(f"\nSaved benchmark report to {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            print_comparison(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
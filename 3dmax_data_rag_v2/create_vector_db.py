@@ -6,6 +6,20 @@ import pickle
 from sentence_transformers import SentenceTransformer
 import html
 import re
+import time
+import hashlib
+import multiprocessing
+import shutil
+from mmap_store import (MmapFlatIndex, StringTable, StringTableWriter, encode_metadata, open_store,
+                        save_array, squared_norms, store_exists, write_manifest)
+from keyword_index import write_keyword_index
+
+
+# Content hash and stable FAISS label of every Q&A id, used for incremental rebuilds
+HASHES_FILE = "content_hashes.json"
+
+# Vectors copied, added to an index or searched at a time, bounding the memory of a build
+ROW_BATCH_SIZE = 8192
 
 
 def clean_html_tags(text):
@@ -17,61 +31,572 @@ def clean_html_tags(text):
     return text
 
 
+def iter_qa_pairs(input_file, chunk_size=1 << 16):
+    """Yield the Q&A pairs of a JSON array file one at a time, without loading the whole file."""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    in_array = False
+
+    with open(input_file, "r", encoding="utf-8") as f:
+        while True:
+            buffer = buffer.lstrip()
+
+            # Top up the buffer when it runs dry
+            if not buffer:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    raise ValueError(f"Unexpected end of JSON array in {input_file}")
+                buffer = chunk
+                continue
+
+            if not in_array:
+                if buffer[0] != "[":
+                    raise ValueError(f"Expected a JSON array of Q&A pairs in {input_file}")
+                buffer = buffer[1:]
+                in_array = True
+                continue
+
+            if buffer[0] == ",":
+                buffer = buffer[1:]
+                continue
+            if buffer[0] == "]":
+                return
+
+            try:
+                qa_pair, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                # The current item continues in the next chunk
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    raise
+                buffer += chunk
+                continue
+
+            yield qa_pair
+            buffer = buffer[end:]
+
+
 class EmbeddingEngine:
-    def __init__(self, model_name="paraphrase-multilingual-mpnet-base-v2"):
-        """Initialize the embedding engine with a multilingual model."""
+    def __init__(self, model_name="paraphrase-multilingual-mpnet-base-v2", parallel_threshold=20000):
+        """
+        Initialize the embedding engine with a multilingual model.
+
+        Corpora of at least parallel_threshold texts are cleaned in a worker pool
+        and encoded with SentenceTransformer's multi-process pool on all CPU cores.
+        """
         print(f"Loading embedding model: {model_name}")
         self.model = SentenceTransformer(model_name)
-
-    def get_embeddings(self, texts):
-        """Generate embeddings for a list of texts."""
-        # Clean HTML tags from texts
-        clean_texts = [clean_html_tags(text) for text in texts]
+        self.dimension = self.model.get_sentence_embedding_dimension()
+        self.parallel_threshold = parallel_threshold
+
+    def get_embeddings(self, texts, num_texts=None, out=None, batch_size=32, window_size=4096):
+        """
+        Generate embeddings for texts in a streaming pipeline.
+
+        Args:
+            texts: Any iterable of texts, e.g. a generator over a large corpus
+            num_texts: Number of texts; required to stream texts without a length
+            out: Preallocated (num_texts x dimension) array or memmap to fill
+            batch_size: Batch size passed to the model
+            window_size: Texts buffered and sorted by length before encoding
+
+        Returns:
+            float32 array (or the given out array) with one row per text
+        """
+        if num_texts is None:
+            texts = list(texts)
+            num_texts = len(texts)
+
+        if out is None:
+            out = np.empty((num_texts, self.dimension), dtype=np.float32)
+
+        cleaner = None
+        encode_pool = None
+        if num_texts >= self.parallel_threshold:
+            # Clean HTML in worker processes and encode on all cores
+            cleaner = multiprocessing.Pool()
+            clean_texts = cleaner.imap(clean_html_tags, texts, chunksize=256)
+            encode_pool = self.model.start_multi_process_pool()
+        else:
+            # Clean HTML tags from texts
+            clean_texts = map(clean_html_tags, texts)
+
+        try:
+            position = 0
+            window = []
+            for text in clean_texts:
+                window.append(text)
+                if len(window) == window_size:
+                    self._encode_window(window, position, out, batch_size, encode_pool)
+                    position += len(window)
+                    window = []
+                    print(f"Embedded {position}/{num_texts} texts")
+
+            if window:
+                self._encode_window(window, position, out, batch_size, encode_pool)
+                position += len(window)
+        finally:
+            if cleaner is not None:
+                cleaner.close()
+                cleaner.join()
+            if encode_pool is not None:
+                self.model.stop_multi_process_pool(encode_pool)
+
+        if position != num_texts:
+            raise ValueError(f"Expected {num_texts} texts, got {position}")
+
+        return out
+
+    def _encode_window(self, window, start, out, batch_size, encode_pool):
+        """Encode one window of texts into rows start..start+len(window) of out."""
+        # Similar lengths in a batch means less padding, longest first
+        order = sorted(range(len(window)), key=lambda i: len(window[i]), reverse=True)
+        sorted_texts = [window[i] for i in order]
 
         # Generate embeddings
-        embeddings = self.model.encode(clean_texts, show_progress_bar=True)
+        if encode_pool is not None:
+            vectors = self.model.encode_multi_process(sorted_texts, encode_pool, batch_size=batch_size)
+        else:
+            vectors = self.model.encode(sorted_texts, batch_size=batch_size)
 
-        return embeddings
+        out[start + np.array(order)] = vectors
 
 
-def prepare_documents(qa_data):
-    """Prepare documents for embedding and retrieval."""
-    documents = []
-    metadata = []
-
+def iter_documents(qa_data):
+    """Yield the (document text, metadata) of every Q&A pair."""
     for qa_pair in qa_data:
         # Create a document that combines question and answer for better semantic matching
         doc_text = f"Вопрос: {qa_pair['question']}\nОтвет: {qa_pair['answer']}"
 
-        # Store the document text for embedding
-        documents.append(doc_text)
-
         # Store metadata for retrieval
-        metadata.append({
+        yield doc_text, {
             "id": qa_pair["id"],
             "question": qa_pair["question"],
             "answer": qa_pair["answer"],
             "media": qa_pair["media"],
             "links": qa_pair["links"]
-        })
+        }
+
+
+def prepare_documents(qa_data):
+    """Prepare documents for embedding and retrieval."""
+    documents = []
+    metadata = []
+
+    for doc_text, meta in iter_documents(qa_data):
+        documents.append(doc_text)
+        metadata.append(meta)
 
     return documents, metadata
 
 
-def create_faiss_index(embeddings):
-    """Create a FAISS index for fast similarity search."""
-    # Get the embedding dimension
-    dimension = embeddings.shape[1]
+def write_document_tables(qa_data, output_dir):
+    """
+    Stream the documents and metadata of the Q&A pairs into the store's string tables.
+
+    Only the ids and content hashes are kept in memory.
+
+    Returns:
+        (ids, hashes) with the ids as strings
+    """
+    documents = StringTableWriter(output_dir, "documents")
+    metadata = StringTableWriter(output_dir, "metadata")
+    ids = []
+    hashes = []
+
+    for doc_text, meta in iter_documents(qa_data):
+        documents.append(doc_text)
+        metadata.append(encode_metadata(meta))
+        # JSON object keys are strings, so the manifest is keyed on string ids
+        ids.append(str(meta["id"]))
+        hashes.append(content_hash(doc_text))
+
+    documents.close()
+    metadata.close()
+    return ids, hashes
+
+
+class RowSubset:
+    """Array-like target that writes rows 0..n-1 into the given rows of a larger array."""
+
+    def __init__(self, array, rows):
+        self.array = array
+        self.rows = np.asarray(rows, dtype=np.int64)
+
+    def __setitem__(self, positions, values):
+        self.array[self.rows[positions]] = values
 
-    # Create an L2 distance index (Euclidean distance)
-    index = faiss.IndexFlatL2(dimension)
 
-    # Add embeddings to the index
-    index.add(embeddings.astype(np.float32))
+def copy_rows(target, target_rows, source, source_rows, batch_size=ROW_BATCH_SIZE):
+    """Copy source rows to target rows a batch at a time, so only one batch is in memory."""
+    target_rows = np.asarray(target_rows, dtype=np.int64)
+    source_rows = np.asarray(source_rows, dtype=np.int64)
+    for start in range(0, len(target_rows), batch_size):
+        target[target_rows[start:start + batch_size]] = source[source_rows[start:start + batch_size]]
+
+
+# flat: exact search, ivfpq: inverted lists with product quantization, hnsw: graph search
+INDEX_TYPES = ("flat", "ivfpq", "hnsw")
+
+# l2: raw vectors and squared distances, cosine: normalized vectors and inner products
+METRICS = ("l2", "cosine")
+
+# Score histograms used to calibrate cosine thresholds
+CALIBRATION_BINS = 200
+CALIBRATION_BACKGROUND_PAIRS = 20
+
+# FAISS warns when k-means gets fewer training points than this per centroid
+TRAINING_POINTS_PER_CENTROID = 39
+
+# Queries searched together for the exact ground truth, each needs a row of scores for every vector
+GROUND_TRUTH_BATCH_SIZE = 16
+
+# Search-time parameter swept for each kind of approximate index
+NPROBE_VALUES = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+EF_SEARCH_VALUES = [16, 32, 64, 128, 256, 512]
+
+
+def index_factory_string(index_type, num_vectors, dimension):
+    """Translate an index type into a FAISS index factory string."""
+    if index_type == "flat":
+        return "Flat"
+
+    if index_type == "hnsw":
+        return "HNSW32"
+
+    if index_type == "ivfpq":
+        # About 4 * sqrt(N) lists, but never fewer training points per list than FAISS wants
+        nlist = max(1, min(int(4 * np.sqrt(num_vectors)), num_vectors // TRAINING_POINTS_PER_CENTROID))
+        # Sub-quantizers must divide the dimension, aim for at least 4 dimensions each
+        m = next(m for m in (64, 48, 32, 24, 16, 12, 8, 4, 2, 1)
+                 if dimension % m == 0 and m <= max(1, dimension // 4))
+        return f"IVF{nlist},PQ{m}"
+
+    # Anything else is handed to faiss.index_factory as is
+    return index_type
+
+
+def select_training_sample(embeddings, index, seed=0):
+    """Pick a random subset of the embeddings, large enough to train the index."""
+    # IVF needs points for its coarse centroids, PQ for its 256 codewords per sub-quantizer
+    centroids = 256
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        centroids = max(centroids, ivf.nlist)
+
+    sample_size = min(len(embeddings), TRAINING_POINTS_PER_CENTROID * centroids)
+    if sample_size == len(embeddings):
+        return embeddings
+
+    rng = np.random.default_rng(seed)
+    sample_ids = np.sort(rng.choice(len(embeddings), size=sample_size, replace=False))
+    return embeddings[sample_ids]
+
+
+def effective_index_type(index_type, num_vectors):
+    """The index type actually built, small corpora fall back to exact search."""
+    # 8-bit product quantizers need at least 256 training points
+    if index_type == "ivfpq" and num_vectors < 256:
+        print(f"Only {num_vectors} vectors, too few to train IVF-PQ. Using a flat index instead.")
+        return "flat"
+    return index_type
+
+
+def faiss_metric(metric):
+    """FAISS metric constant for a metric name."""
+    return faiss.METRIC_INNER_PRODUCT if metric == "cosine" else faiss.METRIC_L2
+
+
+def create_faiss_index(embeddings, index_type="flat", labels=None, metric="l2"):
+    """
+    Create a FAISS index for fast similarity search.
+
+    Vectors are added under stable int64 labels (row positions by default), so
+    later incremental rebuilds can remove and replace them by label. With the
+    cosine metric the embeddings must already be normalized. embeddings may be
+    a memmap; IVF-PQ keeps only compressed codes, HNSW and flat indexes hold a
+    full copy of the vectors in memory.
+    """
+    # Get the embedding dimension
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    num_vectors, dimension = embeddings.shape
+    if labels is None:
+        labels = np.arange(num_vectors, dtype=np.int64)
+
+    index_type = effective_index_type(index_type, num_vectors)
+
+    if index_type == "flat":
+        # Inner products of normalized vectors are cosine similarities
+        if metric == "cosine":
+            index = faiss.IndexFlatIP(dimension)
+        else:
+            # Create an L2 distance index (Euclidean distance)
+            index = faiss.IndexFlatL2(dimension)
+    else:
+        factory = index_factory_string(index_type, num_vectors, dimension)
+        print(f"Building approximate index: {factory}")
+        index = faiss.index_factory(dimension, factory, faiss_metric(metric))
+
+    # Approximate indexes learn their centroids/codebooks first
+    if not index.is_trained:
+        training_sample = select_training_sample(embeddings, index)
+        print(f"Training index on {len(training_sample)} of {num_vectors} vectors")
+        index.train(training_sample)
+
+    # IVF indexes keep ids themselves, the others get an id map
+    if faiss.try_extract_index_ivf(index) is None:
+        index = faiss.IndexIDMap(index)
+
+    # Add embeddings to the index a batch at a time, memmapped vectors are never loaded at once
+    labels = np.asarray(labels, dtype=np.int64)
+    for start in range(0, num_vectors, ROW_BATCH_SIZE):
+        index.add_with_ids(np.ascontiguousarray(embeddings[start:start + ROW_BATCH_SIZE]),
+                           labels[start:start + ROW_BATCH_SIZE])
 
     return index
 
 
+def base_index(index):
+    """Return the index wrapped by an id map, downcast to its concrete type."""
+    if isinstance(index, faiss.IndexIDMap):
+        index = index.index
+    return faiss.downcast_index(index)
+
+
+def search_parameter(index):
+    """Return the name and candidate values of the index's search-time parameter."""
+    if faiss.try_extract_index_ivf(index) is not None:
+        nlist = faiss.extract_index_ivf(index).nlist
+        return "nprobe", [value for value in NPROBE_VALUES if value <= nlist]
+
+    if hasattr(base_index(index), "hnsw"):
+        return "efSearch", EF_SEARCH_VALUES
+
+    return None, []
+
+
+def measure_index(index, queries, ground_truth, k):
+    """Measure recall@k against exact neighbours and per-query search latency."""
+    latencies = []
+    found = []
+    for query in queries:
+        start = time.perf_counter()
+        _, indices = index.search(query.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        found.append(indices[0])
+
+    recall = np.mean([
+        len(set(row.tolist()) & set(truth.tolist())) / k for row, truth in zip(found, ground_truth)
+    ])
+    return {
+        "recall": float(recall),
+        "latency_ms_mean": float(np.mean(latencies)),
+        "latency_ms_p95": float(np.percentile(latencies, 95)),
+    }
+
+
+def tune_index(index, embeddings, queries, k=3, target_recall=0.95, labels=None, metric="l2"):
+    """
+    Sweep the search-time parameter of an approximate index against exact search.
+
+    Picks the cheapest setting that reaches target_recall (or the best recall
+    if none does) and sets it on the index. labels are the index ids of the
+    embedding rows, if they differ from the row positions.
+
+    Returns:
+        (params, report) with the chosen parameters and the recall/latency rows
+    """
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    k = min(k, len(embeddings))
+
+    # Exact neighbours are the reference, searched over the vectors where they
+    # are (e.g. a memmap) instead of a second in-memory copy
+    flat_index = MmapFlatIndex(embeddings, squared_norms(embeddings), "ip" if metric == "cosine" else "l2")
+    ground_truth = np.concatenate([
+        flat_index.search(queries[start:start + GROUND_TRUTH_BATCH_SIZE], k)[1]
+        for start in range(0, len(queries), GROUND_TRUTH_BATCH_SIZE)
+    ])
+
+    # The flat index returns row positions, so it is measured before mapping to labels
+    report = [dict(index="flat", **measure_index(flat_index, queries, ground_truth, k))]
+    if labels is not None:
+        ground_truth = np.asarray(labels)[ground_truth]
+
+    param_name, values = search_parameter(index)
+    if param_name is None:
+        return {}, report
+
+    parameter_space = faiss.ParameterSpace()
+    rows = []
+    for value in values:
+        parameter_space.set_index_parameter(index, param_name, value)
+        row = dict(index="approximate", **{param_name: value}, **measure_index(index, queries, ground_truth, k))
+        rows.append(row)
+        report.append(row)
+
+    # The sweep is ordered from cheapest to most expensive
+    reaching_target = [row for row in rows if row["recall"] >= target_recall]
+    chosen = reaching_target[0] if reaching_target else max(rows, key=lambda row: row["recall"])
+    parameter_space.set_index_parameter(index, param_name, chosen[param_name])
+
+    return {param_name: chosen[param_name]}, report
+
+
+def print_index_report(report, k):
+    """Print the recall@k vs latency table of an index sweep."""
+    print(f"\n{'Index':<28} {f'Recall@{k}':>10} {'Mean ms':>10} {'p95 ms':>10}")
+    for row in report:
+        name = row["index"]
+        for param_name in ("nprobe", "efSearch"):
+            if param_name in row:
+                name += f" {param_name}={row[param_name]}"
+        print(f"{name:<28} {row['recall']:>10.3f} {row['latency_ms_mean']:>10.3f} {row['latency_ms_p95']:>10.3f}")
+
+
+def embed_questions(embedding_engine, metadata, rows, metric="l2"):
+    """Embed the questions of the given rows, normalized for the cosine metric."""
+    queries = embedding_engine.get_embeddings([metadata[row]["question"] for row in rows])
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    if metric == "cosine":
+        faiss.normalize_L2(queries)
+    return queries
+
+
+def calibrate_scores(embeddings, queries, rows, bins=CALIBRATION_BINS,
+                     background_pairs=CALIBRATION_BACKGROUND_PAIRS, seed=0):
+    """
+    Histogram cosine scores of matching and unrelated question/document pairs.
+
+    queries are the normalized question embeddings of the given rows. A
+    question scored against its own Q&A document is a match, against random
+    other documents it is background. The agents derive their thresholds from
+    these two distributions.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    match_scores = np.einsum("ij,ij->i", queries, np.asarray(embeddings[rows]))
+
+    # Random other documents for every question
+    rng = np.random.default_rng(seed)
+    others = rng.integers(0, len(embeddings) - 1, size=(len(rows), background_pairs))
+    others += others >= rows[:, None]
+    unique_others, inverse = np.unique(others, return_inverse=True)
+    other_vectors = np.asarray(embeddings[unique_others])
+    background_scores = np.einsum("ijk,ik->ij", other_vectors[inverse.reshape(others.shape)], queries)
+
+    edges = np.linspace(-1.0, 1.0, bins + 1)
+    match_counts, _ = np.histogram(np.clip(match_scores, -1.0, 1.0), bins=edges)
+    background_counts, _ = np.histogram(np.clip(background_scores, -1.0, 1.0), bins=edges)
+    return {
+        "edges": edges.tolist(),
+        "match_counts": match_counts.tolist(),
+        "background_counts": background_counts.tolist(),
+    }
+
+
+def content_hash(document):
+    """Hash of the text that gets embedded for a Q&A pair."""
+    return hashlib.sha256(document.encode("utf-8")).hexdigest()
+
+
+def load_previous_build(output_dir):
+    """
+    Load the hash manifest and store of an existing database.
+
+    Returns:
+        (hash_manifest, store), or (None, None) if there is nothing to update
+    """
+    hashes_path = os.path.join(output_dir, HASHES_FILE)
+    if not (os.path.exists(hashes_path) and store_exists(output_dir)):
+        return None, None
+
+    with open(hashes_path, "r", encoding="utf-8") as f:
+        hash_manifest = json.load(f)
+    return hash_manifest, open_store(output_dir)
+
+
+def write_hash_manifest(path, ids, hashes, labels, next_label):
+    """Write the hash manifest entry by entry, without building it as one dict first."""
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f'{{\n  "next_label": {int(next_label)},\n  "items": {{')
+        for i, (qa_id, doc_hash, label) in enumerate(zip(ids, hashes, labels)):
+            entry = json.dumps({"hash": doc_hash, "label": int(label)})
+            f.write(f'{"," if i else ""}\n    {json.dumps(qa_id, ensure_ascii=False)}: {entry}')
+        f.write("\n  }\n}\n")
+
+
+def plan_update(ids, hashes, hash_manifest, previous_store):
+    """
+    Decide which Q&A pairs need new embeddings.
+
+    Unchanged pairs keep their label and their stored vector, new or edited
+    pairs get a fresh label. Ids are compared as strings, the way the JSON
+    manifest stores them, so int ids in the Q&A data match across builds.
+
+    Returns:
+        (labels, reused_rows, embed_rows, stale_labels, next_label) where
+        reused_rows maps new row positions to rows of the previous store and
+        stale_labels are the labels of removed or edited pairs
+    """
+    previous_items = hash_manifest["items"] if hash_manifest else {}
+    next_label = hash_manifest["next_label"] if hash_manifest else 0
+    previous_rows = {}
+    if previous_store is not None:
+        previous_rows = {str(meta["id"]): row for row, meta in enumerate(previous_store.metadata)}
+    ids = [str(qa_id) for qa_id in ids]
+
+    labels = np.empty(len(ids), dtype=np.int64)
+    reused_rows = {}
+    embed_rows = []
+    for row, (qa_id, doc_hash) in enumerate(zip(ids, hashes)):
+        previous = previous_items.get(qa_id)
+        if previous and previous["hash"] == doc_hash and qa_id in previous_rows:
+            labels[row] = previous["label"]
+            reused_rows[row] = previous_rows[qa_id]
+        else:
+            labels[row] = next_label
+            next_label += 1
+            embed_rows.append(row)
+
+    current_hashes = dict(zip(ids, hashes))
+    stale_labels = [
+        item["label"] for qa_id, item in previous_items.items()
+        if current_hashes.get(qa_id) != item["hash"]
+    ]
+    return labels, reused_rows, embed_rows, stale_labels, next_label
+
+
+def update_faiss_index(index, embeddings, labels, embed_rows, stale_labels):
+    """
+    Apply an incremental update to an existing index in place.
+
+    Returns:
+        True on success, False if the index type cannot remove entries (HNSW)
+    """
+    try:
+        if stale_labels:
+            index.remove_ids(np.array(stale_labels, dtype=np.int64))
+    except RuntimeError:
+        return False
+
+    embed_rows = np.asarray(embed_rows, dtype=np.int64)
+    for start in range(0, len(embed_rows), ROW_BATCH_SIZE):
+        rows = embed_rows[start:start + ROW_BATCH_SIZE]
+        index.add_with_ids(np.ascontiguousarray(embeddings[rows]), labels[rows])
+    return True
+
+
+def publish_vector_db(staging_dir, output_dir):
+    """Swap a completely written database directory into place."""
+    previous_dir = output_dir.rstrip("/\\") + ".previous"
+    if os.path.exists(previous_dir):
+        shutil.rmtree(previous_dir)
+
+    if os.path.exists(output_dir):
+        os.rename(output_dir, previous_dir)
+    os.rename(staging_dir, output_dir)
+    shutil.rmtree(previous_dir, ignore_errors=True)
+
+
 def save_vector_db(index, documents, metadata, output_dir="vector_db"):
     """Save the vector database and supporting data."""
     # Create output directory if it doesn't exist
@@ -92,40 +617,180 @@ def save_vector_db(index, documents, metadata, output_dir="vector_db"):
 
 
 def main():
-    import re  # Import here to avoid global scope issues
+    import argparse
+    import random
+
+    parser = argparse.ArgumentParser(description="Create the 3D Max vector database")
+    parser.add_argument("--input", type=str, default="data/qa_data.json",
+                        help="Path to the Q&A JSON file")
+    parser.add_argument("--output", type=str, default="vector_db",
+                        help="Directory for the vector database")
+    parser.add_argument("--index", type=str, default="flat",
+                        help=f"Index type ({', '.join(INDEX_TYPES)}) or a FAISS index factory string")
+    parser.add_argument("--target-recall", type=float, default=0.95,
+                        help="Recall@k an approximate index has to reach when tuning its search parameter")
+    parser.add_argument("--eval-queries", type=int, default=500,
+                        help="Number of questions used to measure recall and latency")
+    parser.add_argument("--k", type=int, default=3,
+                        help="k used for recall@k")
+    parser.add_argument("--full", action="store_true",
+                        help="Re-embed everything instead of only new or changed Q&A pairs")
+    parser.add_argument("--metric", type=str, default="l2", choices=METRICS,
+                        help="l2 distances, or cosine scores over normalized vectors")
+    args = parser.parse_args()
 
     # Load the Q&A data
-    input_file = "data/qa_data.json"
+    input_file = args.input
     print(f"Loading Q&A data from {input_file}")
 
-    with open(input_file, "r", encoding="utf-8") as f:
-        qa_data = json.load(f)
-
-    print(f"Loaded {len(qa_data)} Q&A pairs")
-
-    # Prepare documents and metadata
-    documents, metadata = prepare_documents(qa_data)
+    # Everything is written to a staging directory and swapped in at the end
+    output_dir = args.output
+    staging_dir = output_dir.rstrip("/\\") + ".staging"
+    if os.path.exists(staging_dir):
+        shutil.rmtree(staging_dir)
+    os.makedirs(staging_dir)
+
+    # Documents and metadata go straight to the store's string tables, reading the pairs one at a time
+    ids, hashes = write_document_tables(iter_qa_pairs(input_file), staging_dir)
+    documents = StringTable(staging_dir, "documents")
+    metadata = StringTable(staging_dir, "metadata", decode=json.loads)
     print(f"Prepared {len(documents)} documents for embedding")
-
-    # Initialize embedding engine
-    embedding_engine = EmbeddingEngine()
+    if not len(documents):
+        raise ValueError(f"No Q&A pairs found in {input_file}")
+
+    if len(set(ids)) != len(ids):
+        raise ValueError("Q&A ids must be unique for incremental rebuilds")
+
+    # Compare against the previous build to find what has to be embedded
+    hash_manifest, previous_store = (None, None) if args.full else load_previous_build(output_dir)
+
+    # Stored vectors of another metric cannot be reused as they are
+    if previous_store is not None and previous_store.metric != args.metric:
+        print(f"Previous database uses the {previous_store.metric} metric, re-embedding everything")
+        previous_store.close()
+        hash_manifest, previous_store = None, None
+    labels, reused_rows, embed_rows, stale_labels, next_label = plan_update(
+        ids, hashes, hash_manifest, previous_store
+    )
+    removed = len(set(hash_manifest["items"]) - set(ids)) if hash_manifest else 0
+    print(f"{len(reused_rows)} unchanged, {len(embed_rows)} new or changed, {removed} removed Q&A pairs")
+    del hash_manifest
+
+    # The model is only loaded if something has to be embedded
+    embedding_engine = None
+    if embed_rows:
+        # Initialize embedding engine
+        embedding_engine = EmbeddingEngine()
+        dimension = embedding_engine.dimension
+    else:
+        dimension = previous_store.vectors.shape[1]
+
+    # Vectors are written batch by batch into the store's vector file, so peak memory stays flat
+    embeddings = np.lib.format.open_memmap(os.path.join(staging_dir, "vectors.npy"), mode="w+",
+                                           dtype=np.float32, shape=(len(documents), dimension))
 
     # Generate embeddings
-    print("Generating embeddings...")
-    embeddings = embedding_engine.get_embeddings(documents)
-    print(f"Generated embeddings with shape: {embeddings.shape}")
-
-    # Create FAISS index
-    print("Creating FAISS index...")
-    index = create_faiss_index(embeddings)
-    print(f"Created FAISS index with {index.ntotal} vectors")
-
-    # Save vector database
-    output_dir = "vector_db"
-    save_vector_db(index, documents, metadata, output_dir)
+    if embed_rows:
+        print("Generating embeddings...")
+        texts = (documents[row] for row in embed_rows)
+        out = embeddings if len(embed_rows) == len(documents) else RowSubset(embeddings, embed_rows)
+        embedding_engine.get_embeddings(texts, num_texts=len(embed_rows), out=out)
+
+    # Unchanged pairs reuse their stored vectors
+    if reused_rows:
+        copy_rows(embeddings, np.fromiter(reused_rows.keys(), dtype=np.int64, count=len(reused_rows)),
+                  previous_store.vectors, np.fromiter(reused_rows.values(), dtype=np.int64, count=len(reused_rows)))
+
+    # Cosine databases store unit vectors, so inner products are cosine scores
+    if args.metric == "cosine":
+        for start in range(0, len(embeddings), ROW_BATCH_SIZE):
+            faiss.normalize_L2(embeddings[start:start + ROW_BATCH_SIZE])
+    embeddings.flush()
+    print(f"Embeddings ready with shape: {embeddings.shape}")
+
+    # Questions of a fixed sample are the queries for tuning and calibration
+    sample_rows = sorted(random.Random(0).sample(range(len(metadata)), min(args.eval_queries, len(metadata))))
+    queries = None
+
+    # Flat stores are searched directly over the vector file, only approximate indexes are built
+    index_type = effective_index_type(args.index, len(documents))
+    index = None
+    index_info = {"type": index_type}
+    calibration = None
+
+    # Update the previous index in place when it has the requested type
+    if (index_type != "flat" and previous_store is not None
+            and previous_store.manifest["index"]["type"] == index_type):
+        index = faiss.read_index(os.path.join(output_dir, "faiss_index.bin"))
+        if update_faiss_index(index, embeddings, labels, embed_rows, stale_labels):
+            index_info = previous_store.manifest["index"]
+            print(f"Updated FAISS index in place, now {index.ntotal} vectors")
+        else:
+            print("Index type cannot remove entries, rebuilding it from the stored vectors")
+            index = None
+
+    # The previous store is no longer needed once its vectors have been copied
+    if previous_store is not None:
+        calibration = previous_store.calibration
+        previous_store.close()
+
+    if index is None and index_type != "flat":
+        # Create FAISS index
+        print("Creating FAISS index...")
+        index = create_faiss_index(embeddings, index_type, labels, metric=args.metric)
+        print(f"Created FAISS index with {index.ntotal} vectors")
+
+        # Tune approximate indexes against exact search on real questions
+        if embedding_engine is None:
+            embedding_engine = EmbeddingEngine()
+        queries = embed_questions(embedding_engine, metadata, sample_rows, args.metric)
+
+        params, report = tune_index(index, embeddings, queries, k=args.k,
+                                    target_recall=args.target_recall, labels=labels, metric=args.metric)
+        print_index_report(report, args.k)
+        print(f"Selected search parameters: {params}")
+        index_info["params"] = params
+
+        with open(os.path.join(staging_dir, "index_report.json"), "w", encoding="utf-8") as f:
+            json.dump({"index": index_type, "k": args.k, "params": params, "report": report}, f, indent=2)
+        print(f"Saved recall/latency report to {output_dir}/index_report.json")
+
+    # Recalibrate the cosine thresholds whenever the vectors changed
+    if args.metric == "cosine" and len(documents) > 1 and (embed_rows or calibration is None):
+        if queries is None:
+            if embedding_engine is None:
+                embedding_engine = EmbeddingEngine()
+            queries = embed_questions(embedding_engine, metadata, sample_rows, args.metric)
+
+        calibration = calibrate_scores(embeddings, queries, sample_rows)
+        print(f"Calibrated cosine scores on {len(sample_rows)} questions")
+
+    # The agents map the store, nothing is pickled; approximate indexes are mapped by FAISS
+    if index is not None:
+        faiss.write_index(index, os.path.join(staging_dir, "faiss_index.bin"))
+        print(f"Saved FAISS index to {output_dir}/faiss_index.bin")
+        del index
+
+    save_array(squared_norms(embeddings), os.path.join(staging_dir, "norms.npy"))
+    save_array(labels, os.path.join(staging_dir, "labels.npy"))
+    num_vectors = len(embeddings)
+    del embeddings
+
+    # Build the inverted keyword index once, instead of at every agent startup
+    write_keyword_index(documents, staging_dir)
+    documents.close()
+    metadata.close()
+
+    # Remember what was embedded, for the next incremental rebuild
+    write_hash_manifest(os.path.join(staging_dir, HASHES_FILE), ids, hashes, labels, next_label)
+
+    # The store manifest is written last and marks the store as complete
+    write_manifest(staging_dir, num_vectors, dimension, index_info=index_info, metric=args.metric,
+                   calibration=calibration if args.metric == "cosine" else None)
+
+    publish_vector_db(staging_dir, output_dir)
 
     print(f"Vector database created successfully in {output_dir}")
 
-
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
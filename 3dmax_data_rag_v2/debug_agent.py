@@ -6,12 +6,20 @@ import re
 import html
 import json
 from sentence_transformers import SentenceTransformer
+from mmap_store import open_store, store_exists
 
 
 def load_and_check_resources(vector_db_path="vector_db"):
     """Load and inspect the vector database resources."""
     print(f"Loading resources from {vector_db_path}...")
 
+    # Incremental rebuilds leave FAISS labels out of sync with the pickles, the store maps them back
+    if store_exists(vector_db_path):
+        store = open_store(vector_db_path)
+        index, documents, metadata = store.index, store.documents, store.metadata
+        print(f"Mapped store with {index.ntotal} vectors ({store.manifest['index']['type']} index)")
+        return _print_samples(index, documents, metadata)
+
     # Check if files exist
     index_path = os.path.join(vector_db_path, "faiss_index.bin")
     documents_path = os.path.join(vector_db_path, "documents.pkl")
@@ -43,6 +51,11 @@ def load_and_check_resources(vector_db_path="vector_db"):
         metadata = pickle.load(f)
     print(f"Loaded metadata for {len(metadata)} Q&A pairs")
 
+    return _print_samples(index, documents, metadata)
+
+
+def _print_samples(index, documents, metadata):
+    """Print a few documents and metadata entries for inspection."""
     # Print a sample of the documents for inspection
     print("\nSample documents:")
     for i, doc in enumerate(documents[:3]):
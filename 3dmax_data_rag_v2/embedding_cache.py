@@ -0,0 +1,168 @@
+"""
+Query embedding cache for the 3D Max agents.
+
+Repeated questions skip the SentenceTransformer forward pass: embeddings are
+kept in a bounded LRU keyed on the cleaned query text. With a path, entries are
+also spilled to a sqlite file keyed on the model name and the text, so a
+restarted agent starts with the hot set already loaded and can still find
+entries that were evicted from memory, and a file shared by agents running
+different models never returns another model's vector.
+"""
+import sqlite3
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """Bounded LRU cache of the query embeddings of one model with an optional sqlite spill."""
+
+    def __init__(self, model, max_size=1024, path=None, max_disk_size=100000):
+        self.model = model
+        self.max_size = max_size
+        self.max_disk_size = max_disk_size
+        self.path = path
+        self._entries = OrderedDict()
+
+        # Counters for monitoring the hit rate
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path)
+            # Files written before entries were keyed on the model cannot tell which model made them
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(embeddings)")]
+            if columns and "model" not in columns:
+                self._db.execute("DROP TABLE embeddings")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (model TEXT NOT NULL, text TEXT NOT NULL, "
+                "vector BLOB NOT NULL, last_used REAL NOT NULL, PRIMARY KEY (model, text))"
+            )
+            self._db.commit()
+            self._warm_up()
+
+    def _warm_up(self):
+        """Load the most recently used entries from disk into memory."""
+        rows = self._db.execute(
+            "SELECT text, vector FROM embeddings WHERE model = ? ORDER BY last_used DESC LIMIT ?",
+            (self.model, self.max_size)
+        ).fetchall()
+
+        # Oldest first, so the most recent entry ends up at the LRU head
+        for text, vector in reversed(rows):
+            self._entries[text] = np.frombuffer(vector, dtype=np.float32)
+
+        if rows:
+            print(f"Loaded {len(rows)} cached query embeddings from {self.path}")
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remember(self, text, vector):
+        """Insert an entry in memory, evicting the least recently used one if full."""
+        self._entries[text] = vector
+        self._entries.move_to_end(text)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get(self, text):
+        """Return the cached embedding for a cleaned query, or None."""
+        vector = self._entries.get(text)
+        if vector is not None:
+            self._entries.move_to_end(text)
+            self.hits += 1
+            return vector
+
+        # Entries evicted from memory may still be on disk
+        if self._db is not None:
+            row = self._db.execute(
+                "SELECT vector FROM embeddings WHERE model = ? AND text = ?", (self.model, text)
+            ).fetchone()
+            if row is not None:
+                vector = np.frombuffer(row[0], dtype=np.float32)
+                self._remember(text, vector)
+                self.hits += 1
+                self.disk_hits += 1
+                return vector
+
+        self.misses += 1
+        return None
+
+    def put(self, text, vector):
+        """Store the embedding of a cleaned query."""
+        self.put_many({text: vector})
+
+    def put_many(self, items):
+        """Store embeddings for a dict of cleaned queries, with one disk commit."""
+        rows = []
+        for text, vector in items.items():
+            vector = np.asarray(vector, dtype=np.float32)
+            self._remember(text, vector)
+            rows.append((self.model, text, vector.tobytes(), time.time()))
+
+        if self._db is not None:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text, vector, last_used) VALUES (?, ?, ?, ?)", rows
+            )
+            self._db.commit()
+
+    def encode(self, texts, encode_fn):
+        """
+        Embed a list of cleaned queries, calling encode_fn only for the cache misses.
+
+        Args:
+            texts: Cleaned query texts
+            encode_fn: Function taking a list of texts and returning their embeddings
+
+        Returns:
+            float32 array with one row per text
+        """
+        # Each distinct text is looked up, and counted as a hit or miss, once
+        found = {text: self.get(text) for text in dict.fromkeys(texts)}
+
+        # Each distinct missing text is encoded once
+        missing = [text for text, vector in found.items() if vector is None]
+        if missing:
+            new_vectors = dict(zip(missing, np.asarray(encode_fn(missing), dtype=np.float32)))
+            self.put_many(new_vectors)
+            found.update(new_vectors)
+
+        return np.vstack([found[text] for text in texts]) if texts else np.empty((0, 0), dtype=np.float32)
+
+    def stats(self):
+        """Return the cache counters."""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "disk_hits": self.disk_hits,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def flush(self):
+        """Record the in-memory hot set on disk and trim the spill file."""
+        if self._db is None:
+            return
+
+        # Newer timestamps for the entries still in memory, in LRU order
+        now = time.time()
+        self._db.executemany(
+            "UPDATE embeddings SET last_used = ? WHERE model = ? AND text = ?",
+            [(now + i * 1e-6, self.model, text) for i, text in enumerate(self._entries)]
+        )
+        self._db.execute(
+            "DELETE FROM embeddings WHERE rowid NOT IN "
+            "(SELECT rowid FROM embeddings ORDER BY last_used DESC LIMIT ?)", (self.max_disk_size,)
+        )
+        self._db.commit()
+
+    def close(self):
+        """Flush the cache and close the spill file."""
+        if self._db is not None:
+            self.flush()
+            self._db.close()
+            self._db = None
@@ -5,26 +5,66 @@ import os
 import re
 import html
 from sentence_transformers import SentenceTransformer
+from mmap_store import open_store, range_search_top_k, similarity_thresholds, store_exists
+from embedding_cache import EmbeddingCache
+from keyword_index import KeywordIndex, build_keyword_index, keyword_index_exists, open_keyword_index
 import json
 
+# vector: FAISS only, hybrid: FAISS plus keyword boost,
+# bm25: sparse retrieval only, fusion: FAISS and BM25 combined with reciprocal-rank fusion
+SEARCH_MODES = ("vector", "hybrid", "bm25", "fusion")
+
 
 class Agent3DMax:
-    def __init__(self, vector_db_path="vector_db"):
+    def __init__(self, vector_db_path="vector_db", search_mode="hybrid", fusion_depth=50, rrf_k=60,
+                 cache_size=1024, cache_path=None):
         """Initialize the 3D Max Agent with the vector database."""
+        if search_mode not in SEARCH_MODES:
+            raise ValueError(f"Unsupported search mode: {search_mode}")
+
         self.vector_db_path = vector_db_path
+        self.cache_size = cache_size  # Query embeddings kept in memory
+        self.cache_path = cache_path  # Optional sqlite file for warm restarts
+        self.search_mode = search_mode
+        self.fusion_depth = fusion_depth  # Candidates taken from each ranking before fusion
+        self.rrf_k = rrf_k  # Damping constant of reciprocal-rank fusion
         self.load_resources()
         self.load_model()
-        self.create_keyword_index()
+        self.load_keyword_index()
 
     def load_resources(self):
         """Load the vector database resources."""
         print(f"Loading resources from {self.vector_db_path}...")
 
+        # Prefer the memory-mapped store: nothing is deserialized into the process heap
+        if store_exists(self.vector_db_path):
+            store = open_store(self.vector_db_path)
+            self.index = store.index
+            self.documents = store.documents
+            self.metadata = store.metadata
+            self.metric = store.metric
+            self.calibration = store.calibration
+            self.vectors = store.vectors
+            self.norms = store.norms
+            print(f"Mapped store with {self.index.ntotal} vectors")
+            self.set_thresholds()
+            return
+
+        # Fall back to the pickled database
         # Load FAISS index
         index_path = os.path.join(self.vector_db_path, "faiss_index.bin")
         self.index = faiss.read_index(index_path)
         print(f"Loaded FAISS index with {self.index.ntotal} vectors")
 
+        # Inner-product indexes hold normalized vectors
+        self.metric = "cosine" if self.index.metric_type == faiss.METRIC_INNER_PRODUCT else "l2"
+        self.calibration = None
+        self.set_thresholds()
+
+        # Keep the raw vectors for re-scoring keyword candidates
+        self.vectors = self.index.reconstruct_n(0, self.index.ntotal)
+        self.norms = np.einsum("ij,ij->i", self.vectors, self.vectors)
+
         # Load documents
         with open(os.path.join(self.vector_db_path, "documents.pkl"), "rb") as f:
             self.documents = pickle.load(f)
@@ -35,34 +75,56 @@ class Agent3DMax:
             self.metadata = pickle.load(f)
         print(f"Loaded metadata for {len(self.metadata)} Q&A pairs")
 
+    def set_thresholds(self):
+        """Pick the similarity thresholds for the database metric."""
+        self.threshold, self.good_threshold = similarity_thresholds(self.metric, self.calibration)
+        print(f"Using {self.metric} scores, thresholds {self.threshold:.3f} / {self.good_threshold:.3f}")
+
     def load_model(self):
         """Load the sentence transformer model for embeddings."""
         model_name = "paraphrase-multilingual-mpnet-base-v2"
         print(f"Loading embedding model: {model_name}")
         self.model = SentenceTransformer(model_name)
 
-    def create_keyword_index(self):
-        """Create a keyword-based index for hybrid search."""
-        self.keyword_index = {}
-
-        # Important keywords in Russian for 3D Max operations
-        keywords = ["сетка", "grid", "рендер", "rendering", "слой", "layer",
-                    "панел", "panel", "настрой", "setting", "язык", "language",
-                    "клавиш", "keyboard", "импорт", "import", "проект", "project",
-                    "сохран", "save", "интерфейс", "interface"]
+        # Query embeddings are cached, optionally spilled to disk for warm restarts
+        self.embedding_cache = EmbeddingCache(model_name, max_size=self.cache_size, path=self.cache_path)
 
-        # Create index mapping keywords to document indices
-        for i, doc in enumerate(self.documents):
-            doc_lower = doc.lower()
-
-            # For each keyword, check if it's in the document
-            for keyword in keywords:
-                if keyword.lower() in doc_lower:
-                    if keyword not in self.keyword_index:
-                        self.keyword_index[keyword] = []
-                    self.keyword_index[keyword].append(i)
-
-        print(f"Created keyword index with {len(self.keyword_index)} keys")
+    def load_keyword_index(self):
+        """Load the inverted keyword index for hybrid search."""
+        if keyword_index_exists(self.vector_db_path):
+            self.keyword_index = open_keyword_index(self.vector_db_path)
+        else:
+            # Databases created before the index was saved: build it in memory
+            self.keyword_index = KeywordIndex(*build_keyword_index(self.documents))
+
+        print(f"Loaded keyword index with {len(self.keyword_index)} terms")
+
+    def prepare_queries(self, query_embeddings):
+        """Convert query embeddings to a float32 matrix, normalized for cosine scores."""
+        query_embeddings = np.array(query_embeddings, dtype=np.float32, ndmin=2)
+        if self.metric == "cosine":
+            faiss.normalize_L2(query_embeddings)
+        return query_embeddings
+
+    def search_index(self, query_embeddings, top_k, min_similarity):
+        """
+        Search the index for the top_k neighbours of every query row.
+
+        Cosine databases run a range search, so candidates below min_similarity
+        are dropped inside the index. Returns (scores, indices) like index.search.
+        """
+        if self.metric == "cosine":
+            return range_search_top_k(self.index, query_embeddings, min_similarity, top_k)
+        return self.index.search(query_embeddings, top_k)
+
+    def similarity(self, score):
+        """Similarity of an index score: cosine scores as they are, L2 distances mapped to (0, 1]."""
+        if self.metric == "cosine":
+            return score
+
+        # For L2 distance, smaller is better, so we use an exponential decay function
+        # This gives more separation between close matches and distant matches
+        return np.exp(-score / 10.0)  # Adjusted scale factor
 
     def clean_text(self, text):
         """Clean HTML tags from text and standardize whitespace."""
@@ -78,82 +140,208 @@ class Agent3DMax:
         """Generate an embedding for a query."""
         # Clean the query
         clean_query = self.clean_text(query)
-        # Generate embedding
-        embedding = self.model.encode([clean_query])[0]
+        # Reuse the embedding of a repeated question
+        embedding = self.embedding_cache.get(clean_query)
+        if embedding is None:
+            # Generate embedding
+            embedding = self.model.encode([clean_query])[0]
+            self.embedding_cache.put(clean_query, embedding)
         return embedding
 
-    def hybrid_search(self, query, top_k=3, threshold=0.15):
+    def generate_embeddings(self, queries, batch_size=32):
+        """Generate embeddings for a list of queries with one model call for the uncached ones."""
+        clean_queries = [self.clean_text(query) for query in queries]
+        return self.embedding_cache.encode(
+            clean_queries, lambda texts: self.model.encode(texts, batch_size=batch_size)
+        )
+
+    def search(self, query, top_k=3, threshold=None, mode=None):
+        """Search for the most relevant Q&A pairs with the selected search mode."""
+        return self.search_many([query], top_k=top_k, threshold=threshold, mode=mode)[0]
+
+    def hybrid_search(self, query, top_k=3, threshold=None):
         """Perform hybrid search combining vector and keyword matching."""
-        # Clean the query
-        clean_query = self.clean_text(query.lower())
+        return self.search(query, top_k=top_k, threshold=threshold, mode="hybrid")
 
-        # Generate query embedding
-        query_embedding = self.generate_embedding(query)
+    def search_many(self, queries, top_k=3, threshold=None, batch_size=64, mode=None):
+        """Search for many queries at once, one matrix search per batch."""
+        mode = mode or self.search_mode
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unsupported search mode: {mode}")
+        threshold = self.threshold if threshold is None else threshold
 
-        # Convert to float32 as required by FAISS
-        query_embedding = np.array([query_embedding]).astype('float32')
+        queries = list(queries)
+        all_results = []
 
-        # Vector search
-        distances, indices = self.index.search(query_embedding, top_k)
+        # Fusion looks deeper into the vector ranking than the final top_k
+        search_k = max(top_k, self.fusion_depth) if mode == "fusion" else top_k
+        # Fusion keeps candidates down to the lowered threshold it filters with later
+        min_similarity = threshold * 0.7 if mode == "fusion" else threshold
 
-        # Initialize results dictionary
+        for start in range(0, len(queries), batch_size):
+            batch = queries[start:start + batch_size]
+
+            # BM25 needs no embeddings at all
+            if mode == "bm25":
+                all_results.extend(self._rank_bm25(query, top_k) for query in batch)
+                continue
+
+            # Embed the whole batch at once and search all rows together
+            query_embeddings = self.prepare_queries(self.generate_embeddings(batch, batch_size=batch_size))
+            distances, indices = self.search_index(query_embeddings, search_k, min_similarity)
+
+            for row, query in enumerate(batch):
+                args = (query, query_embeddings[row], distances[row], indices[row], top_k, threshold)
+                if mode == "vector":
+                    all_results.append(self._rank_vector(*args))
+                elif mode == "hybrid":
+                    all_results.append(self._rank_hybrid(*args))
+                else:
+                    all_results.append(self._rank_fusion(*args))
+
+        return all_results
+
+    def _make_result(self, idx, vector_similarity, keyword_match=0, combined_score=None, **scores):
+        """Build a result dict for a document position."""
+        result = {
+            'metadata': self.metadata[idx],
+            'document': self.documents[idx],
+            'vector_similarity': vector_similarity,
+            'keyword_match': keyword_match,
+            'combined_score': vector_similarity if combined_score is None else combined_score
+        }
+        result.update(scores)
+        return result
+
+    def _vector_results(self, distances, indices, threshold):
+        """Turn one row of index search output into result dicts keyed by document position."""
         results_dict = {}
 
-        # Process vector search results
-        for i in range(len(indices[0])):
-            idx = indices[0][i]
-            distance = distances[0][i]
+        for i in range(len(indices)):
+            idx = indices[i]
+            distance = distances[i]
+
+            # FAISS pads missing neighbours with -1
+            if idx < 0:
+                continue
 
-            # Better similarity calculation from L2 distance
-            similarity = np.exp(-distance / 10.0)
+            # Cosine score, or a similarity derived from the L2 distance
+            similarity = self.similarity(distance)
 
             # Skip results below threshold
             if similarity < threshold:
                 continue
 
             # Add to results dictionary with vector score
-            results_dict[idx] = {
-                'metadata': self.metadata[idx],
-                'document': self.documents[idx],
-                'vector_similarity': similarity,
-                'keyword_match': 0,
-                'combined_score': similarity
-            }
-
-        # Keyword search boost
-        for keyword in self.keyword_index:
-            if keyword in clean_query:
-                for idx in self.keyword_index[keyword]:
-                    # If already in results, boost the score
-                    if idx in results_dict:
-                        results_dict[idx]['keyword_match'] += 0.1  # Keyword match bonus
-                        results_dict[idx]['combined_score'] += 0.1
-                    # If not in results, add it if it meets a lower threshold
-                    elif len(results_dict) < top_k * 2:  # Allow some extra candidates
-                        # Get the vector similarity
-                        query_embedding_reshaped = np.reshape(query_embedding, (1, -1))
-                        document_vector = self.index.reconstruct(idx)
-                        document_vector_reshaped = np.reshape(document_vector, (1, -1))
-
-                        # Calculate L2 distance
-                        distance = np.linalg.norm(query_embedding_reshaped - document_vector_reshaped)
-                        similarity = np.exp(-distance / 10.0)
-
-                        # Add with keyword boost if it meets a lower threshold
-                        if similarity > threshold * 0.7:  # Lower threshold for keyword matches
-                            results_dict[idx] = {
-                                'metadata': self.metadata[idx],
-                                'document': self.documents[idx],
-                                'vector_similarity': similarity,
-                                'keyword_match': 0.1,  # Initial keyword match bonus
-                                'combined_score': similarity + 0.1
-                            }
+            results_dict[int(idx)] = self._make_result(idx, similarity)
+
+        return results_dict
+
+    def _vector_similarities(self, query_embedding, doc_ids):
+        """Vector similarity of a query to a set of documents, with one dot product."""
+        query_vector = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        if self.metric == "cosine":
+            return self.vectors[doc_ids] @ query_vector
+
+        distances = (self.norms[doc_ids] + query_vector @ query_vector
+                     - 2.0 * (self.vectors[doc_ids] @ query_vector))
+        return self.similarity(np.maximum(distances, 0.0))
+
+    def _rank_vector(self, query, query_embedding, distances, indices, top_k, threshold):
+        """Rank one row of vector search output on its own."""
+        results_dict = self._vector_results(distances, indices, threshold)
+        results = sorted(results_dict.values(), key=lambda x: x['combined_score'], reverse=True)
+        return results[:top_k]
+
+    def _rank_hybrid(self, query, query_embedding, distances, indices, top_k, threshold):
+        """Combine one row of vector search output with the keyword boost."""
+        # Clean the query
+        clean_query = self.clean_text(query.lower())
+
+        # Initialize results dictionary
+        results_dict = self._vector_results(distances, indices, threshold)
+
+        # Keyword candidates come straight from the posting lists
+        candidate_ids, hits = self.keyword_index.match(clean_query)
+        if len(candidate_ids):
+            # Re-score all candidates with one dot product against their stored vectors
+            candidate_similarities = self._vector_similarities(query_embedding, candidate_ids)
+            boosts = 0.1 * hits  # Keyword match bonus per matched query term
+
+            # Candidates outside the vector results, best first
+            extra_candidates = []
+            for idx, similarity, boost in zip(candidate_ids.tolist(), candidate_similarities.tolist(),
+                                              boosts.tolist()):
+                # If already in results, boost the score
+                if idx in results_dict:
+                    results_dict[idx]['keyword_match'] += boost
+                    results_dict[idx]['combined_score'] += boost
+                # Otherwise keep it if it meets a lower threshold
+                elif similarity > threshold * 0.7:
+                    extra_candidates.append((similarity + boost, idx, similarity, boost))
+
+            extra_candidates.sort(reverse=True)
+            for combined_score, idx, similarity, boost in extra_candidates:
+                if len(results_dict) >= top_k * 2:  # Allow some extra candidates
+                    break
+                results_dict[idx] = self._make_result(idx, similarity, boost, combined_score)
 
         # Sort by combined score and convert to list
         results = sorted(results_dict.values(), key=lambda x: x['combined_score'], reverse=True)
 
         return results[:top_k]  # Return the top k results
 
+    def _rank_bm25(self, query, top_k):
+        """Rank documents by BM25 alone."""
+        clean_query = self.clean_text(query.lower())
+        doc_ids, scores = self.keyword_index.bm25(clean_query)
+        if not len(doc_ids):
+            return []
+
+        # Scale scores to [0, 1) by the best score the query terms could reach
+        max_score = self.keyword_index.max_bm25(clean_query)
+
+        top = np.argsort(-scores, kind="stable")[:top_k]
+        return [
+            self._make_result(idx, 0.0, combined_score=score / max_score, bm25_score=score)
+            for idx, score in zip(doc_ids[top].tolist(), scores[top].tolist())
+        ]
+
+    def _rank_fusion(self, query, query_embedding, distances, indices, top_k, threshold):
+        """Fuse the vector and BM25 rankings with reciprocal-rank fusion."""
+        clean_query = self.clean_text(query.lower())
+
+        # Vector ranking: the index search row, already sorted by distance
+        vector_ids = np.asarray(indices)[np.asarray(indices) >= 0].astype(np.int64)
+
+        # BM25 ranking over the same depth
+        bm25_ids, bm25_scores = self.keyword_index.bm25(clean_query)
+        bm25_order = np.argsort(-bm25_scores, kind="stable")[:self.fusion_depth]
+        bm25_ids = bm25_ids[bm25_order]
+
+        # RRF score: sum of 1 / (k + rank) over the rankings a document appears in
+        candidate_ids = np.concatenate([vector_ids, bm25_ids])
+        rrf_contributions = np.concatenate([
+            1.0 / (self.rrf_k + np.arange(1, len(vector_ids) + 1)),
+            1.0 / (self.rrf_k + np.arange(1, len(bm25_ids) + 1)),
+        ])
+        if not len(candidate_ids):
+            return []
+        candidate_ids, inverse = np.unique(candidate_ids, return_inverse=True)
+        rrf_scores = np.bincount(inverse, weights=rrf_contributions)
+
+        # Similarities keep the answer thresholds and confidence meaningful
+        similarities = self._vector_similarities(query_embedding, candidate_ids)
+        keep = similarities >= threshold * 0.7
+        candidate_ids, rrf_scores, similarities = candidate_ids[keep], rrf_scores[keep], similarities[keep]
+
+        top = np.argsort(-rrf_scores, kind="stable")[:top_k]
+        return [
+            self._make_result(idx, similarity, rrf_score=rrf_score)
+            for idx, similarity, rrf_score in zip(candidate_ids[top].tolist(), similarities[top].tolist(),
+                                                  rrf_scores[top].tolist())
+        ]
+
     def format_response(self, result):
         """Format the response with answer, media, and links."""
         metadata = result['metadata']
@@ -183,11 +371,19 @@ class Agent3DMax:
 
         return "\n\n".join(response)
 
-    def answer_question(self, query, threshold=0.15):
+    def answer_question(self, query, threshold=None):
         """Answer a question about 3D Max."""
-        # Hybrid search for relevant Q&A pairs
-        results = self.hybrid_search(query, top_k=3, threshold=threshold)
+        # Search for relevant Q&A pairs with the selected search mode
+        results = self.search(query, top_k=3, threshold=threshold)
+        return self.compose_answer(results)
+
+    def answer_questions(self, queries, threshold=None, batch_size=64):
+        """Answer many questions about 3D Max, embedding and searching them in batches."""
+        all_results = self.search_many(queries, top_k=3, threshold=threshold, batch_size=batch_size)
+        return [self.compose_answer(results) for results in all_results]
 
+    def compose_answer(self, results):
+        """Build the answer text from search results."""
         if not results:
             return (
                 "Извините, я не нашел ответ на ваш вопрос в документации. "
@@ -198,7 +394,7 @@ class Agent3DMax:
         best_match = results[0]
 
         # Check if it's a good match or a tentative match
-        if best_match['combined_score'] > 0.4:  # Adjusted threshold for "good" match
+        if best_match['combined_score'] > self.good_threshold:
             return self.format_response(best_match)
         else:
             # It's a tentative match
@@ -209,8 +405,19 @@ class Agent3DMax:
 
 
 def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="3D Max Assistant")
+    parser.add_argument("--db", type=str, default="vector_db",
+                        help="Path to the vector database")
+    parser.add_argument("--mode", type=str, default="hybrid", choices=SEARCH_MODES,
+                        help="Search mode used to find answers")
+    parser.add_argument("--cache", type=str, default=None,
+                        help="sqlite file that keeps query embeddings across restarts")
+    args = parser.parse_args()
+
     # Initialize the agent
-    agent = Agent3DMax()
+    agent = Agent3DMax(vector_db_path=args.db, search_mode=args.mode, cache_path=args.cache)
 
     print("\n=== 3D Max Assistant ===")
     print("Задайте вопрос о 3D Max или введите 'выход' для завершения.")
@@ -221,6 +428,7 @@ def main():
 
         # Check for exit command
         if query.lower() in ["выход", "exit", "quit", "q"]:
+            agent.embedding_cache.close()
             print("До свидания!")
             break
 
@@ -0,0 +1,235 @@
+"""
+Token-level inverted index for the 3D Max hybrid and BM25 search.
+
+Documents are tokenized into lowercase Russian/English words, reduced with a
+light suffix-stripping stemmer and mapped to posting lists of document ids.
+The index is built once by create_vector_db.py and stored next to the
+memory-mapped store (see mmap_store.py):
+    keywords.bin / keywords.offsets.npy   - string table of indexed terms
+    keywords.postings_offsets.npy         - int64 start of every term's postings
+    keywords.postings.npy                 - int32 document ids, grouped by term
+    keywords.tfs.npy                      - int32 term frequency of every posting
+    keywords.idf.npy                      - float32 BM25 IDF of every term
+    keywords.doc_lengths.npy              - int32 number of terms in every document
+"""
+import html
+import os
+import re
+from array import array
+
+import numpy as np
+
+from mmap_store import StringTable, save_array, write_string_table
+
+TOKEN_PATTERN = re.compile(r"[a-zа-яё0-9]+")
+
+# Words that carry no meaning for matching (every document starts with "Вопрос:" and "Ответ:")
+STOP_WORDS = {
+    "вопрос", "ответ", "как", "что", "где", "когда", "почему", "зачем", "каким", "какой",
+    "в", "во", "на", "и", "или", "с", "со", "по", "для", "из", "от", "до", "к", "у", "о", "об",
+    "не", "ли", "же", "это", "то", "а", "но", "при", "за", "под", "над", "все", "его", "её",
+    "the", "a", "an", "and", "or", "of", "to", "in", "on", "for", "with", "is", "how", "what",
+}
+
+# Endings stripped by the stemmer, longest first
+RUSSIAN_SUFFIXES = sorted([
+    "ами", "ями", "ого", "его", "ому", "ему", "ыми", "ими", "ией", "иях", "ость", "ости",
+    "ать", "ять", "ить", "еть", "ует", "уют", "ают", "яют", "ешь", "ишь", "ет", "ит",
+    "ой", "ей", "ий", "ый", "ая", "яя", "ое", "ее", "ые", "ие", "ую", "юю",
+    "ом", "ем", "ам", "ям", "ах", "ях", "ов", "ев", "ию", "ия",
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+], key=len, reverse=True)
+ENGLISH_SUFFIXES = ["ings", "ing", "ies", "ed", "es", "ly", "s"]
+
+MIN_STEM_LENGTH = 3
+
+
+def stem(token):
+    """Strip a common Russian or English ending from a lowercase token."""
+    if token.isascii():
+        suffixes = ENGLISH_SUFFIXES
+    else:
+        token = token.replace("ё", "е")
+        # Reflexive verbs: "сохраняется" -> "сохраняет"
+        if token.endswith(("ся", "сь")) and len(token) - 2 >= MIN_STEM_LENGTH:
+            token = token[:-2]
+        suffixes = RUSSIAN_SUFFIXES
+
+    for suffix in suffixes:
+        if token.endswith(suffix) and len(token) - len(suffix) >= MIN_STEM_LENGTH:
+            return token[:-len(suffix)]
+    return token
+
+
+def tokenize(text):
+    """Split text into stemmed terms, dropping HTML tags and stop words."""
+    text = html.unescape(re.sub(r'<[^>]+>', ' ', text)).lower()
+    return [stem(token) for token in TOKEN_PATTERN.findall(text) if token not in STOP_WORDS]
+
+
+def build_keyword_index(documents, max_df=0.5):
+    """
+    Build an inverted index from a list of document texts.
+
+    Terms found in more than max_df of the documents are left out, they would
+    boost nearly every candidate and carry almost no BM25 weight.
+
+    Returns:
+        (terms, postings_offsets, postings, tfs, idf, doc_lengths) with terms
+        sorted alphabetically
+    """
+    # One (term id, doc id, count) triple per distinct term of a document, in
+    # compact arrays rather than per-term Python lists
+    vocabulary = {}
+    term_ids = array("i")
+    doc_ids = array("i")
+    counts = array("i")
+    doc_lengths = np.zeros(len(documents), dtype=np.int32)
+    for doc_id, doc in enumerate(documents):
+        tokens = tokenize(doc)
+        doc_lengths[doc_id] = len(tokens)
+
+        term_counts = {}
+        for term in tokens:
+            term_counts[term] = term_counts.get(term, 0) + 1
+        for term, count in term_counts.items():
+            term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+            doc_ids.append(doc_id)
+            counts.append(count)
+
+    term_ids = np.frombuffer(term_ids, dtype=np.int32)
+    doc_ids = np.frombuffer(doc_ids, dtype=np.int32)
+    counts = np.frombuffer(counts, dtype=np.int32)
+
+    max_docs = max(1, int(max_df * len(documents)))
+    doc_freqs = np.bincount(term_ids, minlength=len(vocabulary))
+    terms = sorted(term for term, term_id in vocabulary.items() if doc_freqs[term_id] <= max_docs)
+
+    # Position of every kept term in the sorted term list, -1 for dropped terms
+    positions = np.full(len(vocabulary), -1, dtype=np.int64)
+    positions[[vocabulary[term] for term in terms]] = np.arange(len(terms))
+    term_positions = positions[term_ids]
+    kept = term_positions >= 0
+
+    # Group the postings by term; documents were added in order, a stable sort keeps them sorted
+    order = np.argsort(term_positions[kept], kind="stable")
+    postings = doc_ids[kept][order]
+    tfs = counts[kept][order]
+
+    postings_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(term_positions[kept], minlength=len(terms)), out=postings_offsets[1:])
+
+    # BM25 IDF, the "+1" variant that never goes negative
+    doc_freqs = np.diff(postings_offsets).astype(np.float64)
+    idf = np.log(1.0 + (len(documents) - doc_freqs + 0.5) / (doc_freqs + 0.5)).astype(np.float32)
+
+    return terms, postings_offsets, postings, tfs, idf, doc_lengths
+
+
+def write_keyword_index(documents, output_dir="vector_db"):
+    """Build the inverted index for documents and save it to output_dir."""
+    terms, postings_offsets, postings, tfs, idf, doc_lengths = build_keyword_index(documents)
+
+    write_string_table(terms, output_dir, "keywords")
+    save_array(postings_offsets, os.path.join(output_dir, "keywords.postings_offsets.npy"))
+    save_array(postings, os.path.join(output_dir, "keywords.postings.npy"))
+    save_array(tfs, os.path.join(output_dir, "keywords.tfs.npy"))
+    save_array(idf, os.path.join(output_dir, "keywords.idf.npy"))
+    save_array(doc_lengths, os.path.join(output_dir, "keywords.doc_lengths.npy"))
+    print(f"Saved keyword index with {len(terms)} terms to {output_dir}")
+
+
+class KeywordIndex:
+    """Term -> posting list lookups and BM25 scoring over an inverted index."""
+
+    def __init__(self, terms, postings_offsets, postings, tfs, idf, doc_lengths, k1=1.5, b=0.75):
+        self.term_ids = {term: i for i, term in enumerate(terms)}
+        self.postings_offsets = postings_offsets
+        self.postings = postings
+        self.tfs = tfs
+        self.idf = idf
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+
+        # Per-document part of the BM25 denominator, computed once
+        avg_length = max(float(np.mean(doc_lengths)), 1.0) if len(doc_lengths) else 1.0
+        self.length_norms = (k1 * (1.0 - b + b * np.asarray(doc_lengths) / avg_length)).astype(np.float32)
+
+    def __len__(self):
+        return len(self.term_ids)
+
+    def postings_for(self, term):
+        """Return the document ids containing a term (empty if unknown)."""
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            return self.postings[:0]
+        return self.postings[self.postings_offsets[term_id]:self.postings_offsets[term_id + 1]]
+
+    def match(self, text):
+        """
+        Find documents sharing terms with a text.
+
+        Returns:
+            (doc_ids, hits): candidate document ids and the number of distinct
+            query terms each of them contains
+        """
+        lists = [self.postings_for(term) for term in set(tokenize(text))]
+        lists = [postings for postings in lists if len(postings)]
+        if not lists:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        doc_ids, hits = np.unique(np.concatenate(lists), return_counts=True)
+        return doc_ids.astype(np.int64), hits
+
+    def _query_term_ids(self, text):
+        """Ids of the distinct indexed terms of a text."""
+        term_ids = (self.term_ids.get(term) for term in set(tokenize(text)))
+        return np.array(sorted(term_id for term_id in term_ids if term_id is not None), dtype=np.int64)
+
+    def bm25(self, text):
+        """
+        Score documents against a text with BM25 in one pass over the query's posting lists.
+
+        Returns:
+            (doc_ids, scores) for every document containing at least one query term
+        """
+        term_ids = self._query_term_ids(text)
+        if not len(term_ids):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        starts = np.asarray(self.postings_offsets[term_ids])
+        ends = np.asarray(self.postings_offsets[term_ids + 1])
+
+        # Flat positions of all postings of the query terms
+        lengths = ends - starts
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+        doc_ids = np.asarray(self.postings[positions], dtype=np.int64)
+        tfs = np.asarray(self.tfs[positions], dtype=np.float32)
+        idf = np.repeat(np.asarray(self.idf[term_ids]), lengths)
+
+        contributions = idf * tfs * (self.k1 + 1.0) / (tfs + self.length_norms[doc_ids])
+        doc_ids, inverse = np.unique(doc_ids, return_inverse=True)
+        return doc_ids, np.bincount(inverse, weights=contributions).astype(np.float32)
+
+    def max_bm25(self, text):
+        """Upper bound of the BM25 score a document can reach for a text."""
+        term_ids = self._query_term_ids(text)
+        return float(np.sum(np.asarray(self.idf[term_ids]))) * (self.k1 + 1.0)
+
+
+def keyword_index_exists(store_dir):
+    """Check whether a directory contains a saved keyword index."""
+    return os.path.exists(os.path.join(store_dir, "keywords.doc_lengths.npy"))
+
+
+def open_keyword_index(store_dir):
+    """Open a keyword index saved by write_keyword_index, mapping its arrays read-only."""
+    terms = StringTable(store_dir, "keywords")
+    postings_offsets = np.load(os.path.join(store_dir, "keywords.postings_offsets.npy"), mmap_mode="r")
+    postings = np.load(os.path.join(store_dir, "keywords.postings.npy"), mmap_mode="r")
+    tfs = np.load(os.path.join(store_dir, "keywords.tfs.npy"), mmap_mode="r")
+    idf = np.load(os.path.join(store_dir, "keywords.idf.npy"), mmap_mode="r")
+    doc_lengths = np.load(os.path.join(store_dir, "keywords.doc_lengths.npy"), mmap_mode="r")
+    return KeywordIndex(terms, postings_offsets, postings, tfs, idf, doc_lengths)
@@ -0,0 +1,410 @@
+"""
+Memory-mapped vector store for the 3D Max agents.
+
+The store is written once by create_vector_db.py and opened read-only by the
+agents. Nothing is unpickled at startup: vectors and strings are mapped from
+disk, so several worker processes share the same pages through the OS page cache.
+
+Store layout (inside the vector database directory):
+    store.json              - format version, number of vectors, dimension and index settings
+    vectors.npy             - float32 matrix (N x D)
+    norms.npy               - float32 squared L2 norm of every vector
+    documents.bin           - UTF-8 document texts, concatenated
+    documents.offsets.npy   - int64 offsets into documents.bin (N + 1 values)
+    metadata.bin            - JSON encoded metadata dicts, concatenated
+    metadata.offsets.npy    - int64 offsets into metadata.bin (N + 1 values)
+    labels.npy              - int64 FAISS label of every row (optional)
+
+store.json also records the metric: "l2" stores keep raw vectors, "cosine"
+stores keep normalized vectors searched by inner product, together with
+score histograms used to calibrate similarity thresholds.
+
+Flat stores are searched directly over vectors.npy. Approximate indexes
+(IVF-PQ, HNSW) are read from faiss_index.bin with FAISS's own mmap support.
+After incremental rebuilds their labels no longer match row positions, so
+search results are translated back to rows through labels.npy.
+"""
+import json
+import mmap
+import os
+
+import faiss
+import numpy as np
+
+STORE_VERSION = 1
+MANIFEST_FILE = "store.json"
+
+
+def _replace_atomically(write, path):
+    """Write a file through a temporary path and move it into place."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def save_array(array, path):
+    """Save a numpy array as .npy without ever exposing a half-written file."""
+    _replace_atomically(lambda f: np.save(f, array), path)
+
+
+class StringTableWriter:
+    """
+    Appends strings to a string table one at a time.
+
+    Only the offsets are kept in memory, the UTF-8 blob goes straight to disk.
+    Both files appear under their final names when the writer is closed.
+    """
+
+    def __init__(self, output_dir, name):
+        self.blob_path = os.path.join(output_dir, f"{name}.bin")
+        self.offsets_path = os.path.join(output_dir, f"{name}.offsets.npy")
+        self._file = open(self.blob_path + ".tmp", "wb")
+        self._offsets = [0]
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def append(self, text):
+        data = text.encode("utf-8")
+        self._file.write(data)
+        self._offsets.append(self._offsets[-1] + len(data))
+
+    def close(self):
+        self._file.close()
+        os.replace(self.blob_path + ".tmp", self.blob_path)
+        save_array(np.array(self._offsets, dtype=np.int64), self.offsets_path)
+
+
+def write_string_table(strings, output_dir, name):
+    """Write an iterable of strings as one UTF-8 blob plus an int64 offsets array."""
+    writer = StringTableWriter(output_dir, name)
+    for text in strings:
+        writer.append(text)
+    writer.close()
+
+
+def encode_metadata(meta):
+    """JSON text of a metadata dict as stored in the metadata table."""
+    return json.dumps(meta, ensure_ascii=False)
+
+
+def squared_norms(vectors, batch_size=65536):
+    """Squared L2 norm of every row, computed a batch at a time for memmapped vectors."""
+    norms = np.empty(len(vectors), dtype=np.float32)
+    for start in range(0, len(vectors), batch_size):
+        batch = np.asarray(vectors[start:start + batch_size], dtype=np.float32)
+        norms[start:start + len(batch)] = np.einsum("ij,ij->i", batch, batch)
+    return norms
+
+
+def write_manifest(output_dir, count, dimension, index_info=None, metric="l2", calibration=None):
+    """
+    Write store.json, which marks the store as complete.
+
+    It has to be written last, so a half-written store is never picked up.
+    """
+    manifest = {
+        "version": STORE_VERSION,
+        "count": int(count),
+        "dimension": int(dimension),
+        "index": index_info or {"type": "flat"},
+        "metric": metric,
+    }
+    if calibration is not None:
+        manifest["calibration"] = calibration
+    _replace_atomically(lambda f: f.write(json.dumps(manifest, indent=2).encode("utf-8")),
+                        os.path.join(output_dir, MANIFEST_FILE))
+    print(f"Saved memory-mapped store with {manifest['count']} vectors to {output_dir}")
+
+
+def write_store(embeddings, documents, metadata, output_dir="vector_db", index_info=None, labels=None,
+                metric="l2", calibration=None):
+    """
+    Save vectors, documents and metadata in the memory-mapped store format.
+
+    index_info describes the FAISS index saved alongside, e.g.
+    {"type": "ivfpq", "params": {"nprobe": 16}}. Defaults to exact flat search.
+    labels are the ids of the rows in that index, if they differ from positions.
+    metric is "l2" or "cosine" (vectors normalized, inner-product index), and
+    calibration holds the score histograms thresholds are derived from.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    vectors = np.ascontiguousarray(embeddings, dtype=np.float32)
+
+    save_array(vectors, os.path.join(output_dir, "vectors.npy"))
+    save_array(squared_norms(vectors), os.path.join(output_dir, "norms.npy"))
+    if labels is not None:
+        save_array(np.asarray(labels, dtype=np.int64), os.path.join(output_dir, "labels.npy"))
+
+    write_string_table(documents, output_dir, "documents")
+    write_string_table((encode_metadata(meta) for meta in metadata), output_dir, "metadata")
+
+    # The manifest is written last, so a half-written store is never picked up
+    write_manifest(output_dir, vectors.shape[0], vectors.shape[1], index_info=index_info,
+                   metric=metric, calibration=calibration)
+
+
+class StringTable:
+    """Read-only, list-like view over a string table. Strings are decoded on access."""
+
+    def __init__(self, store_dir, name, decode=None):
+        self.offsets = np.load(os.path.join(store_dir, f"{name}.offsets.npy"), mmap_mode="r")
+        self._decode = decode
+
+        # mmap refuses to map empty files, so an empty table is kept as plain bytes
+        with open(os.path.join(store_dir, f"{name}.bin"), "rb") as f:
+            if int(self.offsets[-1]) > 0:
+                self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._buffer = b""
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+
+        idx = int(idx)
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("string table index out of range")
+
+        text = self._buffer[int(self.offsets[idx]):int(self.offsets[idx + 1])].decode("utf-8")
+        return self._decode(text) if self._decode else text
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self):
+        """Release the mapped file."""
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+        self._buffer = b""
+
+
+class MmapFlatIndex:
+    """
+    Exact search over memory-mapped vectors.
+
+    Mirrors the parts of the faiss.IndexFlatL2 / IndexFlatIP interface used by
+    the agents (ntotal, d, search, range_search, reconstruct). With metric "l2"
+    it returns the same squared distances as FAISS (smaller is better), with
+    "ip" inner products (larger is better).
+    """
+
+    def __init__(self, vectors, norms, metric="l2"):
+        self.vectors = vectors
+        self.norms = norms
+        self.metric = metric
+        self.ntotal, self.d = vectors.shape
+
+    def _scores(self, queries):
+        """Distances (l2) or inner products (ip) of every query row to every vector."""
+        scores = queries @ self.vectors.T
+        if self.metric == "ip":
+            return scores
+
+        # ||q - x||^2 = ||q||^2 + ||x||^2 - 2 q.x, one matrix product for the whole batch
+        scores *= -2.0
+        scores += self.norms[None, :]
+        scores += np.einsum("ij,ij->i", queries, queries)[:, None]
+        np.maximum(scores, 0.0, out=scores)
+        return scores
+
+    def search(self, queries, k):
+        """Return (distances, indices) for the k nearest vectors of every query row."""
+        queries = np.ascontiguousarray(queries, dtype=np.float32).reshape(-1, self.d)
+        n_queries = queries.shape[0]
+
+        # Pad like FAISS does when fewer than k vectors are stored
+        padding = np.inf if self.metric == "l2" else -np.inf
+        distances = np.full((n_queries, k), padding, dtype=np.float32)
+        indices = np.full((n_queries, k), -1, dtype=np.int64)
+        found = min(k, self.ntotal)
+        if found == 0:
+            return distances, indices
+
+        # Rank by ascending distance or by descending inner product
+        scores = self._scores(queries)
+        keys = scores if self.metric == "l2" else -scores
+
+        if found < self.ntotal:
+            top = np.argpartition(keys, found - 1, axis=1)[:, :found]
+        else:
+            top = np.broadcast_to(np.arange(self.ntotal), (n_queries, self.ntotal))
+        order = np.argsort(np.take_along_axis(keys, top, axis=1), axis=1, kind="stable")
+        top = np.take_along_axis(top, order, axis=1)
+
+        distances[:, :found] = np.take_along_axis(scores, top, axis=1)
+        indices[:, :found] = top
+        return distances, indices
+
+    def range_search(self, queries, radius):
+        """
+        Return FAISS-style (lims, distances, indices) of all vectors within radius.
+
+        For "l2" that is a distance below radius, for "ip" a score above it.
+        Results of query row i are at lims[i]:lims[i + 1].
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float32).reshape(-1, self.d)
+        scores = self._scores(queries)
+        within = scores < radius if self.metric == "l2" else scores > radius
+
+        rows, cols = np.nonzero(within)
+        lims = np.zeros(queries.shape[0] + 1, dtype=np.int64)
+        lims[1:] = np.cumsum(within.sum(axis=1))
+        return lims, scores[rows, cols], cols.astype(np.int64)
+
+    def reconstruct(self, idx):
+        """Return a copy of the stored vector at position idx."""
+        return np.array(self.vectors[int(idx)], dtype=np.float32)
+
+
+class LabelMappedIndex:
+    """Wraps a FAISS index whose ids are stable labels, returning store row positions instead."""
+
+    def __init__(self, index, labels, vectors):
+        self.index = index
+        self.vectors = vectors
+        self.ntotal = index.ntotal
+        self.d = index.d
+
+        # Sorted labels for binary-search lookups of their rows
+        self._rows = np.argsort(labels, kind="stable")
+        self._sorted_labels = np.asarray(labels)[self._rows]
+
+    def _to_rows(self, labels):
+        """Translate index labels to row positions (-1 stays -1)."""
+        positions = np.clip(np.searchsorted(self._sorted_labels, labels), 0, len(self._sorted_labels) - 1)
+        known = (labels >= 0) & (self._sorted_labels[positions] == labels)
+        return np.where(known, self._rows[positions], -1)
+
+    def search(self, queries, k):
+        """Return (distances, row positions) of the k nearest vectors of every query row."""
+        distances, labels = self.index.search(queries, k)
+        return distances, self._to_rows(labels)
+
+    def range_search(self, queries, radius):
+        """Return (lims, distances, row positions) of all vectors within radius."""
+        lims, distances, labels = self.index.range_search(queries, radius)
+        return lims, distances, self._to_rows(labels)
+
+    def reconstruct(self, idx):
+        """Return a copy of the stored vector at row position idx."""
+        return np.array(self.vectors[int(idx)], dtype=np.float32)
+
+
+class MmapStore:
+    """Vectors, documents and metadata of a store directory, mapped read-only."""
+
+    def __init__(self, store_dir):
+        with open(os.path.join(store_dir, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            self.manifest = json.load(f)
+
+        if self.manifest.get("version") != STORE_VERSION:
+            raise ValueError(f"Unsupported store version: {self.manifest.get('version')}")
+
+        self.vectors = np.load(os.path.join(store_dir, "vectors.npy"), mmap_mode="r")
+        self.norms = np.load(os.path.join(store_dir, "norms.npy"), mmap_mode="r")
+        self.documents = StringTable(store_dir, "documents")
+        self.metadata = StringTable(store_dir, "metadata", decode=json.loads)
+
+        # "cosine" stores hold normalized vectors, their scores are inner products
+        self.metric = self.manifest.get("metric", "l2")
+        self.calibration = self.manifest.get("calibration")
+
+        index_info = self.manifest.get("index", {"type": "flat"})
+        if index_info["type"] == "flat":
+            self.index = MmapFlatIndex(self.vectors, self.norms, "ip" if self.metric == "cosine" else "l2")
+        else:
+            self.index = faiss.read_index(os.path.join(store_dir, "faiss_index.bin"),
+                                          faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+
+            # Search parameters tuned by create_vector_db.py
+            parameter_space = faiss.ParameterSpace()
+            for name, value in index_info.get("params", {}).items():
+                parameter_space.set_index_parameter(self.index, name, value)
+
+            labels_path = os.path.join(store_dir, "labels.npy")
+            if os.path.exists(labels_path):
+                self.index = LabelMappedIndex(self.index, np.load(labels_path), self.vectors)
+
+    def close(self):
+        """Release the mapped files, e.g. before the store directory is replaced."""
+        self.documents.close()
+        self.metadata.close()
+        self.index = None
+        self.vectors = None
+        self.norms = None
+
+
+def range_search_top_k(index, queries, min_score, k):
+    """
+    Find the k best inner-product hits above min_score for every query row.
+
+    Low-similarity candidates are dropped inside the index by range_search.
+    The result is padded like index.search, so callers can treat both alike.
+    """
+    lims, scores, indices = index.range_search(np.ascontiguousarray(queries, dtype=np.float32), min_score)
+
+    n_queries = len(lims) - 1
+    top_scores = np.full((n_queries, k), -np.inf, dtype=np.float32)
+    top_indices = np.full((n_queries, k), -1, dtype=np.int64)
+    for row in range(n_queries):
+        row_scores = scores[lims[row]:lims[row + 1]]
+        order = np.argsort(-row_scores, kind="stable")[:k]
+        top_scores[row, :len(order)] = row_scores[order]
+        top_indices[row, :len(order)] = indices[lims[row]:lims[row + 1]][order]
+
+    return top_scores, top_indices
+
+
+def histogram_quantile(edges, counts, quantile):
+    """Score below which the given fraction of a histogram's mass lies."""
+    counts = np.asarray(counts, dtype=np.float64)
+    cumulative = np.concatenate([[0.0], np.cumsum(counts)]) / max(counts.sum(), 1.0)
+
+    # Interpolate linearly inside the bin where the quantile is crossed
+    return float(np.interp(quantile, cumulative, edges))
+
+
+# Similarity thresholds (result, good match) when a store has no calibration
+DEFAULT_THRESHOLDS = {"l2": (0.15, 0.4), "cosine": (0.3, 0.6)}
+
+# A result has to beat almost all unrelated pairs, a good match most of the weakest matching ones
+BACKGROUND_QUANTILE = 0.99
+MATCH_QUANTILE = 0.25
+# ...but the result threshold never drops more than this share of matching pairs
+MISSED_MATCH_QUANTILE = 0.05
+
+
+def similarity_thresholds(metric, calibration=None):
+    """
+    Return the (result, good match) similarity thresholds for a store.
+
+    Cosine stores with a calibration derive them from the score histograms of
+    unrelated and matching question/document pairs.
+    """
+    if metric != "cosine" or not calibration:
+        return DEFAULT_THRESHOLDS.get(metric, DEFAULT_THRESHOLDS["l2"])
+
+    edges = calibration["edges"]
+    threshold = min(histogram_quantile(edges, calibration["background_counts"], BACKGROUND_QUANTILE),
+                    histogram_quantile(edges, calibration["match_counts"], MISSED_MATCH_QUANTILE))
+    good_threshold = histogram_quantile(edges, calibration["match_counts"], MATCH_QUANTILE)
+    return threshold, max(threshold, good_threshold)
+
+
+def store_exists(store_dir):
+    """Check whether a directory contains a memory-mapped store."""
+    return os.path.exists(os.path.join(store_dir, MANIFEST_FILE))
+
+
+def open_store(store_dir):
+    """Open a memory-mapped store written by write_store."""
+    return MmapStore(store_dir)
@@ -0,0 +1,127 @@
+import json
+import sys
+import zlib
+
+import numpy as np
+import pytest
+
+pytest.importorskip("faiss")
+pytest.importorskip("sentence_transformers")
+
+import create_vector_db
+
+
+class CountingEngine:
+    """Stands in for EmbeddingEngine: deterministic vectors, counts the texts it embeds."""
+
+    embedded = 0
+
+    def __init__(self, dimension=32):
+        self.dimension = dimension
+
+    def get_embeddings(self, texts, num_texts=None, out=None, **kwargs):
+        texts = list(texts)
+        CountingEngine.embedded += len(texts)
+
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            rng = np.random.default_rng(zlib.crc32(text.encode("utf-8")))
+            vectors[row] = rng.standard_normal(self.dimension)
+        if out is not None:
+            out[:] = vectors
+            return out
+        return vectors
+
+
+def write_qa_data(path, num_pairs):
+    qa_data = [
+        {"id": i, "question": f"Вопрос номер {i}?", "answer": f"Ответ на вопрос {i}.",
+         "media": [], "links": []}
+        for i in range(num_pairs)
+    ]
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(qa_data, f, ensure_ascii=False)
+
+
+def build(monkeypatch, input_file, output_dir, *extra_args):
+    monkeypatch.setattr(create_vector_db, "EmbeddingEngine", CountingEngine)
+    monkeypatch.setattr(sys, "argv", ["create_vector_db.py", "--input", str(input_file),
+                                      "--output", str(output_dir), "--eval-queries", "20", *extra_args])
+    CountingEngine.embedded = 0
+    create_vector_db.main()
+    return CountingEngine.embedded
+
+
+def test_rebuild_with_int_ids_embeds_nothing(tmp_path, monkeypatch, capsys):
+    """Int ids come back from the JSON manifest as strings and must still match."""
+    input_file = tmp_path / "qa_data.json"
+    output_dir = tmp_path / "vector_db"
+    write_qa_data(input_file, 400)
+
+    assert build(monkeypatch, input_file, output_dir) == 400
+    capsys.readouterr()
+
+    assert build(monkeypatch, input_file, output_dir) == 0
+    assert "400 unchanged, 0 new or changed, 0 removed Q&A pairs" in capsys.readouterr().out
+
+    with open(output_dir / create_vector_db.HASHES_FILE, encoding="utf-8") as f:
+        labels = [item["label"] for item in json.load(f)["items"].values()]
+    assert sorted(labels) == list(range(400))
+
+
+def test_rebuild_with_int_ids_embeds_only_changes(tmp_path, monkeypatch, capsys):
+    input_file = tmp_path / "qa_data.json"
+    output_dir = tmp_path / "vector_db"
+    write_qa_data(input_file, 400)
+    build(monkeypatch, input_file, output_dir)
+
+    with open(input_file, encoding="utf-8") as f:
+        qa_data = json.load(f)
+    qa_data[7]["answer"] = "Новый ответ."
+    del qa_data[0]
+    with open(input_file, "w", encoding="utf-8") as f:
+        json.dump(qa_data, f, ensure_ascii=False)
+    capsys.readouterr()
+
+    assert build(monkeypatch, input_file, output_dir) == 1
+    assert "398 unchanged, 1 new or changed, 1 removed Q&A pairs" in capsys.readouterr().out
+
+
+def test_tune_index_flat_baseline_with_labels():
+    """The exact baseline is exact whatever labels the approximate index uses."""
+    rng = np.random.default_rng(0)
+    embeddings = rng.standard_normal((500, 16)).astype(np.float32)
+    queries = embeddings[:50] + 0.01
+    labels = rng.permutation(500).astype(np.int64) + 1000
+
+    index = create_vector_db.create_faiss_index(embeddings, "hnsw", labels)
+    _, report = create_vector_db.tune_index(index, embeddings, queries, k=3, labels=labels)
+
+    assert report[0]["index"] == "flat"
+    assert report[0]["recall"] == 1.0
+    assert max(row["recall"] for row in report[1:]) > 0.9
+
+
+@pytest.mark.parametrize("index_type", ["flat", "hnsw", "ivfpq"])
+def test_build_writes_only_the_mapped_store(tmp_path, monkeypatch, index_type):
+    from mmap_store import open_store
+
+    input_file = tmp_path / "qa_data.json"
+    output_dir = tmp_path / "vector_db"
+    write_qa_data(input_file, 400)
+    build(monkeypatch, input_file, output_dir, "--index", index_type, "--metric", "cosine")
+    assert build(monkeypatch, input_file, output_dir, "--index", index_type, "--metric", "cosine") == 0
+
+    files = set(path.name for path in output_dir.iterdir())
+    assert not files & {"documents.pkl", "metadata.pkl", "embeddings.build.npy"}
+    assert ("faiss_index.bin" in files) == (index_type != "flat")
+
+    store = open_store(str(output_dir))
+    assert len(store.documents) == 400
+    assert store.metadata[5]["id"] == 5
+    engine = CountingEngine()
+    queries = engine.get_embeddings([store.documents[5]])
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    _, rows = store.index.search(queries, 1)
+    assert rows[0, 0] == 5
+    store.close()
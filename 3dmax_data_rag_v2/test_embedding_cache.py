@@ -0,0 +1,62 @@
+import sqlite3
+
+import numpy as np
+
+from embedding_cache import EmbeddingCache
+
+
+class CountingEncoder:
+    """Encodes every text as a vector of its length times a model factor, counting the texts."""
+
+    def __init__(self, factor):
+        self.factor = factor
+        self.encoded = []
+
+    def __call__(self, texts):
+        self.encoded += texts
+        return np.array([[len(text) * self.factor, 1.0] for text in texts], dtype=np.float32)
+
+
+def test_spill_file_is_keyed_on_the_model(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    first = EmbeddingCache("model-a", path=path)
+    first.encode(["как", "что"], CountingEncoder(1.0))
+    first.close()
+
+    encoder = CountingEncoder(10.0)
+    second = EmbeddingCache("model-b", path=path)
+    vectors = second.encode(["как"], encoder)
+    second.close()
+    assert encoder.encoded == ["как"]
+    assert vectors[0, 0] == 30.0
+
+    # Both models' vectors are kept, each found by its own model
+    again = EmbeddingCache("model-a", path=path)
+    assert again.get("как")[0] == 3.0
+    again.close()
+
+
+def test_repeated_misses_are_encoded_and_counted_once():
+    cache = EmbeddingCache("model-a")
+    encoder = CountingEncoder(1.0)
+    vectors = cache.encode(["где", "как", "где", "где"], encoder)
+
+    assert encoder.encoded == ["где", "как"]
+    assert vectors.shape == (4, 2)
+    assert cache.stats()["misses"] == 2
+
+    cache.encode(["где", "где"], encoder)
+    assert cache.stats()["hits"] == 1
+
+
+def test_spill_file_without_model_is_dropped(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE embeddings (text TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)")
+    db.execute("INSERT INTO embeddings VALUES (?, ?, ?)", ("как", np.zeros(2, dtype=np.float32).tobytes(), 0.0))
+    db.commit()
+    db.close()
+
+    cache = EmbeddingCache("model-a", path=path)
+    assert cache.get("как") is None
+    cache.close()
@@ -0,0 +1,109 @@
+"""
+Semantic answer cache for the 3D Max RAG system.
+
+Most questions are paraphrases of the same Q&A items. An answer is reused when
+a new question retrieves exactly the same chunks and its embedding is close
+enough to a question that was already answered, so the paraphrase skips the
+LLM call. Entries expire after a TTL and the least recently used ones are
+evicted once the cache is full.
+"""
+import time
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+CachedAnswer = namedtuple("CachedAnswer", ["question", "embedding", "answer", "tokens", "created"])
+
+
+def normalize(embedding):
+    """Return an embedding as a unit-length float32 vector."""
+    vector = np.asarray(embedding, dtype=np.float32)
+    return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+
+class SemanticAnswerCache:
+    """Answers keyed on the retrieved chunk IDs and matched by question similarity."""
+
+    def __init__(self, max_size=512, ttl=24 * 3600, threshold=0.92):
+        """
+        Args:
+            max_size: Answers kept before the least recently used one is evicted
+            ttl: Seconds an answer stays valid (no expiry if None)
+            threshold: Minimum cosine similarity between the questions
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+
+        # Context key -> answers for that context, the most recently used key last
+        self._entries = OrderedDict()
+        self._size = 0
+
+        # Counters for monitoring the hit rate
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+
+    def __len__(self):
+        return self._size
+
+    @staticmethod
+    def context_key(chunk_ids):
+        """Key of a retrieved context, independent of the retrieval order."""
+        return tuple(sorted(chunk_ids))
+
+    def _expired(self, entry, now):
+        return self.ttl is not None and now - entry.created > self.ttl
+
+    def get(self, chunk_ids, embedding):
+        """Return the cached answer for a question and its context, or None."""
+        key = self.context_key(chunk_ids)
+        entries = self._entries.get(key)
+        if entries:
+            # Drop expired answers for this context first
+            now = time.time()
+            live = [entry for entry in entries if not self._expired(entry, now)]
+            self._size -= len(entries) - len(live)
+            entries[:] = live
+
+            if live:
+                query = normalize(embedding)
+                similarities = np.stack([entry.embedding for entry in live]) @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    self.saved_tokens += live[best].tokens
+                    return live[best].answer
+            else:
+                del self._entries[key]
+
+        self.misses += 1
+        return None
+
+    def put(self, chunk_ids, embedding, question, answer, tokens=0):
+        """Store the answer to a question along with its context and token cost."""
+        key = self.context_key(chunk_ids)
+        entries = self._entries.setdefault(key, [])
+        entries.append(CachedAnswer(question, normalize(embedding), answer, tokens, time.time()))
+        self._entries.move_to_end(key)
+        self._size += 1
+
+        # Evict the oldest answers of the least recently used contexts
+        while self._size > self.max_size:
+            oldest_key, oldest_entries = next(iter(self._entries.items()))
+            oldest_entries.pop(0)
+            self._size -= 1
+            if not oldest_entries:
+                del self._entries[oldest_key]
+
+    def stats(self):
+        """Return the cache counters."""
+        lookups = self.hits + self.misses
+        return {
+            "size": self._size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "saved_tokens": self.saved_tokens,
+        }
@@ -0,0 +1,229 @@
+"""
+Caching embedding wrapper for the 3D Max RAG system.
+
+Chunk and query embeddings are stored in a local sqlite file keyed by
+(model, input kind, SHA-256 of the text), so rebuilding the vector database
+only pays the provider for texts it has never seen. Misses are sent in batches
+of the provider's maximum size, several batches at a time, under a
+requests-per-minute limit.
+"""
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# Cohere accepts at most 96 texts per embed request
+PROVIDER_MAX_BATCH_SIZE = 96
+
+# sqlite limits the number of bound parameters per statement
+LOOKUP_BATCH_SIZE = 500
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def text_hash(text):
+    """SHA-256 hex digest of a text, the cache key next to the model name."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class RateLimiter:
+    """Spaces out provider requests so at most requests_per_minute start per minute."""
+
+    def __init__(self, requests_per_minute=None):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next request may start."""
+        if not self.interval:
+            return
+
+        # Reserve a slot under the lock, sleep outside it
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    LangChain embeddings that put a sqlite cache in front of another embeddings object.
+
+    Documents and queries are cached separately, since providers like Cohere
+    embed them with different input types.
+    """
+
+    def __init__(self, embeddings, path="./embedding_cache.sqlite", model=None,
+                 batch_size=PROVIDER_MAX_BATCH_SIZE, max_concurrency=4, requests_per_minute=100):
+        """
+        Args:
+            embeddings: The wrapped embeddings (e.g. CohereEmbeddings)
+            path: sqlite file holding the cached vectors
+            model: Model name for the cache key, taken from embeddings.model if None
+            batch_size: Texts per provider request
+            max_concurrency: Provider requests in flight at once
+            requests_per_minute: Provider request limit (unlimited if None)
+        """
+        self.embeddings = embeddings
+        self.path = path
+        self.model = model or getattr(embeddings, "model", None) or type(embeddings).__name__
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.rate_limiter = RateLimiter(requests_per_minute)
+
+        # Counters for monitoring the hit rate, each distinct text of a call
+        # is one lookup; updated from executor threads, so under a lock
+        self.hits = 0
+        self.misses = 0
+        self.requests = 0
+        self._counter_lock = threading.Lock()
+
+        # Async retrievers embed queries from executor threads, so the
+        # connection is shared and guarded by a lock; workers only call the provider
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db_lock = threading.Lock()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(model TEXT NOT NULL, kind TEXT NOT NULL, text_hash TEXT NOT NULL, vector BLOB NOT NULL, "
+            "PRIMARY KEY (model, kind, text_hash))"
+        )
+        self._db.commit()
+
+    def _lookup(self, kind, hashes):
+        """Return {hash: vector} for the cached hashes."""
+        found = {}
+        with self._db_lock:
+            for start in range(0, len(hashes), LOOKUP_BATCH_SIZE):
+                chunk = hashes[start:start + LOOKUP_BATCH_SIZE]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._db.execute(
+                    f"SELECT text_hash, vector FROM embeddings "
+                    f"WHERE model = ? AND kind = ? AND text_hash IN ({placeholders})",
+                    [self.model, kind, *chunk]
+                )
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32)
+        return found
+
+    def _store(self, kind, vectors):
+        """Write {hash: vector} to the cache with one commit."""
+        rows = [(self.model, kind, key, np.asarray(vector, dtype=np.float32).tobytes())
+                for key, vector in vectors.items()]
+        with self._db_lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, kind, text_hash, vector) VALUES (?, ?, ?, ?)", rows
+            )
+            self._db.commit()
+
+    def _count(self, hits=0, misses=0, requests=0):
+        """Add to the cache counters."""
+        with self._counter_lock:
+            self.hits += hits
+            self.misses += misses
+            self.requests += requests
+
+    def _call_provider(self, embed_fn, texts):
+        """One rate-limited provider request."""
+        self.rate_limiter.wait()
+        return embed_fn(texts)
+
+    def _embed_missing(self, texts):
+        """Embed texts through the provider in concurrent, rate-limited batches."""
+        batches = [texts[start:start + self.batch_size] for start in range(0, len(texts), self.batch_size)]
+        self._count(requests=len(batches))
+
+        if len(batches) == 1 or self.max_concurrency <= 1:
+            results = [self._call_provider(self.embeddings.embed_documents, batch) for batch in batches]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches))) as executor:
+                results = list(executor.map(
+                    lambda batch: self._call_provider(self.embeddings.embed_documents, batch), batches
+                ))
+
+        return [vector for batch_vectors in results for vector in batch_vectors]
+
+    def embed_documents(self, texts):
+        """Embed search documents, calling the provider only for uncached texts."""
+        hashes = [text_hash(text) for text in texts]
+        vectors = self._lookup("document", list(dict.fromkeys(hashes)))
+
+        # Each distinct missing text is counted and embedded once
+        missing = {key: text for key, text in zip(hashes, texts) if key not in vectors}
+        self._count(hits=len(vectors), misses=len(missing))
+        if missing:
+            new_vectors = dict(zip(missing, self._embed_missing(list(missing.values()))))
+            self._store("document", new_vectors)
+            vectors.update({key: np.asarray(vector, dtype=np.float32) for key, vector in new_vectors.items()})
+
+        return [vectors[key].tolist() for key in hashes]
+
+    def embed_query(self, text):
+        """Embed a search query, reusing the cached vector of a repeated query."""
+        key = text_hash(text)
+        vector = self._lookup("query", [key]).get(key)
+        if vector is not None:
+            self._count(hits=1)
+            return vector.tolist()
+
+        self._count(misses=1, requests=1)
+        vector = self._call_provider(lambda texts: [self.embeddings.embed_query(texts[0])], [text])[0]
+        self._store("query", {key: vector})
+        return list(vector)
+
+    def stats(self):
+        """Return the cache counters."""
+        with self._counter_lock:
+            hits, misses, requests = self.hits, self.misses, self.requests
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "requests": requests,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        """Close the cache file."""
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    Offline stand-in for CohereEmbeddings.
+
+    Words and character trigrams are hashed with crc32 into signed buckets and
+    the result is L2-normalized, so indexing and retrieval can be tested
+    without an API key or network access.
+    """
+
+    def __init__(self, dimension=1024):
+        self.dimension = dimension
+        self.model = f"hashing-{dimension}"
+
+    def _embed(self, text):
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for word in WORD_PATTERN.findall(text.lower()):
+            padded = f" {word} "
+            for feature in [word] + [padded[i:i + 3] for i in range(len(padded) - 2)]:
+                bucket = zlib.crc32(feature.encode("utf-8"))
+                # The top bit picks the sign, so collisions cancel out on average
+                vector[bucket % self.dimension] += 1.0 if bucket & 0x80000000 else -1.0
+        return (vector / max(np.linalg.norm(vector), 1e-12)).tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
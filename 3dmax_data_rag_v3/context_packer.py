@@ -0,0 +1,222 @@
+"""
+Token-budget context packing for the 3D Max RAG system.
+
+Whole chunks go into the prompt only while they fit a token budget. Chunks
+arrive best first (by reranker or vector search score) and are given budget
+in that order; a chunk that does not fit is shortened at sentence boundaries,
+keeping the sentences that share most words with the question, and chunks
+that cannot get a useful share are dropped. The prompt size, and with it the
+latency and cost of an answer, is bounded by the budget whatever the size of
+the retrieved chunks.
+"""
+import math
+import re
+
+from reranker import stems
+
+# Tokenizer of gpt-4o-mini
+TIKTOKEN_ENCODING = "o200k_base"
+
+# Words and punctuation marks, with about this many characters per token
+APPROX_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+APPROX_CHARS_PER_TOKEN = 4
+
+# Sentences end with a terminal mark followed by whitespace, or at a line break
+SENTENCE_PATTERN = re.compile(r"[^\n]+?(?:[.!?…](?=\s)|$)", re.MULTILINE)
+
+# Marks the place where sentences of a shortened chunk were left out
+ELLIPSIS = " …"
+
+
+class TokenCounter:
+    """
+    Counts and truncates text in model tokens.
+
+    Uses tiktoken when it is installed and its encoding can be loaded (it is
+    downloaded on first use), otherwise a local approximation that counts
+    every word as one token per APPROX_CHARS_PER_TOKEN characters.
+    """
+
+    def __init__(self, encoding=TIKTOKEN_ENCODING):
+        self.encoding = None
+        # Optional dependency, only needed for exact counts
+        try:
+            import tiktoken
+            self.encoding = tiktoken.get_encoding(encoding)
+        except ImportError:
+            pass
+        except Exception as e:
+            print(f"Could not load the {encoding} tokenizer ({e}), approximating token counts")
+
+    @property
+    def exact(self):
+        return self.encoding is not None
+
+    def _approx_ends(self, text):
+        """Character offsets at which each approximate token ends"""
+        ends = []
+        for match in APPROX_TOKEN_PATTERN.finditer(text):
+            pieces = math.ceil(len(match.group()) / APPROX_CHARS_PER_TOKEN)
+            ends += [min(match.start() + (i + 1) * APPROX_CHARS_PER_TOKEN, match.end()) for i in range(pieces)]
+        return ends
+
+    def count(self, text):
+        """Number of tokens in a text"""
+        if self.encoding is not None:
+            return len(self.encoding.encode(text))
+        return sum(math.ceil(len(word) / APPROX_CHARS_PER_TOKEN) for word in APPROX_TOKEN_PATTERN.findall(text))
+
+    def truncate(self, text, max_tokens):
+        """The longest prefix of a text with at most max_tokens tokens"""
+        if max_tokens <= 0:
+            return ""
+        if self.encoding is not None:
+            tokens = self.encoding.encode(text)
+            return text if len(tokens) <= max_tokens else self.encoding.decode(tokens[:max_tokens])
+        ends = self._approx_ends(text)
+        return text if len(ends) <= max_tokens else text[:ends[max_tokens - 1]]
+
+
+class ContextPacker:
+    """
+    Fits formatted chunks into a token budget, best chunks first.
+
+    Every chunk is a (header, body) pair: the header (chapter, question
+    number) is always kept whole, the body is shortened when needed.
+    """
+
+    def __init__(self, budget_tokens=1500, max_chunk_tokens=None, min_chunk_tokens=40, counter=None):
+        """
+        Args:
+            budget_tokens: Tokens the whole context may take
+            max_chunk_tokens: Tokens one chunk gets before the others are served (budget / 2 if None)
+            min_chunk_tokens: Smallest useful body, chunks that cannot get it are dropped
+            counter: TokenCounter to use, a new one if None
+        """
+        self.budget_tokens = budget_tokens
+        self.max_chunk_tokens = max_chunk_tokens or budget_tokens // 2
+        self.min_chunk_tokens = min_chunk_tokens
+        self.counter = counter or TokenCounter()
+
+    def _allot(self, header_tokens, body_tokens):
+        """Body tokens granted to each chunk, None for dropped chunks"""
+        # Headers are kept whole, so drop the lowest ranked chunks until every
+        # kept chunk can get its header and a useful body
+        kept = len(body_tokens)
+        while kept and sum(header_tokens[:kept]) + sum(
+                min(tokens, self.min_chunk_tokens) for tokens in body_tokens[:kept]) > self.budget_tokens:
+            kept -= 1
+
+        available = self.budget_tokens - sum(header_tokens[:kept])
+        minimums = [min(tokens, self.min_chunk_tokens) for tokens in body_tokens[:kept]]
+
+        # Best chunks first, up to the per-chunk cap, leaving the minimum for the rest
+        allotted = []
+        for i in range(kept):
+            reserve = sum(minimums[i + 1:])
+            allotted.append(max(min(body_tokens[i], self.max_chunk_tokens, available - reserve), minimums[i]))
+            available -= allotted[-1]
+
+        # Budget the cap left over goes back to capped chunks, again best first
+        for i in range(kept):
+            extra = min(body_tokens[i] - allotted[i], available)
+            if extra > 0:
+                allotted[i] += extra
+                available -= extra
+
+        return allotted + [None] * (len(body_tokens) - kept)
+
+    def _sentences(self, text):
+        """(start, end) offsets of the sentences of a text, without surrounding whitespace"""
+        spans = []
+        for match in SENTENCE_PATTERN.finditer(text):
+            sentence = match.group()
+            if sentence.strip():
+                spans.append((match.start() + len(sentence) - len(sentence.lstrip()), match.end()))
+        return spans
+
+    @staticmethod
+    def _join(text, sentences, chosen):
+        """Chosen sentences in document order, marking the places where others were left out"""
+        parts = []
+        for position, i in enumerate(chosen):
+            start, end = sentences[i]
+            if position and chosen[position - 1] == i - 1:
+                # Adjacent sentences keep the text between them
+                parts.append(text[sentences[i - 1][1]:end])
+            elif position:
+                parts += [ELLIPSIS, " ", text[start:end]]
+            else:
+                parts += [ELLIPSIS.lstrip() + " " if i else "", text[start:end]]
+        if chosen[-1] != len(sentences) - 1:
+            parts.append(ELLIPSIS)
+        return "".join(parts)
+
+    def shorten(self, text, max_tokens, question=None):
+        """
+        Shorten a chunk body to max_tokens at sentence boundaries
+
+        With a question the sentences sharing most word stems with it are
+        kept, otherwise the leading ones; either way in document order. A
+        first sentence too long to fit is cut at a token boundary.
+        """
+        sentences = self._sentences(text)
+        costs = [self.counter.count(text[start:end]) for start, end in sentences]
+
+        # Sentences in the order they are considered for the shortened chunk
+        order = list(range(len(sentences)))
+        if question:
+            query_stems = set(stems(question))
+            overlap = [len(query_stems.intersection(stems(text[start:end]))) for start, end in sentences]
+            # The first sentence usually names the topic of the chunk
+            order.sort(key=lambda i: (i != 0, -overlap[i], i))
+
+        budget = max_tokens - self.counter.count(ELLIPSIS)
+        chosen = []
+        for i in order:
+            if costs[i] <= budget:
+                chosen.append(i)
+                budget -= costs[i]
+            elif not question:
+                break
+
+        # Gap marks and the text between sentences cost a few tokens too,
+        # so give up the least relevant sentences until the result fits
+        while chosen:
+            shortened = self._join(text, sentences, sorted(chosen))
+            if self.counter.count(shortened) <= max_tokens:
+                return shortened
+            chosen.pop()
+
+        cut = self.counter.truncate(text.strip(), max_tokens - self.counter.count(ELLIPSIS))
+        return cut.rstrip() + ELLIPSIS
+
+    def pack(self, chunks, question=None):
+        """
+        Fit formatted chunks into the budget
+
+        Args:
+            chunks: (header, body) pairs, best first
+            question: Question used to pick the sentences of shortened chunks
+
+        Returns:
+            tuple: (list of kept (header, body) pairs, stats dict with tokens,
+                    budget, shortened and dropped)
+        """
+        header_tokens = [self.counter.count(header) for header, _ in chunks]
+        body_tokens = [self.counter.count(body) for _, body in chunks]
+        allotted = self._allot(header_tokens, body_tokens)
+
+        packed = []
+        stats = {"tokens": 0, "budget": self.budget_tokens, "shortened": 0, "dropped": 0}
+        for (header, body), header_count, body_count, allowed in zip(chunks, header_tokens, body_tokens, allotted):
+            if allowed is None:
+                stats["dropped"] += 1
+                continue
+            if body_count > allowed:
+                body = self.shorten(body, allowed, question)
+                body_count = self.counter.count(body)
+                stats["shortened"] += 1
+            packed.append((header, body))
+            stats["tokens"] += header_count + body_count
+        return packed, stats
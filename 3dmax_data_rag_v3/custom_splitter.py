@@ -1,9 +1,190 @@
 from langchain.text_splitter import TextSplitter
 from langchain.docstore.document import Document
 from langchain_community.document_loaders import PyPDFLoader
+from text_cache import DEFAULT_CACHE_DIR, TextCache
+from lexical_index import LexicalIndex
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import os
 import re
 import random
 
+# Russian question words a numbered question starts with
+QUESTION_WORDS = r'(?:Как|Что|Почему|Где|Когда|Каким|В чем|Зачем|Сколько)'
+
+# Patterns are compiled once instead of on every call
+CHAPTER_PATTERN = re.compile(r'--([^-]+)--')
+QA_PATTERN = re.compile(r'(\d+)\.\s+(' + QUESTION_WORDS + r'[^?]+\?)')
+UI_PATTERN = re.compile(r'\d+\.\d+\.')
+SECTION_PATTERN = re.compile(r'(\d+\.\d+\.)\s+([^\n]+)')
+
+# Marks the start of the answer inside a Q&A pair
+ANSWER_MARKER = "Ответ:"
+
+# Single-pass scanner: matches a chapter marker, or a number that starts a question
+# or a section, and captures in lookaheads which of the patterns above begin there.
+# The leading character class lets the regex engine skip plain text in a tight loop.
+BOUNDARY_PATTERN = re.compile(
+    r'(?P<lead>[-\d])(?:'
+    r'(?<=-)-(?P<chapter_name>[^-]+)--'
+    r'|(?<=\d)(?P<digits>\d*)\.(?:'
+    r'(?=\s+(?P<question>' + QUESTION_WORDS + r'[^?]+\?))'
+    r'|(?=(?P<minor>\d+)\.(?:\s+(?P<section_title>[^\n]+))?)'
+    r'))'
+)
+
+# Boundaries found by the scanner, as offsets into the source text
+ChapterSpan = namedtuple("ChapterSpan", ["name", "start", "end", "questions", "sections", "has_ui"])
+QuestionSpan = namedtuple("QuestionSpan", ["number", "question", "start", "end"])
+SectionSpan = namedtuple("SectionSpan", ["number", "title", "start", "end"])
+
+
+def scan_chapters(text):
+    """
+    Find chapters, Q&A pairs and numbered sections in one linear scan of the text.
+
+    Yields a ChapterSpan for every --ChapterName-- marker as soon as the next
+    marker (or the end of the text) closes it. The spans match what
+    re.finditer over each stripped chapter would find.
+    """
+    chapter = None
+
+    for match in BOUNDARY_PATTERN.finditer(text):
+        lead, chapter_name, digits, question, minor, section_title = match.groups()
+
+        if chapter_name is not None:
+            if chapter is not None:
+                yield _close_chapter(text, match.start(), *chapter)
+            chapter = [chapter_name.strip(), match.end(), [], [], None]
+            continue
+
+        # Text before the first chapter is not part of any chunk
+        if chapter is None:
+            continue
+
+        number = lead + digits
+        if question is not None:
+            chapter[2].append((match.start(), match.end("question"), number, question))
+
+        if minor is not None:
+            # Only the first section number decides whether the chapter is a UI chapter
+            if chapter[4] is None:
+                chapter[4] = match.end("minor") + 1
+            if section_title is not None:
+                chapter[3].append((match.start(), match.start("section_title"), match.end("section_title"),
+                                   f"{number}.{minor}."))
+
+    if chapter is not None:
+        yield _close_chapter(text, len(text), *chapter)
+
+
+def _close_chapter(text, end, name, start, question_matches, section_matches, first_ui_end):
+    """Resolve the boundaries collected for a chapter once its end is known."""
+    # Chapter content is stripped, like text[start:end].strip()
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+
+    # Matches were found in the whole text: drop the ones running past the
+    # chapter end and the ones overlapping an earlier match
+    questions = []
+    resume = start
+    for match_start, match_end, number, question in question_matches:
+        if match_start >= resume and match_end <= end:
+            questions.append((match_start, number, question.strip()))
+            resume = match_end
+
+    sections = []
+    resume = start
+    for match_start, title_start, title_end, number in section_matches:
+        title_end = min(title_end, end)
+        if match_start >= resume and title_start < title_end:
+            sections.append((match_start, number, text[title_start:title_end].strip()))
+            resume = title_end
+
+    # Every Q&A pair or section runs until the next one starts
+    question_spans = [
+        QuestionSpan(number, question, match_start, questions[i + 1][0] if i + 1 < len(questions) else end)
+        for i, (match_start, number, question) in enumerate(questions)
+    ]
+    section_spans = [
+        SectionSpan(number, title, match_start, sections[i + 1][0] if i + 1 < len(sections) else end)
+        for i, (match_start, number, title) in enumerate(sections)
+    ]
+    has_ui = first_ui_end is not None and first_ui_end <= end
+    return ChapterSpan(name, start, end, question_spans, section_spans, has_ui)
+
+
+def find_answer_start(content, question):
+    """
+    Offset of the answer in a Q&A chunk, or -1 if the question is not in it.
+
+    The answer follows the "Ответ:" marker if there is one, else the question.
+    """
+    question_index = content.find(question)
+    if question_index == -1:
+        return -1
+    start = question_index + len(question)
+
+    marker_index = content.find(ANSWER_MARKER, start)
+    if marker_index != -1:
+        start = marker_index + len(ANSWER_MARKER)
+
+    # Skip the whitespace before the answer
+    while start < len(content) and content[start].isspace():
+        start += 1
+    return start
+
+
+def chunk_answer(chunk):
+    """Answer text of a Q&A chunk, or None if its question is not in the content."""
+    start = chunk.metadata.get("answer_start")
+    if start is None:
+        # Chunks indexed before answers were extracted at split time
+        start = find_answer_start(chunk.page_content, chunk.metadata.get("question", ""))
+    return chunk.page_content[start:] if start >= 0 else None
+
+
+def _qa_document(content, base_metadata, chapter_name, question_number, question):
+    """Create a Q&A pair document with its answer offset in the metadata"""
+    metadata = base_metadata.copy()
+    metadata.update({
+        "chapter": chapter_name,
+        "type": "qa",
+        "question_number": question_number,
+        "question": question,
+        "answer_start": find_answer_start(content, question)
+    })
+    return Document(page_content=content, metadata=metadata)
+
+
+def _chapter_type(chapter):
+    """Content type of a scanned chapter: qa, ui_explanation or general"""
+    if chapter.questions:
+        return "qa"
+    if chapter.has_ui:
+        return "ui_explanation"
+    return "general"
+
+
+def _process_chapter(task):
+    """Split the text of one chapter, in a worker process of the parallel mode"""
+    chapter_type, chapter_name, content, base_metadata = task
+    splitter = ChapterAwareMaxSplitter(verbose=False)
+
+    if chapter_type == "qa":
+        return splitter._process_qa_content(chapter_name, content, base_metadata)
+    if chapter_type == "ui_explanation":
+        return splitter._process_ui_content(chapter_name, content, base_metadata)
+
+    # Keep as a single chunk if content type is unknown
+    metadata = base_metadata.copy()
+    metadata["chapter"] = chapter_name
+    metadata["type"] = "general"
+    return [Document(page_content=content, metadata=metadata)]
+
 
 class ChapterAwareMaxSplitter(TextSplitter):
     """
@@ -12,9 +193,18 @@ class ChapterAwareMaxSplitter(TextSplitter):
     both Q&A sections and UI explanation sections.
     """
 
-    def __init__(self):
+    def __init__(self, verbose=True, parallel=False, max_workers=None):
+        """
+        Args:
+            verbose: Print a line for every chapter (slow on large documents)
+            parallel: Process chapters in a process pool instead of one after another
+            max_workers: Size of the process pool, defaults to the number of CPUs
+        """
         # Initialize with reasonable values for the parent class
         super().__init__(chunk_size=1000, chunk_overlap=0)
+        self.verbose = verbose
+        self.parallel = parallel
+        self.max_workers = max_workers or os.cpu_count() or 1
 
     def split_text(self, text):
         """Required by the interface but not used directly"""
@@ -25,52 +215,185 @@ class ChapterAwareMaxSplitter(TextSplitter):
         """Split documents by chapters then by content type within each chapter"""
         result = []
 
-        # Process each input document
-        for doc in documents:
-            text = doc.page_content
-            base_metadata = doc.metadata.copy()
-
-            # Chapter identification with --ChapterName-- format
-            chapters = self._identify_chapters(text)
+        with self._executor() as executor:
+            # Process each input document
+            for doc in documents:
+                text = doc.page_content
+                base_metadata = doc.metadata.copy()
 
-            if not chapters:
-                print("Warning: No chapters found with --ChapterName-- pattern")
-                # Keep the document as is if no chapters found
-                result.append(doc)
-                continue
+                # Chapters, Q&A pairs and sections are found in a single scan
+                chapters = list(scan_chapters(text))
 
-            print(f"Found {len(chapters)} chapters")
+                if not chapters:
+                    print("Warning: No chapters found with --ChapterName-- pattern")
+                    # Keep the document as is if no chapters found
+                    result.append(doc)
+                    continue
 
-            # Process each chapter
-            for chapter_name, chapter_content in chapters:
-                print(f"\nProcessing chapter: {chapter_name}")
+                if self.verbose:
+                    print(f"Found {len(chapters)} chapters")
 
-                # Determine content type and process accordingly
-                if self._is_qa_chapter(chapter_content):
-                    chunks = self._process_qa_content(chapter_name, chapter_content, base_metadata)
+                # Process each chapter, results come back in document order
+                for chapter, chunks in zip(chapters, self._split_chapters(executor, text, chapters, base_metadata)):
                     result.extend(chunks)
-                    print(f"  Processed as Q&A chapter with {len(chunks)} Q&A pairs")
-                elif self._is_ui_chapter(chapter_content):
-                    chunks = self._process_ui_content(chapter_name, chapter_content, base_metadata)
-                    result.extend(chunks)
-                    print(f"  Processed as UI chapter with {len(chunks)} sections")
-                else:
-                    # Keep as a single chunk if content type is unknown
-                    metadata = base_metadata.copy()
-                    metadata["chapter"] = chapter_name
-                    metadata["type"] = "general"
-                    result.append(Document(page_content=chapter_content, metadata=metadata))
-                    print(f"  Processed as general content (single chunk)")
+                    if not self.verbose:
+                        continue
+
+                    print(f"\nProcessing chapter: {chapter.name}")
+                    if chapter.questions:
+                        print(f"  Processed as Q&A chapter with {len(chunks)} Q&A pairs")
+                    elif chapter.has_ui:
+                        print(f"  Processed as UI chapter with {len(chunks)} sections")
+                    else:
+                        # Kept as a single chunk if content type is unknown
+                        print(f"  Processed as general content (single chunk)")
 
         return result
 
+    def lazy_split_documents(self, documents):
+        """
+        Yield chunks one at a time instead of building the full list.
+
+        Each chapter is handed out as soon as the scanner has found its end.
+        Until then its chunks are only offsets into the source text, so memory
+        stays flat however many chunks the documents produce.
+        """
+        with self._executor() as executor:
+            for doc in documents:
+                text = doc.page_content
+                base_metadata = doc.metadata.copy()
+
+                found_chapters = False
+                for chunks in self._split_chapters(executor, text, scan_chapters(text), base_metadata):
+                    found_chapters = True
+                    yield from chunks
+
+                if not found_chapters:
+                    print("Warning: No chapters found with --ChapterName-- pattern")
+                    # Keep the document as is if no chapters found
+                    yield doc
+
+    def split_pages(self, pages, metadata=None, delimiter="\n"):
+        """
+        Yield chunks of a document that arrives page by page.
+
+        The chunks are the same as for delimiter.join(pages). Only the chapter
+        that is still open is carried over between pages: as soon as the next
+        --ChapterName-- marker shows up, the chapters before it are split and
+        dropped, so chapter and Q&A boundaries across page seams are kept.
+        """
+        base_metadata = dict(metadata or {})
+        carry = ""
+        chapter_open = False
+        # Markers cannot start before this offset in carry
+        search_from = 0
+
+        with self._executor() as executor:
+            for page_number, page in enumerate(pages):
+                carry = carry + delimiter + page if page_number else page
+
+                if not chapter_open:
+                    # Text before the first chapter is not part of any chunk
+                    first = CHAPTER_PATTERN.search(carry, search_from)
+                    if first is None:
+                        search_from = max(search_from, carry.rfind("--"))
+                        continue
+                    carry = carry[first.start():]
+                    chapter_open = True
+                    search_from = first.end() - first.start()
+
+                # A marker cut off at the end of the page can only start at the last "--"
+                markers = list(CHAPTER_PATTERN.finditer(carry, search_from))
+                if not markers:
+                    search_from = max(search_from, carry.rfind("--"))
+                    continue
+
+                # Every chapter before the last marker is complete
+                cut = markers[-1].start()
+                segment, carry = carry[:cut], carry[cut:]
+                search_from = markers[-1].end() - cut
+                for chunks in self._split_chapters(executor, segment, scan_chapters(segment), base_metadata):
+                    yield from chunks
+
+            if not chapter_open:
+                print("Warning: No chapters found with --ChapterName-- pattern")
+                # Keep the document as is if no chapters found
+                yield Document(page_content=carry, metadata=base_metadata)
+                return
+
+            for chunks in self._split_chapters(executor, carry, scan_chapters(carry), base_metadata):
+                yield from chunks
+
+    def _executor(self):
+        """Process pool for the parallel mode, or a no-op context when sequential"""
+        if self.parallel:
+            return ProcessPoolExecutor(max_workers=self.max_workers)
+        return contextlib.nullcontext()
+
+    def _split_chapters(self, executor, text, chapters, base_metadata):
+        """
+        Yield the list of chunks of every chapter, in document order.
+
+        With an executor each chapter's text goes to a worker process that runs
+        _process_qa_content / _process_ui_content on it. At most a few chapters
+        per worker are in flight, so lazy callers still see bounded memory.
+        """
+        if executor is None:
+            for chapter in chapters:
+                yield list(self._chapter_chunks(text, chapter, base_metadata))
+            return
+
+        pending = deque()
+        for chapter in chapters:
+            task = (_chapter_type(chapter), chapter.name, text[chapter.start:chapter.end], base_metadata)
+            pending.append(executor.submit(_process_chapter, task))
+            if len(pending) >= 4 * self.max_workers:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+    def _chapter_chunks(self, text, chapter, base_metadata):
+        """Yield the chunks of a scanned chapter according to its content type"""
+        if chapter.questions:
+            yield from self._qa_chunks(text, chapter, base_metadata)
+        elif chapter.has_ui:
+            yield from self._ui_chunks(text, chapter, base_metadata)
+        else:
+            yield self._general_chunk(text, chapter, base_metadata)
+
+    def _general_chunk(self, text, chapter, base_metadata):
+        """Create a single document for a chapter of unknown content type"""
+        metadata = base_metadata.copy()
+        metadata["chapter"] = chapter.name
+        metadata["type"] = "general"
+        return Document(page_content=text[chapter.start:chapter.end], metadata=metadata)
+
+    def _qa_chunks(self, text, chapter, base_metadata):
+        """Yield the Q&A pair documents of a scanned chapter"""
+        for span in chapter.questions:
+            yield _qa_document(
+                text[span.start:span.end].strip(), base_metadata, chapter.name, span.number, span.question
+            )
+
+    def _ui_chunks(self, text, chapter, base_metadata):
+        """Yield the section documents of a scanned UI chapter"""
+        for span in chapter.sections:
+            metadata = base_metadata.copy()
+            metadata.update({
+                "chapter": chapter.name,
+                "type": "ui_explanation",
+                "section_number": span.number.rstrip('.'),
+                "section_title": f"{span.number} {span.title}"
+            })
+            yield Document(page_content=text[span.start:span.end].strip(), metadata=metadata)
+
     def _identify_chapters(self, text):
         """Identify chapters marked with --ChapterName-- format"""
         chapters = []
 
         # Find all chapter markers
-        chapter_pattern = r'--([^-]+)--'
-        chapter_matches = list(re.finditer(chapter_pattern, text))
+        chapter_matches = list(CHAPTER_PATTERN.finditer(text))
 
         # Extract chapter content
         for i, match in enumerate(chapter_matches):
@@ -92,24 +415,19 @@ class ChapterAwareMaxSplitter(TextSplitter):
     def _is_qa_chapter(self, content):
         """Determine if a chapter contains Q&A pairs"""
         # Look for numbered questions that end with question marks
-        qa_pattern = r'\d+\.\s+(?:Как|Что|Почему|Где|Когда|Каким|В чем|Зачем|Сколько)[^?]+\?'
-        return bool(re.search(qa_pattern, content))
+        return bool(QA_PATTERN.search(content))
 
     def _is_ui_chapter(self, content):
         """Determine if a chapter contains UI explanations with numbered sections"""
         # Look for section numbering like 1.1, 1.2, etc.
-        ui_pattern = r'\d+\.\d+\.'
-        return bool(re.search(ui_pattern, content))
+        return bool(UI_PATTERN.search(content))
 
     def _process_qa_content(self, chapter_name, content, base_metadata):
         """Process a chapter containing Q&A pairs"""
         chunks = []
 
-        # Pattern for numbered questions
-        qa_pattern = r'(\d+)\.\s+((?:Как|Что|Почему|Где|Когда|Каким|В чем|Зачем|Сколько)[^?]+\?)'
-
         # Find all Q&A pairs
-        qa_matches = list(re.finditer(qa_pattern, content))
+        qa_matches = list(QA_PATTERN.finditer(content))
 
         # Process each Q&A pair
         for i, match in enumerate(qa_matches):
@@ -126,17 +444,8 @@ class ChapterAwareMaxSplitter(TextSplitter):
             # Extract the full Q&A text
             qa_text = content[start_pos:end_pos].strip()
 
-            # Create metadata
-            metadata = base_metadata.copy()
-            metadata.update({
-                "chapter": chapter_name,
-                "type": "qa",
-                "question_number": q_num,
-                "question": question
-            })
-
-            # Create document with the complete Q&A pair
-            chunks.append(Document(page_content=qa_text, metadata=metadata))
+            # Create document with the complete Q&A pair, locating the answer once here
+            chunks.append(_qa_document(qa_text, base_metadata, chapter_name, q_num, question))
 
         return chunks
 
@@ -144,11 +453,8 @@ class ChapterAwareMaxSplitter(TextSplitter):
         """Process a chapter containing UI explanations with numbered sections"""
         chunks = []
 
-        # Pattern for numbered sections
-        section_pattern = r'(\d+\.\d+\.)\s+([^\n]+)'
-
         # Find all sections
-        section_matches = list(re.finditer(section_pattern, content))
+        section_matches = list(SECTION_PATTERN.finditer(content))
 
         # Process each section
         for i, match in enumerate(section_matches):
@@ -180,13 +486,16 @@ class ChapterAwareMaxSplitter(TextSplitter):
         return chunks
 
 
-def eval_chapter_aware_splitter(pdf_path, num_samples=5):
+def eval_chapter_aware_splitter(pdf_path, num_samples=5, text_cache_dir=DEFAULT_CACHE_DIR):
     """Test the chapter-aware splitter and display sample chunks"""
     print(f"Loading document: {pdf_path}")
 
-    # Load the PDF as a single document to preserve structure
+    # Load the PDF as a single document to preserve structure, parsed once per file version
     loader = PyPDFLoader(pdf_path, mode="single")
-    documents = loader.load()
+    if text_cache_dir:
+        documents = TextCache(text_cache_dir).documents(pdf_path, "PyPDFLoader", {"mode": "single"}, loader.load)
+    else:
+        documents = loader.load()
 
     if len(documents) > 1:
         print(f"Warning: PDF loaded as {len(documents)} separate pages. Combining into one document.")
@@ -244,35 +553,20 @@ def eval_chapter_aware_splitter(pdf_path, num_samples=5):
     return chunks, chapters
 
 
-def eval_retrieval(chunks, query, num_results=3):
-    """Test retrieval for a specific question"""
+def eval_retrieval(chunks, query, num_results=3, index=None):
+    """
+    Test retrieval for a specific question
+
+    Pass a LexicalIndex built once over the chunks when testing many questions.
+    """
     print(f"\nTesting retrieval for: '{query}'")
 
     # Simple search function - in practice, you'd use a vector database
-    matching_chunks = []
-
-    # Try exact matching first
-    for chunk in chunks:
-        if chunk.metadata.get("type") == "qa" and query.lower() in chunk.metadata.get("question", "").lower():
-            matching_chunks.append((chunk, 1.0))  # Perfect match score
-
-    # If no exact matches, try word matching
-    if not matching_chunks:
-        query_words = set(query.lower().split())
-
-        for chunk in chunks:
-            if chunk.metadata.get("type") == "qa":
-                question = chunk.metadata.get("question", "")
-                chunk_words = set(question.lower().split())
-                common_words = query_words.intersection(chunk_words)
+    if index is None:
+        index = LexicalIndex(chunks)
 
-                if common_words:
-                    # Calculate similarity score
-                    similarity = len(common_words) / max(len(query_words), len(chunk_words))
-                    matching_chunks.append((chunk, similarity))
-
-    # Sort by similarity score
-    matching_chunks.sort(key=lambda x: x[1], reverse=True)
+    # Exact matches first, then word matching sorted by similarity score
+    matching_chunks = index.search(query)
 
     # Display top results
     if matching_chunks:
@@ -283,22 +577,12 @@ def eval_retrieval(chunks, query, num_results=3):
             print(f"Chapter: {chunk.metadata.get('chapter')}")
             print(f"Question #{chunk.metadata.get('question_number')}: {chunk.metadata.get('question')}")
 
-            # Extract answer (everything after the question)
-            content = chunk.page_content
-            question = chunk.metadata.get("question", "")
-
-            question_index = content.find(question)
-            if question_index != -1:
-                answer_text = content[question_index + len(question):].strip()
-
-                # Look for "Ответ:" marker
-                answer_marker = re.search(r'Ответ:', answer_text)
-                if answer_marker:
-                    answer_text = answer_text[answer_marker.end():].strip()
-
+            # Answer located at split time
+            answer_text = chunk_answer(chunk)
+            if answer_text is not None:
                 print(f"Answer: {answer_text[:300]}...")
             else:
-                print(f"Content: {content[:300]}...")
+                print(f"Content: {chunk.page_content[:300]}...")
 
             print(f"{'=' * 60}")
     else:
@@ -0,0 +1,302 @@
+"""
+Evaluation runner for the 3D Max RAG system.
+
+Runs a file of labeled questions through ThreeDMaxRAG, retrieval and
+generation together, with a bounded number of questions in flight. For every
+question it records the rank of the first chunk matching the expected
+chapter / question number, stage latencies and the tokens the model used.
+The report gives hit@k, the latency distribution and token totals, so a new
+splitter version or retrieval setting can be compared with the last one
+before it is deployed.
+
+Questions are a JSON list (or JSON lines) of objects like
+    {"question": "Как выбрать систему координат?", "chapter": "Интерфейс", "question_number": "37"}
+where chapter, question_number and section_number are optional; a retrieved
+chunk is a hit when all the given fields match. With --sample the questions
+are taken from the Q&A chunks in the vector store instead.
+
+With --fake-llm and --fake-embeddings everything runs offline.
+
+Usage:
+    python eval_rag.py --questions eval_questions.json --output eval.json
+    python eval_rag.py --sample 100 --fake-llm --fake-embeddings --db ./chroma_db_eval
+    python eval_rag.py --questions eval_questions.json --compare eval_before.json --min-hit-rate 0.8
+"""
+import asyncio
+import json
+import random
+import sys
+import time
+
+import numpy as np
+
+from rag_complete import ThreeDMaxRAG
+
+# Metadata fields a labeled question can pin down
+LABEL_FIELDS = ("chapter", "question_number", "section_number")
+
+
+def load_questions(path):
+    """Load labeled questions from a JSON list or a JSON lines file."""
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+
+    if text.lstrip().startswith("["):
+        questions = json.loads(text)
+    else:
+        questions = [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    for item in questions:
+        if not item.get("question"):
+            raise ValueError(f"Question entry without 'question': {item}")
+    return questions
+
+
+def sample_questions(vectorstore, num_questions, seed=0):
+    """Use the questions of randomly chosen Q&A chunks, labeled with their own chapter and number."""
+    metadatas = vectorstore.get(where={"type": "qa"}, include=["metadatas"])["metadatas"]
+    random.Random(seed).shuffle(metadatas)
+    return [
+        {"question": metadata["question"], "chapter": metadata.get("chapter"),
+         "question_number": metadata.get("question_number")}
+        for metadata in metadatas[:num_questions]
+    ]
+
+
+def first_hit_rank(docs, item):
+    """1-based rank of the first retrieved chunk matching the question's labels, or None."""
+    labels = {field: str(item[field]) for field in LABEL_FIELDS if item.get(field) is not None}
+    if not labels:
+        return None
+
+    for rank, doc in enumerate(docs, start=1):
+        if all(str(doc.metadata.get(field)) == value for field, value in labels.items()):
+            return rank
+    return None
+
+
+async def evaluate_question(rag, item, k, semaphore):
+    """Answer one labeled question and record its retrieval rank, latency and tokens."""
+    expected = {field: item[field] for field in LABEL_FIELDS if item.get(field) is not None}
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            result = await rag.aask_detailed(item["question"], k=k)
+        except Exception as e:
+            # Kept labeled, so a failed question counts as a miss
+            return {"question": item["question"], "expected": expected, "error": str(e), "rank": None,
+                    "latency_ms": (time.perf_counter() - start) * 1000}
+        latency = time.perf_counter() - start
+
+    timings = result["timings"]
+    usage = result["usage"]
+    return {
+        "question": item["question"],
+        "expected": expected,
+        "rank": first_hit_rank(result["docs"], item),
+        "retrieved": [
+            {field: doc.metadata.get(field) for field in ("chapter", "type") + LABEL_FIELDS[1:]
+             if doc.metadata.get(field) is not None}
+            for doc in result["docs"]
+        ],
+        "cached": result["cached"],
+        "latency_ms": latency * 1000,
+        "retrieval_ms": timings.get("retrieval", 0.0) * 1000,
+        "generation_ms": timings.get("generation", 0.0) * 1000,
+        "input_tokens": usage.get("input_tokens", 0),
+        "output_tokens": usage.get("output_tokens", 0),
+        "total_tokens": usage.get("total_tokens", 0),
+        "context_tokens": result["context_tokens"],
+        "answer": result["answer"],
+    }
+
+
+async def run_eval(rag, questions, k=5, concurrency=8):
+    """Evaluate all questions with at most `concurrency` in flight; returns (rows, wall seconds)."""
+    semaphore = asyncio.Semaphore(concurrency)
+    start = time.perf_counter()
+    rows = await asyncio.gather(*(evaluate_question(rag, item, k, semaphore) for item in questions))
+    return list(rows), time.perf_counter() - start
+
+
+def percentile_ms(values, q):
+    """Percentile of a list of millisecond values, 0 for an empty list."""
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def summarize(rows, ks, wall_time):
+    """Aggregate per-question rows into hit rates, latency percentiles and token totals."""
+    labeled = [row for row in rows if row.get("expected")]
+    answered = [row for row in rows if "error" not in row]
+    generated = [row for row in answered if not row["cached"]]
+
+    summary = {
+        "questions": len(rows),
+        "labeled": len(labeled),
+        "errors": len(rows) - len(answered),
+        "cached": len(answered) - len(generated),
+        "wall_time_s": wall_time,
+        "qps": len(rows) / wall_time if wall_time else 0.0,
+        "mrr": sum(1 / row["rank"] for row in labeled if row["rank"]) / len(labeled) if labeled else 0.0,
+    }
+    for k in ks:
+        hits = sum(1 for row in labeled if row["rank"] and row["rank"] <= k)
+        summary[f"hit_at_{k}"] = hits / len(labeled) if labeled else 0.0
+
+    for stage in ("latency", "retrieval", "generation"):
+        values = [row[f"{stage}_ms"] for row in answered if stage != "generation" or not row["cached"]]
+        for q in (50, 95, 99):
+            summary[f"{stage}_ms_p{q}"] = percentile_ms(values, q)
+
+    for field in ("input_tokens", "output_tokens", "total_tokens"):
+        total = sum(row[field] for row in generated)
+        summary[field] = total
+        summary[f"mean_{field}"] = total / len(generated) if generated else 0.0
+
+    context_tokens = [row["context_tokens"] for row in generated if row["context_tokens"] is not None]
+    summary["mean_context_tokens"] = sum(context_tokens) / len(context_tokens) if context_tokens else 0.0
+    summary["max_context_tokens"] = max(context_tokens, default=0)
+    return summary
+
+
+def print_report(summary, ks):
+    """Print the summary as a short table."""
+    print(f"\nQuestions: {summary['questions']} ({summary['labeled']} labeled, "
+          f"{summary['errors']} errors, {summary['cached']} cached answers)")
+    print("Retrieval: " + "  ".join(f"hit@{k} {summary[f'hit_at_{k}']:.3f}" for k in ks)
+          + f"  MRR {summary['mrr']:.3f}")
+    print(f"\n{'Stage':<11} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for stage in ("latency", "retrieval", "generation"):
+        print(f"{stage:<11} {summary[f'{stage}_ms_p50']:>9.1f} {summary[f'{stage}_ms_p95']:>9.1f} "
+              f"{summary[f'{stage}_ms_p99']:>9.1f}")
+    print(f"\nTokens: {summary['total_tokens']} total, {summary['mean_total_tokens']:.0f} per question "
+          f"({summary['mean_input_tokens']:.0f} in / {summary['mean_output_tokens']:.0f} out)")
+    if summary["max_context_tokens"]:
+        print(f"Context: {summary['mean_context_tokens']:.0f} tokens per question, "
+              f"{summary['max_context_tokens']} at most")
+    print(f"Throughput: {summary['qps']:.2f} questions/s over {summary['wall_time_s']:.1f} s")
+
+
+def print_comparison(previous, current):
+    """Print how the summary changed against a previous report."""
+    print("\nChange against the previous report:")
+    for key, value in sorted(current["summary"].items()):
+        old = previous.get("summary", {}).get(key)
+        if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old != value:
+            print(f"  {key:<22} {old:>12.3f} -> {value:>12.3f}")
+
+
+def check_thresholds(summary, k, min_hit_rate=None, max_mean_tokens=None, max_errors=0):
+    """Return the list of violated thresholds, empty if the run passes."""
+    failures = []
+    if max_errors is not None and summary["errors"] > max_errors:
+        failures.append(f"{summary['errors']} questions failed, at most {max_errors} allowed")
+    if min_hit_rate is not None and summary[f"hit_at_{k}"] < min_hit_rate:
+        failures.append(f"hit@{k} {summary[f'hit_at_{k}']:.3f} is below {min_hit_rate:.3f}")
+    if max_mean_tokens is not None and summary["mean_total_tokens"] > max_mean_tokens:
+        failures.append(f"mean tokens {summary['mean_total_tokens']:.0f} exceed {max_mean_tokens:.0f}")
+    return failures
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Evaluate the 3D Max RAG system on labeled questions")
+    parser.add_argument("--questions", type=str, default=None,
+                        help="Labeled questions, a JSON list or JSON lines file")
+    parser.add_argument("--sample", type=int, default=None,
+                        help="Sample this many questions from the Q&A chunks of the vector store instead")
+    parser.add_argument("--doc", type=str, default="./data/3dmax_data.pdf",
+                        help="Path to the 3D Max documentation, used if the database has to be built")
+    parser.add_argument("--type", type=str, default="pdf", choices=["pdf", "docx"],
+                        help="Document type (pdf or docx)")
+    parser.add_argument("--db", type=str, default="./chroma_db_aware_v1",
+                        help="Path to the Chroma vector database")
+    parser.add_argument("--k", type=int, default=5,
+                        help="Chunks retrieved per question, hit rate is reported at 1, 3 and k")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="Questions in flight at once")
+    parser.add_argument("--fake-llm", action="store_true",
+                        help="Answer with a local fake model instead of gpt-4o-mini")
+    parser.add_argument("--fake-embeddings", action="store_true",
+                        help="Use local hashing embeddings instead of Cohere")
+    parser.add_argument("--reranker", type=str, default="lexical", choices=["lexical", "cross-encoder", "none"],
+                        help="Second retrieval stage reranking the vector search candidates")
+    parser.add_argument("--no-routing", action="store_true",
+                        help="Search the whole collection instead of the routed chapter/chunk type")
+    parser.add_argument("--answer-cache-size", type=int, default=0,
+                        help="Answer cache size, 0 measures every question uncached")
+    parser.add_argument("--context-tokens", type=int, default=1500,
+                        help="Token budget of the documentation in the prompt (0 puts whole chunks in)")
+    parser.add_argument("--output", type=str, default="eval.json",
+                        help="JSON report path")
+    parser.add_argument("--compare", type=str, default=None,
+                        help="Previous JSON report to compare against")
+    parser.add_argument("--min-hit-rate", type=float, default=None,
+                        help="Exit with an error if hit@k is below this value")
+    parser.add_argument("--max-mean-tokens", type=float, default=None,
+                        help="Exit with an error if the mean tokens per question exceed this value")
+    parser.add_argument("--max-errors", type=int, default=0,
+                        help="Exit with an error if more questions than this raise an exception")
+    args = parser.parse_args()
+
+    if args.questions is None and args.sample is None:
+        parser.error("either --questions or --sample is required")
+
+    rag = ThreeDMaxRAG(
+        doc_path=args.doc,
+        doc_type=args.type,
+        db_path=args.db,
+        fake_embeddings=args.fake_embeddings,
+        fake_llm=args.fake_llm,
+        reranker=None if args.reranker == "none" else args.reranker,
+        route_queries=not args.no_routing,
+        answer_cache_size=args.answer_cache_size,
+        context_tokens=args.context_tokens or None
+    )
+
+    if args.questions:
+        questions = load_questions(args.questions)
+    else:
+        questions = sample_questions(rag.vectorstore, args.sample)
+    print(f"Evaluating {len(questions)} questions, {args.concurrency} at a time")
+
+    ks = sorted({k for k in (1, 3, args.k) if k <= args.k})
+    rows, wall_time = asyncio.run(run_eval(rag, questions, k=args.k, concurrency=args.concurrency))
+    summary = summarize(rows, ks, wall_time)
+    print_report(summary, ks)
+
+    report = {
+        "config": {
+            "questions": args.questions,
+            "sample": args.sample,
+            "db": args.db,
+            "k": args.k,
+            "concurrency": args.concurrency,
+            "llm": "fake" if args.fake_llm else "gpt-4o-mini",
+            "embeddings": "hashing" if args.fake_embeddings else "embed-multilingual-v3.0",
+            "reranker": args.reranker,
+            "routing": not args.no_routing,
+            "answer_cache_size": args.answer_cache_size,
+            "context_tokens": args.context_tokens,
+        },
+        "summary": summary,
+        "questions": rows,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, sort_keys=True)
+    print(f"\nSaved evaluation report to {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            print_comparison(json.load(f), report)
+
+    failures = check_thresholds(summary, args.k, args.min_hit_rate, args.max_mean_tokens, args.max_errors)
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
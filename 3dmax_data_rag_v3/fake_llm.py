@@ -0,0 +1,61 @@
+"""
+Offline stand-in for the gpt-4o-mini chat model of the 3D Max RAG system.
+
+FakeChatModel answers with the first documentation fragment of the prompt and
+reports token usage counted with the same TokenCounter as the context packer,
+so retrieval quality, latency and prompt size can be measured without an API
+key or network access, in the same units as the context token budget.
+"""
+import asyncio
+import re
+import time
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+from context_packer import TokenCounter
+
+# Counts tokens like the context packer, exactly if tiktoken is available
+TOKEN_COUNTER = TokenCounter()
+
+# The prompt lists the documentation fragments between these headings
+CONTEXT_PATTERN = re.compile(r"ДОКУМЕНТАЦИЯ:\s*(.*?)\s*ВОПРОС ПОЛЬЗОВАТЕЛЯ:", re.DOTALL)
+
+
+class FakeChatModel(BaseChatModel):
+    """Answers with the first fragment of the prompt context, after an optional delay"""
+
+    latency: float = 0.0
+    max_answer_chars: int = 500
+
+    @property
+    def _llm_type(self):
+        return "fake-3dmax"
+
+    def _answer(self, prompt):
+        context = CONTEXT_PATTERN.search(prompt)
+        if context is None or not context.group(1):
+            return "Я не знаю."
+        return context.group(1).split("\n\n", 1)[0][:self.max_answer_chars]
+
+    def _result(self, messages):
+        prompt = "\n".join(str(message.content) for message in messages)
+        answer = self._answer(prompt)
+        input_tokens, output_tokens = TOKEN_COUNTER.count(prompt), TOKEN_COUNTER.count(answer)
+        message = AIMessage(content=answer, usage_metadata={
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
+        })
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        return self._result(messages)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._result(messages)
@@ -0,0 +1,132 @@
+"""
+In-memory lexical index over the questions of the splitter output.
+
+The chunk inspection tools look questions up by substring ("exact") or by
+shared words ("fuzzy"). Instead of scanning every chunk per query, the index
+is built once and keeps, in compact numpy arrays:
+
+- the postings of every normalized word (lowercase, split on whitespace, as
+  the inspection tools always compared them) and the number of distinct
+  words of each question, for fuzzy lookups;
+- the postings of every character trigram, for exact lookups: a question
+  containing the query contains all its trigrams, so only the questions in
+  the intersection of the query's trigram postings are checked.
+
+Both lookups touch only the postings of the query's terms, not every chunk,
+so thousands of questions can be looked up quickly in offline tests.
+"""
+import numpy as np
+
+# Characters per gram of the substring index
+GRAM_SIZE = 3
+
+
+def words(text):
+    """Normalized words of a question: lowercase, split on whitespace"""
+    return text.lower().split()
+
+
+def grams(text):
+    """Distinct character trigrams of a lowercase text"""
+    return {text[i:i + GRAM_SIZE] for i in range(len(text) - GRAM_SIZE + 1)}
+
+
+class Postings:
+    """Sorted document ids of every term, concatenated into one int32 array"""
+
+    def __init__(self, term_sets):
+        doc_ids = {}
+        for doc_id, terms in enumerate(term_sets):
+            for term in terms:
+                doc_ids.setdefault(term, []).append(doc_id)
+
+        self.terms = {term: term_id for term_id, term in enumerate(doc_ids)}
+        lengths = np.fromiter((len(ids) for ids in doc_ids.values()), dtype=np.int32, count=len(doc_ids))
+        self.offsets = np.zeros(len(doc_ids) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+        self.doc_ids = np.fromiter((doc_id for ids in doc_ids.values() for doc_id in ids),
+                                   dtype=np.int32, count=int(self.offsets[-1]))
+
+    def get(self, term):
+        """Ids of the documents containing a term, empty if it is unknown"""
+        term_id = self.terms.get(term)
+        if term_id is None:
+            return self.doc_ids[:0]
+        return self.doc_ids[self.offsets[term_id]:self.offsets[term_id + 1]]
+
+
+class LexicalIndex:
+    """Exact and fuzzy question lookups over a list of chunks"""
+
+    def __init__(self, chunks, field="question", doc_type="qa"):
+        """
+        Args:
+            chunks: Chunks from the splitter or the Q&A extractor
+            field: Metadata field holding the indexed text
+            doc_type: Only index chunks of this type (all chunks if None)
+        """
+        self.chunks = [
+            chunk for chunk in chunks
+            if doc_type is None or chunk.metadata.get("type") == doc_type
+        ]
+        self.texts = [chunk.metadata.get(field, "").lower() for chunk in self.chunks]
+
+        word_sets = [set(text.split()) for text in self.texts]
+        self.word_postings = Postings(word_sets)
+        self.word_counts = np.fromiter((len(terms) for terms in word_sets), dtype=np.int32,
+                                       count=len(word_sets))
+        self.gram_postings = Postings(grams(text) for text in self.texts)
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def exact(self, query):
+        """Indices of the chunks whose text contains the query, in chunk order"""
+        query = query.lower()
+        query_grams = grams(query)
+
+        if not query_grams:
+            # Too short for trigrams, check every text
+            candidates = range(len(self.texts))
+        else:
+            # Intersect the postings starting with the rarest trigram
+            postings = sorted((self.gram_postings.get(gram) for gram in query_grams), key=len)
+            candidates = postings[0]
+            for ids in postings[1:]:
+                if not len(candidates):
+                    break
+                candidates = np.intersect1d(candidates, ids, assume_unique=True)
+
+        return [int(i) for i in candidates if query in self.texts[i]]
+
+    def fuzzy(self, query, min_common=1):
+        """
+        Chunks sharing at least min_common words with the query
+
+        Returns:
+            list: (chunk index, shared words, shared words / max(query words,
+                  chunk words)) in chunk order
+        """
+        query_words = set(words(query))
+        postings = [self.word_postings.get(word) for word in query_words]
+        if not postings:
+            return []
+
+        doc_ids, common = np.unique(np.concatenate(postings), return_counts=True)
+        keep = common >= min_common
+        doc_ids, common = doc_ids[keep], common[keep]
+        similarity = common / np.maximum(len(query_words), self.word_counts[doc_ids])
+        return [(int(i), int(c), float(s)) for i, c, s in zip(doc_ids, common, similarity)]
+
+    def search(self, query):
+        """
+        Exact matches with score 1.0, or fuzzy matches by similarity if there are none
+
+        Returns:
+            list: (chunk, score) pairs, best first
+        """
+        matches = [(self.chunks[i], 1.0) for i in self.exact(query)]
+        if not matches:
+            matches = [(self.chunks[i], similarity) for i, _, similarity in self.fuzzy(query)]
+            matches.sort(key=lambda x: x[1], reverse=True)
+        return matches
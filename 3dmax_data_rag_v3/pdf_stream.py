@@ -0,0 +1,74 @@
+"""
+Streaming PDF text extraction for the 3D Max documentation.
+
+Text extraction is the slow part of loading a large manual, and it is
+independent per page. Pages are extracted in batches by worker processes and
+handed out in page order, with only a few batches in flight, so the caller
+can split the text as it arrives instead of holding the whole manual.
+"""
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from pypdf import PdfReader
+
+# PyPDFLoader joins pages with this delimiter in single mode
+PAGES_DELIMITER = "\n\f"
+
+# Pages extracted by one worker task
+PAGES_PER_TASK = 8
+
+
+def _extract_pages(task):
+    """Extract the text of a range of pages (runs in a worker process)"""
+    path, start, stop = task
+    reader = PdfReader(path)
+    return [reader.pages[i].extract_text() or "" for i in range(start, stop)]
+
+
+def iter_pdf_pages(path, max_workers=None, pages_per_task=PAGES_PER_TASK):
+    """
+    Yield the text of every page of a PDF, in order
+
+    Args:
+        path: Path to the PDF file
+        max_workers: Extraction processes, defaults to the number of CPUs (in-process if 1)
+        pages_per_task: Pages extracted per worker task
+    """
+    reader = PdfReader(path)
+    num_pages = len(reader.pages)
+    max_workers = max_workers or os.cpu_count() or 1
+
+    # Without spare cores the one reader already open is the cheapest
+    if max_workers <= 1 or num_pages <= pages_per_task:
+        for page in reader.pages:
+            yield page.extract_text() or ""
+        return
+
+    tasks = [(path, start, min(start + pages_per_task, num_pages)) for start in range(0, num_pages, pages_per_task)]
+
+    # A couple of tasks per worker in flight keeps every core busy with bounded memory
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for task in tasks:
+            pending.append(executor.submit(_extract_pages, task))
+            if len(pending) >= 2 * max_workers:
+                yield from pending.popleft().result()
+
+        while pending:
+            yield from pending.popleft().result()
+
+
+def cached_pdf_pages(path, cache=None, max_workers=None):
+    """
+    Yield the text of every page of a PDF, from a TextCache when it has them
+
+    Args:
+        path: Path to the PDF file
+        cache: TextCache storing the extracted pages (always extracts if None)
+        max_workers: Extraction processes on a cache miss
+    """
+    if cache is None:
+        return iter_pdf_pages(path, max_workers=max_workers)
+    return cache.pages(path, "pypdf", {"extraction_mode": "plain"},
+                       lambda: iter_pdf_pages(path, max_workers=max_workers))
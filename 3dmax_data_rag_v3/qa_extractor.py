@@ -1,10 +1,27 @@
-from langchain_community.document_loaders import PyPDFLoader
 from langchain.docstore.document import Document
 import re
 import random
-
-
-def process_max_document(file_path, file_type="pdf", num_samples=5, test_question=None):
+from pdf_stream import cached_pdf_pages
+from text_cache import DEFAULT_CACHE_DIR, TextCache
+from lexical_index import LexicalIndex
+
+# Questions like "37. Как выбрать систему координат?", with all common Russian question words
+QUESTION_WORDS = ("Как", "Что", "Почему", "Где", "Когда", "Каким образом", "В чем", "Зачем", "Сколько",
+                  "Какие", "Какой", "Какая", "Какое")
+QA_PATTERN = re.compile(r'(\d+)\.\s+((?:' + "|".join(QUESTION_WORDS) + r')[^?]+\?)')
+# The start of a question up to its question word, complete or cut off at the end of the text
+QUESTION_START_PATTERN = re.compile(r'\d+\.\s+(?:' + "|".join(QUESTION_WORDS) + ')')
+CUT_OFF_QUESTION_START_PATTERN = re.compile(r'\d+(?:\.(?:\s+(?:' + "|".join(
+    sorted({word[:i] for word in QUESTION_WORDS for i in range(1, len(word))}, key=len, reverse=True)
+) + r')?)?)?\Z')
+# Simpler pattern tried when a document has no standard questions at all
+FALLBACK_QA_PATTERN = re.compile(r'(\d+)\.\s+([^\.]+\?)')
+
+PAGES_DELIMITER = "\n--PAGE--\n"
+
+
+def process_max_document(file_path, file_type="pdf", num_samples=5, test_question=None, pdf_workers=None,
+                         text_cache_dir=DEFAULT_CACHE_DIR):
     """
     Process a 3D Max document to extract Q&A pairs
 
@@ -13,32 +30,38 @@ def process_max_document(file_path, file_type="pdf", num_samples=5, test_questio
         file_type: Type of document (pdf or docx)
         num_samples: Number of sample chunks to display
         test_question: Specific question to search for
+        pdf_workers: Processes extracting PDF pages, defaults to the number of CPUs
+        text_cache_dir: Directory caching the extracted text (parse every time if None)
     """
-    # Load the document as a single text
+    text_cache = TextCache(text_cache_dir) if text_cache_dir else None
+
+    # PDF pages are extracted in parallel and split as they arrive
     if file_type.lower() == "pdf":
-        loader = PyPDFLoader(file_path, mode="single",
-                             pages_delimiter="\n--PAGE--\n")
-        documents = loader.load()
+        print(f"Loading document: {file_path}")
+        qa_chunks = list(iter_qa_pairs(cached_pdf_pages(file_path, text_cache, max_workers=pdf_workers)))
     elif file_type.lower() == "docx":
         from langchain_community.document_loaders import Docx2txtLoader
         loader = Docx2txtLoader(file_path)
-        documents = loader.load()
-    else:
-        raise ValueError(f"Unsupported file type: {file_type}")
+        if text_cache is not None:
+            documents = text_cache.documents(file_path, "Docx2txtLoader", {}, loader.load)
+        else:
+            documents = loader.load()
+        print(f"Loaded document: {file_path}")
+
+        # We should have a single document with all the text
+        if len(documents) == 1:
+            full_text = documents[0].page_content
+        else:
+            # If we have multiple documents, combine them
+            full_text = "\n".join([doc.page_content for doc in documents])
 
-    print(f"Loaded document: {file_path}")
+        print(f"Document length: {len(full_text)} characters")
 
-    # We should have a single document with all the text
-    if len(documents) == 1:
-        full_text = documents[0].page_content
+        # Extract Q&A pairs
+        qa_chunks = extract_qa_pairs(full_text)
     else:
-        # If we have multiple documents, combine them
-        full_text = "\n".join([doc.page_content for doc in documents])
-
-    print(f"Document length: {len(full_text)} characters")
+        raise ValueError(f"Unsupported file type: {file_type}")
 
-    # Extract Q&A pairs
-    qa_chunks = extract_qa_pairs(full_text)
     print(f"Extracted {len(qa_chunks)} Q&A pairs")
 
     # Display sample chunks
@@ -53,49 +76,95 @@ def process_max_document(file_path, file_type="pdf", num_samples=5, test_questio
 
 def extract_qa_pairs(text):
     """Extract Q&A pairs from text"""
-    qa_chunks = []
-
-    # Pattern for questions like "37. Как выбрать систему координат?"
-    # Includes all common Russian question words
-    qa_pattern = r'(\d+)\.\s+((?:Как|Что|Почему|Где|Когда|Каким образом|В чем|Зачем|Сколько|Какие|Какой|Какая|Какое)[^?]+\?)'
-
     # Find all matching questions
-    matches = list(re.finditer(qa_pattern, text))
+    matches = list(QA_PATTERN.finditer(text))
 
     if not matches:
         print("Warning: No Q&A pairs found with the standard pattern")
         # Try a simpler pattern as fallback
-        qa_pattern = r'(\d+)\.\s+([^\.]+\?)'
-        matches = list(re.finditer(qa_pattern, text))
+        matches = list(FALLBACK_QA_PATTERN.finditer(text))
         if matches:
             print(f"Found {len(matches)} Q&A pairs with simplified pattern")
 
-    # Process each matched question
-    for i, match in enumerate(matches):
-        q_num = match.group(1)
-        question = match.group(2).strip()
-        start_pos = match.start()
+    # Each answer ends where the next question starts, or at the end of text
+    return [
+        _qa_pair(text, match, matches[i + 1].start() if i < len(matches) - 1 else len(text))
+        for i, match in enumerate(matches)
+    ]
 
-        # Find where this answer ends (start of next question or end of text)
-        if i < len(matches) - 1:
-            end_pos = matches[i + 1].start()
-        else:
-            end_pos = len(text)
 
-        # Extract the full Q&A text
-        qa_text = text[start_pos:end_pos].strip()
+def iter_qa_pairs(pages, delimiter=PAGES_DELIMITER):
+    """
+    Yield the Q&A pairs of a document that arrives page by page
 
-        # Create metadata
-        metadata = {
-            "type": "qa",
-            "question_number": q_num,
-            "question": question
-        }
+    The pairs are the same as extract_qa_pairs(delimiter.join(pages)). Only
+    the text from the last question on is carried over to the next page, so
+    questions and answers running across a page seam stay whole, and it is
+    only scanned again from where a new question can start, so long stretches
+    without questions are not scanned once per page.
+    """
+    carry = ""
+    # No question starting before this offset of carry is still to be found
+    scan_from = 0
+    # Whether carry starts with a question found on an earlier page
+    carries_question = False
+
+    for page_number, page in enumerate(pages):
+        new_text = delimiter + page if page_number else page
+        carry += new_text
+
+        # Every question still to be found ends at a '?' of the new text
+        if "?" not in new_text:
+            continue
+
+        matches = [QA_PATTERN.match(carry)] if carries_question else []
+        start = max(scan_from, matches[0].end()) if matches else scan_from
+        matches += QA_PATTERN.finditer(carry, start)
+        if not matches:
+            scan_from = _next_scan_from(carry, start)
+            continue
+
+        # Pairs before the last question are complete
+        for i in range(len(matches) - 1):
+            yield _qa_pair(carry, matches[i], matches[i + 1].start())
+        carry = carry[matches[-1].start():]
+        carries_question = True
+        scan_from = _next_scan_from(carry, matches[-1].end() - matches[-1].start())
+
+    # The last pair runs to the end of the text. If no page had a standard
+    # question, carry is still the whole text and gets the fallback pattern.
+    yield from extract_qa_pairs(carry)
+
+
+def _next_scan_from(text, start):
+    """
+    Offset of text, from start on, where a question ending in text appended later can start
 
-        # Add to results
-        qa_chunks.append(Document(page_content=qa_text, metadata=metadata))
+    Such a question has no '?' before its end, so it starts after the last
+    '?' of text, where a question start is complete or cut off at the end.
+    """
+    start = max(start, text.rfind("?", start) + 1)
+    offsets = [len(text)]
+    for pattern in (QUESTION_START_PATTERN, CUT_OFF_QUESTION_START_PATTERN):
+        match = pattern.search(text, start)
+        if match:
+            offsets.append(match.start())
+    return min(offsets)
 
-    return qa_chunks
+
+def _qa_pair(text, match, end_pos):
+    """Create the document of one Q&A pair running from a question match to end_pos"""
+    # Extract the full Q&A text
+    qa_text = text[match.start():end_pos].strip()
+
+    # Create metadata
+    metadata = {
+        "type": "qa",
+        "question_number": match.group(1),
+        "question": match.group(2).strip()
+    }
+
+    return Document(page_content=qa_text, metadata=metadata)
 
 
 def display_samples(chunks, num_samples):
@@ -142,15 +211,19 @@ def display_samples(chunks, num_samples):
         print(f"{'=' * 60}")
 
 
-def eval_specific_question(chunks, question_text):
-    """Test retrieval for a specific question"""
+def eval_specific_question(chunks, question_text, index=None):
+    """
+    Test retrieval for a specific question
+
+    Pass a LexicalIndex built once over the chunks when testing many questions.
+    """
     print(f"\nSEARCHING FOR: '{question_text}'")
 
+    if index is None:
+        index = LexicalIndex(chunks)
+
     # First, try exact matching
-    exact_matches = []
-    for chunk in chunks:
-        if question_text.lower() in chunk.metadata['question'].lower():
-            exact_matches.append(chunk)
+    exact_matches = [index.chunks[i] for i in index.exact(question_text)]
 
     if exact_matches:
         print(f"Found {len(exact_matches)} matches containing this question")
@@ -180,15 +253,8 @@ def eval_specific_question(chunks, question_text):
         # Try word matching
         print("No exact matches found. Trying partial matching...")
 
-        query_words = set(question_text.lower().split())
-        best_matches = []
-
-        for chunk in chunks:
-            chunk_words = set(chunk.metadata['question'].lower().split())
-            common_words = query_words.intersection(chunk_words)
-
-            if len(common_words) >= 2:  # At least two words in common
-                best_matches.append((chunk, len(common_words)))
+        # At least two words in common
+        best_matches = [(index.chunks[i], common) for i, common, _ in index.fuzzy(question_text, min_common=2)]
 
         # Sort by number of matching words, descending
         best_matches.sort(key=lambda x: x[1], reverse=True)
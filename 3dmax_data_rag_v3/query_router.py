@@ -0,0 +1,92 @@
+"""
+Keyword router for the 3D Max RAG system.
+
+Before the vector search, a question is classified with cheap local rules:
+an explicit question or section number, a chapter name it mentions, and
+whether it asks about the interface (UI explanation chunks) or is a numbered-
+question style "Как ...?" question (Q&A chunks). The result is a Chroma `where`
+filter, so the similarity search only scores the matching subset.
+"""
+import re
+
+from custom_splitter import QUESTION_WORDS
+
+# Word stems of questions about the program interface
+UI_STEMS = ("панел", "окн", "меню", "кнопк", "вкладк", "интерфейс", "значок", "иконк", "свиток",
+            "toolbar", "вьюпорт", "viewport")
+
+QUESTION_START_PATTERN = re.compile(r'\s*' + QUESTION_WORDS + r'\b', re.IGNORECASE)
+QUESTION_NUMBER_PATTERN = re.compile(r'вопрос\w*\s*(?:№\s*)?(\d+)', re.IGNORECASE)
+SECTION_NUMBER_PATTERN = re.compile(r'(?<![\d.])(\d+\.\d+)(?![\d])')
+WORD_PATTERN = re.compile(r'\w+')
+
+# Shorter chapter names match too many questions by accident
+MIN_CHAPTER_NAME_LENGTH = 4
+
+
+class QueryRouter:
+    """Maps a question to a Chroma metadata filter over chapter and chunk type."""
+
+    def __init__(self, chapters=(), types=()):
+        """
+        Args:
+            chapters: Chapter names present in the vector store
+            types: Chunk types present in the vector store
+        """
+        # Longest names first, so "Моделирование сплайнов" wins over "Моделирование"
+        self.chapters = sorted(
+            (name for name in set(chapters) if len(name) >= MIN_CHAPTER_NAME_LENGTH), key=len, reverse=True
+        )
+        self.types = set(types)
+
+    @classmethod
+    def from_vectorstore(cls, vectorstore):
+        """Build a router from the chapters and chunk types stored in a Chroma collection."""
+        metadatas = vectorstore.get(include=["metadatas"])["metadatas"]
+        chapters = {metadata.get("chapter") for metadata in metadatas if metadata.get("chapter")}
+        types = {metadata.get("type") for metadata in metadatas if metadata.get("type")}
+        return cls(chapters, types)
+
+    def _chunk_type(self, question, words):
+        """Chunk type the question asks for, or None if the rules are not sure."""
+        if "ui_explanation" in self.types and any(word.startswith(UI_STEMS) for word in words):
+            return "ui_explanation"
+        if "qa" in self.types and QUESTION_START_PATTERN.match(question):
+            return "qa"
+        return None
+
+    def route(self, question):
+        """
+        Classify a question.
+
+        Returns:
+            dict: Chroma `where` filter, or None to search the whole collection
+        """
+        lowered = question.lower()
+        conditions = []
+
+        # A chapter named in the question
+        for chapter in self.chapters:
+            if chapter.lower() in lowered:
+                conditions.append({"chapter": chapter})
+                break
+
+        # Explicit numbers pin the chunk type as well
+        question_number = QUESTION_NUMBER_PATTERN.search(question)
+        section_number = SECTION_NUMBER_PATTERN.search(question)
+        if question_number and "qa" in self.types:
+            conditions.append({"type": "qa"})
+            conditions.append({"question_number": question_number.group(1)})
+        elif section_number and "ui_explanation" in self.types:
+            conditions.append({"type": "ui_explanation"})
+            conditions.append({"section_number": section_number.group(1)})
+        else:
+            chunk_type = self._chunk_type(question, WORD_PATTERN.findall(lowered))
+            if chunk_type:
+                conditions.append({"type": chunk_type})
+
+        if not conditions:
+            return None
+        if len(conditions) == 1:
+            return conditions[0]
+        return {"$and": conditions}
@@ -2,8 +2,12 @@
 3D Max RAG System - A complete question answering system for 3D Max documentation
 with chapter-aware document processing
 """
+import asyncio
+import hashlib
 import os
 import shutil
+import time
+from itertools import islice
 from dotenv import load_dotenv
 from pathlib import Path
 
@@ -12,13 +16,19 @@ from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader
 from langchain.chat_models import init_chat_model
 from langchain_cohere import CohereEmbeddings
 from langchain_chroma import Chroma
-from langchain.schema.runnable import RunnablePassthrough
 from langchain.prompts import ChatPromptTemplate
-from langchain.schema.output_parser import StrOutputParser
 from langchain.docstore.document import Document
 
-# Import our custom splitter
-from custom_splitter import ChapterAwareMaxSplitter
+# Import our custom splitter and embedding cache
+from custom_splitter import ChapterAwareMaxSplitter, chunk_answer
+from cached_embeddings import CachedEmbeddings, HashingEmbeddings, PROVIDER_MAX_BATCH_SIZE
+from answer_cache import SemanticAnswerCache
+from query_router import QueryRouter
+from reranker import RerankStage
+from pdf_stream import PAGES_DELIMITER, cached_pdf_pages
+from text_cache import DEFAULT_CACHE_DIR, TextCache
+from fake_llm import FakeChatModel
+from context_packer import ContextPacker
 
 # Load environment variables
 load_dotenv()
@@ -28,13 +38,31 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 COHERE_API_KEY = os.getenv("COHERE_API_KEY")
 
 
+def chunk_id(chunk):
+    """
+    Deterministic Chroma ID of a chunk: chapter, question/section number and content hash.
+
+    An edited chunk gets a new ID, an unchanged one keeps its ID across rebuilds.
+    """
+    metadata = chunk.metadata
+    number = metadata.get("question_number") or metadata.get("section_number") or metadata.get("type", "general")
+    content_hash = hashlib.sha256(chunk.page_content.encode("utf-8")).hexdigest()[:16]
+    return f"{metadata.get('chapter', '')}:{number}:{content_hash}"
+
+
 class ThreeDMaxRAG:
     """
     A RAG-based question answering system for 3D Max documentation
     with chapter-aware document processing
     """
 
-    def __init__(self, doc_path, doc_type="pdf", db_path="./chroma_db_aware_v1", rebuild_db=False):
+    def __init__(self, doc_path, doc_type="pdf", db_path="./chroma_db_aware_v1", rebuild_db=False,
+                 index_batch_size=4 * PROVIDER_MAX_BATCH_SIZE, splitter_workers=None, update_db=False,
+                 embedding_cache_path="./embedding_cache.sqlite", embed_concurrency=4,
+                 requests_per_minute=100, fake_embeddings=False, answer_cache_size=512,
+                 answer_cache_ttl=24 * 3600, answer_cache_threshold=0.92, route_queries=True,
+                 reranker="lexical", candidate_k=50, rerank_budget_ms=200, stream_pdf=True, pdf_workers=None,
+                 text_cache_dir=DEFAULT_CACHE_DIR, fake_llm=False, context_tokens=1500):
         """
         Initialize the 3D Max RAG system
 
@@ -43,20 +71,80 @@ class ThreeDMaxRAG:
             doc_type: Type of document (pdf or docx)
             db_path: Path to store/load the Chroma vector database
             rebuild_db: Whether to rebuild the vector database even if it exists
+            index_batch_size: Chunks embedded and written to Chroma at a time when building
+            splitter_workers: Split chapters in this many worker processes (sequential if None)
+            update_db: Re-index an existing database incrementally, embedding only changed chunks
+            embedding_cache_path: sqlite file caching chunk and query embeddings (no cache if None)
+            embed_concurrency: Embedding requests sent to the provider at once
+            requests_per_minute: Embedding request limit of the provider
+            fake_embeddings: Use local hashing embeddings instead of Cohere, for offline testing
+            answer_cache_size: Answers kept for paraphrased questions (no answer cache if 0)
+            answer_cache_ttl: Seconds a cached answer stays valid
+            answer_cache_threshold: Question similarity needed to reuse a cached answer
+            route_queries: Restrict retrieval to the chapter/chunk type a question asks about
+            reranker: Second retrieval stage, "lexical" or "cross-encoder" (single stage if None)
+            candidate_k: Candidates fetched by the vector search for the reranker
+            rerank_budget_ms: Latency budget of the rerank stage
+            stream_pdf: Extract PDF pages in parallel and split them as they arrive
+            pdf_workers: Processes extracting PDF pages, defaults to the number of CPUs
+            text_cache_dir: Directory caching the text extracted from the document (no cache if None)
+            fake_llm: Answer with a local fake model instead of gpt-4o-mini, for offline testing
+            context_tokens: Token budget of the documentation in the prompt (whole chunks if None)
         """
         self.doc_path = doc_path
         self.doc_type = doc_type.lower()
         self.db_path = db_path
         self.rebuild_db = rebuild_db
-
-        # Initialize language model
-        self.llm = init_chat_model("gpt-4o-mini", model_provider="openai")
+        self.update_db = update_db
+        self.index_batch_size = index_batch_size
+        self.splitter_workers = splitter_workers
+        self.route_queries = route_queries
+        self.candidate_k = candidate_k
+        self.stream_pdf = stream_pdf
+        self.pdf_workers = pdf_workers
+        self.text_cache = TextCache(text_cache_dir) if text_cache_dir else None
+
+        # Initialize language model, reporting token usage when streaming too
+        if fake_llm:
+            self.llm = FakeChatModel()
+        else:
+            self.llm = init_chat_model("gpt-4o-mini", model_provider="openai", stream_usage=True)
 
         # Initialize embeddings
-        self.embeddings = CohereEmbeddings(
-            model="embed-multilingual-v3.0",
-            cohere_api_key=COHERE_API_KEY
-        )
+        if fake_embeddings:
+            self.embeddings = HashingEmbeddings()
+        else:
+            self.embeddings = CohereEmbeddings(
+                model="embed-multilingual-v3.0",
+                cohere_api_key=COHERE_API_KEY
+            )
+
+        # Cache embeddings outside the database directory, so a rebuild reuses them
+        if embedding_cache_path:
+            self.embeddings = CachedEmbeddings(
+                self.embeddings,
+                path=embedding_cache_path,
+                max_concurrency=embed_concurrency,
+                # The local fake embedder has no provider limit to respect
+                requests_per_minute=None if fake_embeddings else requests_per_minute
+            )
+
+        # Paraphrases of an answered question with the same context reuse its answer
+        self.answer_cache = None
+        if answer_cache_size:
+            self.answer_cache = SemanticAnswerCache(
+                max_size=answer_cache_size,
+                ttl=answer_cache_ttl,
+                threshold=answer_cache_threshold
+            )
+
+        # Rerank a wide candidate set and keep only the best chunks for the prompt
+        self.rerank_stage = None
+        if reranker:
+            self.rerank_stage = RerankStage(reranker, budget_ms=rerank_budget_ms)
+
+        # Keep the prompt within a token budget however large the retrieved chunks are
+        self.context_packer = ContextPacker(context_tokens) if context_tokens else None
 
         # Setup the vector database and retriever
         self._setup_vectorstore()
@@ -70,13 +158,19 @@ class ThreeDMaxRAG:
 
         if self.doc_type == "pdf":
             loader = PyPDFLoader(self.doc_path, mode="single")
-            documents = loader.load()
+            loader_options = {"mode": "single"}
         elif self.doc_type == "docx":
             loader = Docx2txtLoader(self.doc_path)
-            documents = loader.load()
+            loader_options = {}
         else:
             raise ValueError(f"Unsupported document type: {self.doc_type}")
 
+        # Parsing is skipped when the same file was loaded the same way before
+        if self.text_cache is not None:
+            documents = self.text_cache.documents(self.doc_path, type(loader).__name__, loader_options, loader.load)
+        else:
+            documents = loader.load()
+
         # Combine all pages into a single document if needed
         if len(documents) > 1:
             full_text = "\n".join([doc.page_content for doc in documents])
@@ -89,42 +183,106 @@ class ThreeDMaxRAG:
         """Set up the vector database, loading or creating it as needed"""
         db_exists = Path(self.db_path).exists() and any(Path(self.db_path).iterdir())
 
-        if db_exists and not self.rebuild_db:
+        if db_exists and not (self.rebuild_db or self.update_db):
             print(f"Loading existing vector database from {self.db_path}")
             self.vectorstore = Chroma(
                 persist_directory=self.db_path,
                 embedding_function=self.embeddings
             )
         else:
-            print(f"Creating new vector database at {self.db_path}")
+            if db_exists and not self.rebuild_db:
+                print(f"Updating vector database at {self.db_path}")
+            else:
+                print(f"Creating new vector database at {self.db_path}")
 
             # If rebuilding and db exists, delete it first
             if db_exists and self.rebuild_db:
                 print(f"Removing existing database at {self.db_path}")
                 shutil.rmtree(self.db_path)
 
-            # Load and process the document
-            documents = self._load_document()
-
-            # Use our custom chapter-aware splitter
-            splitter = ChapterAwareMaxSplitter()
-            chunks = splitter.split_documents(documents)
-            print(f"Created {len(chunks)} chunks with chapter-aware splitting")
-
-            # Create the vector store
-            self.vectorstore = Chroma.from_documents(
-                documents=chunks,
-                embedding=self.embeddings,
-                persist_directory=self.db_path
+            # Create the vector store, or open the one being updated
+            self.vectorstore = Chroma(
+                persist_directory=self.db_path,
+                embedding_function=self.embeddings
             )
-            print(f"Vector database created and stored at {self.db_path}")
+            self._index_documents()
 
         # Create a retriever
+        self.retrieval_k = 3  # Retrieve top 3 most relevant chunks
         self.retriever = self.vectorstore.as_retriever(
             search_type="similarity",
-            search_kwargs={"k": 3}  # Retrieve top 3 most relevant chunks
+            search_kwargs={"k": self.retrieval_k}
         )
 
+        # Route questions to the chapters and chunk types present in the store
+        self.router = None
+        if self.route_queries:
+            self.router = QueryRouter.from_vectorstore(self.vectorstore)
+            print(f"Query routing over {len(self.router.chapters)} chapters, "
+                  f"chunk types: {', '.join(sorted(self.router.types))}")
+
+    def _index_documents(self):
+        """
+        Bring the vector store in line with the document.
+
+        Chunks are stored under deterministic IDs (see chunk_id). Chunks whose ID
+        is already in the store are skipped, new or edited ones are embedded and
+        added, and IDs no longer produced by the document are deleted.
+        """
+        # IDs already in the store, empty for a new database
+        existing_ids = set(self.vectorstore.get(include=[])["ids"])
+
+        # Stream chunks from our custom chapter-aware splitter into the store in
+        # bounded batches, so only one batch is held in memory at a time
+        splitter = ChapterAwareMaxSplitter(
+            verbose=False,
+            parallel=bool(self.splitter_workers),
+            max_workers=self.splitter_workers
+        )
+        if self.doc_type == "pdf" and self.stream_pdf:
+            # Pages are extracted by worker processes and split as they arrive
+            print(f"Streaming document: {self.doc_path}")
+            pages = cached_pdf_pages(self.doc_path, self.text_cache, max_workers=self.pdf_workers)
+            chunks = splitter.split_pages(pages, {"source": self.doc_path}, delimiter=PAGES_DELIMITER)
+        else:
+            # Load and process the document
+            chunks = splitter.lazy_split_documents(self._load_document())
+
+        current_ids = set()
+        num_chunks = 0
+        num_added = 0
+        while True:
+            batch = list(islice(chunks, self.index_batch_size))
+            if not batch:
+                break
+            num_chunks += len(batch)
+
+            # Only chunks that are not stored yet cost embedding calls
+            new_chunks = {}
+            for chunk in batch:
+                doc_id = chunk_id(chunk)
+                if doc_id not in existing_ids and doc_id not in current_ids:
+                    new_chunks[doc_id] = chunk
+                current_ids.add(doc_id)
+
+            if new_chunks:
+                self.vectorstore.add_documents(list(new_chunks.values()), ids=list(new_chunks))
+                num_added += len(new_chunks)
+
+        # Chunks that were edited or removed from the document
+        orphan_ids = list(existing_ids - current_ids)
+        for start in range(0, len(orphan_ids), self.index_batch_size):
+            self.vectorstore.delete(ids=orphan_ids[start:start + self.index_batch_size])
+
+        print(f"Created {num_chunks} chunks with chapter-aware splitting")
+        print(f"Embedded {num_added} new or changed chunks, kept {len(existing_ids & current_ids)} unchanged, "
+              f"deleted {len(orphan_ids)} orphaned")
+        if isinstance(self.embeddings, CachedEmbeddings):
+            stats = self.embeddings.stats()
+            print(f"Embedding cache: {stats['hits']} hits, {stats['misses']} misses, "
+                  f"{stats['requests']} provider requests")
+        print(f"Vector database created and stored at {self.db_path}")
+
     def _setup_rag_chain(self):
         """Set up the RAG chain for question answering"""
         # Create prompt template
@@ -147,61 +305,181 @@ class ThreeDMaxRAG:
 
         self.prompt = ChatPromptTemplate.from_template(template)
 
-        # Define the RAG chain
-        self.rag_chain = (
-            {"context": self.retriever | self._format_docs, "question": RunnablePassthrough()}
-            | self.prompt
-            | self.llm
-            | StrOutputParser()
-        )
+        # Prompt and model for an already retrieved context, used by ask and friends
+        self.answer_chain = self.prompt | self.llm
 
-    def _format_docs(self, docs):
-        """Format retrieved documents for the prompt"""
-        formatted_docs = []
+    def _format_doc(self, doc):
+        """
+        Header and body of one retrieved chunk in the prompt
 
-        for i, doc in enumerate(docs):
-            # Get metadata
-            chapter = doc.metadata.get("chapter", "Неизвестная глава")
-            doc_type = doc.metadata.get("type", "general")
+        Answers are located at split time (answer_start in the metadata), so
+        every chunk is assembled by string joins without searching its content.
+        """
+        metadata = doc.metadata
+        chapter = metadata.get("chapter", "Неизвестная глава")
+        doc_type = metadata.get("type", "general")
+
+        if doc_type == "qa":
+            # Format as Q&A pair
+            answer_text = chunk_answer(doc)
+            header = ["\n\n[Глава: ", chapter, "] [Вопрос №", metadata.get("question_number", "?"), "]:\n",
+                      metadata.get("question", ""), "\n"]
+            if answer_text is not None:
+                return "".join(header + ["Ответ: "]), answer_text
+            return "".join(header + ["Содержимое: "]), doc.page_content
+
+        if doc_type == "ui_explanation":
+            # Format as UI explanation
+            header = ["\n\n[Глава: ", chapter, "] [Раздел: ", metadata.get("section_title", ""), "]:\n"]
+            return "".join(header), doc.page_content
+
+        # Format general content
+        return "".join(["\n\n[Глава: ", chapter, "]:\n"]), doc.page_content
+
+    def _format_docs(self, docs, question=None):
+        """
+        Format retrieved documents for the prompt
 
-            if doc_type == "qa":
-                question_num = doc.metadata.get("question_number", "?")
-                question = doc.metadata.get("question", "")
+        The documents come best first. With a context budget they are packed
+        into it in that order, shortening the ones that do not fit to the
+        sentences closest to the question.
 
-                # Format as Q&A pair
-                formatted_doc = f"[Глава: {chapter}] [Вопрос №{question_num}]:\n{question}\n"
+        Returns:
+            tuple: (context text, packing stats from ContextPacker.pack, empty
+                    without a context budget)
+        """
+        chunks = [self._format_doc(doc) for doc in docs]
 
-                # Extract answer (everything after the question)
-                content = doc.page_content
-                question_index = content.find(question)
+        stats = {}
+        if self.context_packer is not None:
+            chunks, stats = self.context_packer.pack(chunks, question)
 
-                if question_index != -1:
-                    answer_text = content[question_index + len(question):].strip()
-                    # Look for "Ответ:" marker
-                    if "Ответ:" in answer_text:
-                        answer_text = answer_text.split("Ответ:", 1)[1].strip()
-                    formatted_doc += f"Ответ: {answer_text}"
-                else:
-                    formatted_doc += f"Содержимое: {content}"
+        return "".join(part for chunk in chunks for part in chunk) if chunks else "\n\n", stats
 
-            elif doc_type == "ui_explanation":
-                section_title = doc.metadata.get("section_title", "")
-                section_num = doc.metadata.get("section_number", "")
+    def ask(self, question):
+        """
+        Ask a question about 3D Max
 
-                # Format as UI explanation
-                formatted_doc = f"[Глава: {chapter}] [Раздел: {section_title}]:\n{doc.page_content}"
+        Args:
+            question: The question to ask
 
-            else:
-                # Format general content
-                formatted_doc = f"[Глава: {chapter}]:\n{doc.page_content}"
+        Returns:
+            str: The answer to the question
+        """
+        docs, embedding, _ = self._retrieve(question)
 
-            formatted_docs.append(formatted_doc)
+        answer = self._cached_answer(docs, embedding)
+        if answer is None:
+            prompt_input, _ = self._prompt_input(question, docs)
+            message = self.answer_chain.invoke(prompt_input)
+            answer = message.content
+            self._remember_answer(question, docs, embedding, message)
 
-        return "\n\n" + "\n\n".join(formatted_docs)
+        return answer
 
-    def ask(self, question):
+    def _route(self, question):
+        """Chroma metadata filter for a question, or None to search everything"""
+        return self.router.route(question) if self.router is not None else None
+
+    def _retrieve(self, question, k=None):
         """
-        Ask a question about 3D Max
+        Embed the question once and retrieve its context
+
+        The vector search fetches candidate_k candidates when a reranker is set,
+        which then keeps the best k.
+
+        Returns:
+            tuple: (docs, question embedding, stage timings for format_timings)
+        """
+        k = k or self.retrieval_k
+        timings = {}
+
+        start = time.perf_counter()
+        embedding = self.embeddings.embed_query(question)
+        timings["embed"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        docs = self._vector_search(question, embedding, k)
+        timings["search"] = time.perf_counter() - start
+        timings["candidates"] = len(docs)
+
+        if self.rerank_stage is not None:
+            start = time.perf_counter()
+            docs, timings["scored"] = self.rerank_stage.rerank(question, docs, k)
+            timings["rerank"] = time.perf_counter() - start
+
+        return docs[:k], embedding, timings
+
+    async def _aretrieve(self, question, k=None):
+        """Async version of _retrieve, with the search and rerank run in threads"""
+        k = k or self.retrieval_k
+        timings = {}
+
+        start = time.perf_counter()
+        embedding = await self.embeddings.aembed_query(question)
+        timings["embed"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        docs = await asyncio.to_thread(self._vector_search, question, embedding, k)
+        timings["search"] = time.perf_counter() - start
+        timings["candidates"] = len(docs)
+
+        if self.rerank_stage is not None:
+            start = time.perf_counter()
+            docs, timings["scored"] = await asyncio.to_thread(self.rerank_stage.rerank, question, docs, k)
+            timings["rerank"] = time.perf_counter() - start
+
+        return docs[:k], embedding, timings
+
+    def _vector_search(self, question, embedding, k):
+        """
+        First retrieval stage: the nearest chunks, or a wider candidate set for the reranker
+
+        The search is filtered to the routed subset of the collection and falls
+        back to the whole collection when the subset has fewer than k chunks.
+        """
+        num_candidates = max(self.candidate_k, k) if self.rerank_stage is not None else k
+
+        where = self._route(question)
+        if where is not None:
+            docs = self.vectorstore.similarity_search_by_vector(embedding, k=num_candidates, filter=where)
+            if len(docs) >= k:
+                return docs
+
+        return self.vectorstore.similarity_search_by_vector(embedding, k=num_candidates)
+
+    def format_timings(self, timings):
+        """One-line report of the retrieval stage timings"""
+        parts = [f"{stage} {timings[stage] * 1000:.0f} ms" for stage in ("embed", "search", "rerank")
+                 if stage in timings]
+        if "scored" in timings:
+            parts.append(f"{timings['scored']}/{timings['candidates']} candidates scored")
+        return ", ".join(parts)
+
+    def _prompt_input(self, question, docs):
+        """Prompt variables for a question and its retrieved context, and the context packing stats"""
+        context, stats = self._format_docs(docs, question)
+        return {"context": context, "question": question}, stats
+
+    def _cached_answer(self, docs, embedding):
+        """Answer of an earlier paraphrase with the same context, or None"""
+        if self.answer_cache is None:
+            return None
+        return self.answer_cache.get([chunk_id(doc) for doc in docs], embedding)
+
+    def _remember_answer(self, question, docs, embedding, message):
+        """Store a generated answer along with the tokens it cost"""
+        if self.answer_cache is None:
+            return
+        usage = getattr(message, "usage_metadata", None) or {}
+        self.answer_cache.put(
+            [chunk_id(doc) for doc in docs], embedding, question, message.content,
+            tokens=usage.get("total_tokens", 0)
+        )
+
+    async def aask(self, question):
+        """
+        Ask a question about 3D Max without blocking the event loop
 
         Args:
             question: The question to ask
@@ -209,7 +487,118 @@ class ThreeDMaxRAG:
         Returns:
             str: The answer to the question
         """
-        return self.rag_chain.invoke(question)
+        return (await self.aask_detailed(question))["answer"]
+
+    async def aask_detailed(self, question, k=None):
+        """
+        Answer a question and report how the answer was produced
+
+        Args:
+            question: The question to ask
+            k: Chunks to retrieve (retrieval_k if None), the prompt gets the first retrieval_k
+
+        Returns:
+            dict: answer, retrieved docs, whether the answer was cached, token usage,
+                  stage timings in seconds and the packed context tokens (None
+                  if cached or without a context budget)
+        """
+        start = time.perf_counter()
+        docs, embedding, timings = await self._aretrieve(question, k=k)
+        timings["retrieval"] = time.perf_counter() - start
+        context = docs[:self.retrieval_k]
+
+        usage = {}
+        context_tokens = None
+        answer = self._cached_answer(context, embedding)
+        cached = answer is not None
+        if not cached:
+            start = time.perf_counter()
+            prompt_input, context_stats = self._prompt_input(question, context)
+            context_tokens = context_stats.get("tokens")
+            message = await self.answer_chain.ainvoke(prompt_input)
+            timings["generation"] = time.perf_counter() - start
+            answer = message.content
+            usage = dict(getattr(message, "usage_metadata", None) or {})
+            self._remember_answer(question, context, embedding, message)
+
+        return {"answer": answer, "docs": docs, "cached": cached, "usage": usage, "timings": timings,
+                "context_tokens": context_tokens}
+
+    async def stream_ask(self, question, timings=None):
+        """
+        Ask a question about 3D Max and yield the answer as it is generated
+
+        Args:
+            question: The question to ask
+            timings: Dict that receives the retrieval stage timings, if given
+
+        Yields:
+            str: Answer tokens as they arrive from the model
+        """
+        docs, embedding, retrieval_timings = await self._aretrieve(question)
+        if timings is not None:
+            timings.update(retrieval_timings)
+
+        # A cached answer arrives in one piece
+        answer = self._cached_answer(docs, embedding)
+        if answer is not None:
+            yield answer
+            return
+
+        # Sum the chunks to get the full message with its token usage
+        message = None
+        prompt_input, _ = self._prompt_input(question, docs)
+        async for chunk in self.answer_chain.astream(prompt_input):
+            message = chunk if message is None else message + chunk
+            yield chunk.content
+
+        if message is not None:
+            self._remember_answer(question, docs, embedding, message)
+
+    async def abatch_ask(self, questions, max_concurrency=8):
+        """
+        Answer many questions concurrently from one process
+
+        Within one question retrieval finishes before the prompt is built and
+        the model is called; the concurrency is across questions.
+
+        Args:
+            questions: The questions to ask
+            max_concurrency: Questions in flight at once
+
+        Returns:
+            list: Answers in the order of the questions, or the exception raised for a question
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def answer(question):
+            async with semaphore:
+                return await self.aask(question)
+
+        return await asyncio.gather(*(answer(question) for question in questions), return_exceptions=True)
+
+    async def print_streamed_answer(self, question, prefix="\nОтвет: "):
+        """
+        Print the answer to a question token by token
+
+        Returns:
+            tuple: (answer, seconds to the first token, total seconds, retrieval stage timings)
+        """
+        start = time.perf_counter()
+        first_token_time = None
+        tokens = []
+        timings = {}
+
+        print(prefix, end="", flush=True)
+        async for token in self.stream_ask(question, timings):
+            if first_token_time is None:
+                first_token_time = time.perf_counter() - start
+            tokens.append(token)
+            print(token, end="", flush=True)
+        print()
+
+        total_time = time.perf_counter() - start
+        return "".join(tokens), first_token_time, total_time, timings
 
     def test_retrieval(self, query, k=3):
         """
@@ -223,10 +612,17 @@ class ThreeDMaxRAG:
             List of retrieved documents
         """
         print(f"\nТестовый запрос: '{query}'")
-        results = self.vectorstore.similarity_search(query, k=k)
+        print(f"Фильтр: {self._route(query)}")
+        results, _, timings = self._retrieve(query, k=k)
+        print(f"Этапы поиска: {self.format_timings(timings)}")
 
         print(f"Найдено {len(results)} релевантных фрагментов.")
 
+        if self.context_packer is not None:
+            _, context = self._format_docs(results, query)
+            print(f"Контекст: {context['tokens']} из {context['budget']} токенов, "
+                  f"сокращено {context['shortened']}, отброшено {context['dropped']}")
+
         for i, doc in enumerate(results):
             print(f"\nРезультат {i+1}:")
             print(f"Глава: {doc.metadata.get('chapter', 'Неизвестная глава')}")
@@ -238,18 +634,12 @@ class ThreeDMaxRAG:
                 question_num = doc.metadata.get("question_number", "?")
                 print(f"Вопрос №{question_num}: {question}")
 
-                # Extract answer
-                content = doc.page_content
-                question_index = content.find(question)
-
-                if question_index != -1:
-                    answer_text = content[question_index + len(question):].strip()
-                    # Look for "Ответ:" marker
-                    if "Ответ:" in answer_text:
-                        answer_text = answer_text.split("Ответ:", 1)[1].strip()
+                # Answer located at split time
+                answer_text = chunk_answer(doc)
+                if answer_text is not None:
                     print(f"Ответ: {answer_text[:200]}...")
                 else:
-                    print(f"Содержимое: {content[:200]}...")
+                    print(f"Содержимое: {doc.page_content[:200]}...")
 
             elif doc_type == "ui_explanation":
                 section_title = doc.metadata.get("section_title", "")
@@ -269,25 +659,38 @@ class ThreeDMaxRAG:
         print("Задайте вопрос о 3D Max или введите 'выход' для завершения.")
         print("="*50 + "\n")
 
-        while True:
-            user_question = input("\nВаш вопрос: ")
-
-            if user_question.lower() in ['выход', 'exit', 'quit', 'bye']:
-                print("\nСпасибо за использование ассистента по 3D Max. До свидания!")
-                break
-
-            if not user_question.strip():
-                print("Пожалуйста, введите вопрос или 'выход' для завершения.")
-                continue
-
-            try:
-                print("\nИщу ответ...")
-                answer = self.ask(user_question)
-                print(f"\nОтвет: {answer}")
-
-            except Exception as e:
-                print(f"\nИзвините, произошла ошибка: {str(e)}")
-                print("Пожалуйста, попробуйте еще раз или перефразируйте вопрос.")
+        # One event loop for the whole session, so the async model and
+        # embedding clients keep their connections between questions
+        loop = asyncio.new_event_loop()
+        try:
+            while True:
+                user_question = input("\nВаш вопрос: ")
+
+                if user_question.lower() in ['выход', 'exit', 'quit', 'bye']:
+                    if self.answer_cache is not None:
+                        stats = self.answer_cache.stats()
+                        print(f"\nКэш ответов: {stats['hits']} попаданий из {stats['hits'] + stats['misses']}, "
+                              f"сэкономлено {stats['saved_tokens']} токенов")
+                    print("\nСпасибо за использование ассистента по 3D Max. До свидания!")
+                    break
+
+                if not user_question.strip():
+                    print("Пожалуйста, введите вопрос или 'выход' для завершения.")
+                    continue
+
+                try:
+                    print("\nИщу ответ...")
+                    _, first_token_time, total_time, timings = loop.run_until_complete(
+                        self.print_streamed_answer(user_question))
+                    if first_token_time is not None:
+                        print(f"(первый токен через {first_token_time:.2f} с, ответ за {total_time:.2f} с; "
+                              f"{self.format_timings(timings)})")
+
+                except Exception as e:
+                    print(f"\nИзвините, произошла ошибка: {str(e)}")
+                    print("Пожалуйста, попробуйте еще раз или перефразируйте вопрос.")
+        finally:
+            loop.close()
 
 
 def main():
@@ -303,8 +706,50 @@ def main():
                         help="Path to the Chroma vector database")
     parser.add_argument("--rebuild", action="store_true",
                         help="Rebuild the vector database even if it exists")
+    parser.add_argument("--update", action="store_true",
+                        help="Update the vector database incrementally, re-embedding only changed chunks")
     parser.add_argument("--query", type=str,
                         help="Single query to test (non-interactive mode)")
+    parser.add_argument("--batch-size", type=int, default=4 * PROVIDER_MAX_BATCH_SIZE,
+                        help="Chunks embedded and stored at a time when building the database")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes for splitting chapters when building the database")
+    parser.add_argument("--pdf-workers", type=int, default=None,
+                        help="Processes extracting PDF pages when building the database")
+    parser.add_argument("--no-stream-pdf", action="store_true",
+                        help="Load the whole PDF before splitting instead of streaming its pages")
+    parser.add_argument("--text-cache", type=str, default=DEFAULT_CACHE_DIR,
+                        help="Directory caching the text extracted from the document")
+    parser.add_argument("--no-text-cache", action="store_true",
+                        help="Parse the document on every build")
+    parser.add_argument("--embedding-cache", type=str, default="./embedding_cache.sqlite",
+                        help="sqlite file caching embeddings across rebuilds")
+    parser.add_argument("--no-embedding-cache", action="store_true",
+                        help="Call the embedding provider for every chunk")
+    parser.add_argument("--embed-concurrency", type=int, default=4,
+                        help="Embedding requests sent to the provider at once")
+    parser.add_argument("--requests-per-minute", type=int, default=100,
+                        help="Embedding request limit of the provider")
+    parser.add_argument("--fake-embeddings", action="store_true",
+                        help="Use local hashing embeddings instead of Cohere (offline testing)")
+    parser.add_argument("--fake-llm", action="store_true",
+                        help="Answer with a local fake model instead of gpt-4o-mini (offline testing)")
+    parser.add_argument("--answer-cache-size", type=int, default=512,
+                        help="Answers cached for paraphrased questions (0 disables the cache)")
+    parser.add_argument("--answer-cache-ttl", type=int, default=24 * 3600,
+                        help="Seconds a cached answer stays valid")
+    parser.add_argument("--reranker", type=str, default="lexical", choices=["lexical", "cross-encoder", "none"],
+                        help="Second retrieval stage reranking the vector search candidates")
+    parser.add_argument("--candidates", type=int, default=50,
+                        help="Candidates fetched by the vector search for the reranker")
+    parser.add_argument("--rerank-budget-ms", type=int, default=200,
+                        help="Latency budget of the rerank stage in milliseconds")
+    parser.add_argument("--no-routing", action="store_true",
+                        help="Search the whole collection instead of the routed chapter/chunk type")
+    parser.add_argument("--answer-cache-threshold", type=float, default=0.92,
+                        help="Question similarity needed to reuse a cached answer")
+    parser.add_argument("--context-tokens", type=int, default=1500,
+                        help="Token budget of the documentation in the prompt (0 puts whole chunks in)")
 
     args = parser.parse_args()
 
@@ -313,7 +758,26 @@ def main():
         doc_path=args.doc,
         doc_type=args.type,
         db_path=args.db,
-        rebuild_db=args.rebuild
+        rebuild_db=args.rebuild,
+        index_batch_size=args.batch_size,
+        splitter_workers=args.workers,
+        update_db=args.update,
+        embedding_cache_path=None if args.no_embedding_cache else args.embedding_cache,
+        embed_concurrency=args.embed_concurrency,
+        requests_per_minute=args.requests_per_minute,
+        fake_embeddings=args.fake_embeddings,
+        answer_cache_size=args.answer_cache_size,
+        answer_cache_ttl=args.answer_cache_ttl,
+        answer_cache_threshold=args.answer_cache_threshold,
+        route_queries=not args.no_routing,
+        reranker=None if args.reranker == "none" else args.reranker,
+        candidate_k=args.candidates,
+        rerank_budget_ms=args.rerank_budget_ms,
+        stream_pdf=not args.no_stream_pdf,
+        pdf_workers=args.pdf_workers,
+        text_cache_dir=None if args.no_text_cache else args.text_cache,
+        fake_llm=args.fake_llm,
+        context_tokens=args.context_tokens or None
     )
 
     # Either run a test query or interactive session
@@ -321,8 +785,11 @@ def main():
         print(f"\nTesting query: {args.query}")
         rag.test_retrieval(args.query)
         print("\nGenerating answer...")
-        answer = rag.ask(args.query)
-        print(f"\nAnswer: {answer}")
+        _, first_token_time, total_time, timings = asyncio.run(
+            rag.print_streamed_answer(args.query, prefix="\nAnswer: "))
+        if first_token_time is not None:
+            print(f"(first token after {first_token_time:.2f}s, answer in {total_time:.2f}s; "
+                  f"{rag.format_timings(timings)})")
     else:
         rag.run_interactive()
 
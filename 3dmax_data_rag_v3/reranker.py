@@ -0,0 +1,138 @@
+"""
+Second retrieval stage for the 3D Max RAG system.
+
+The vector search fetches a wide candidate set cheaply; a reranker then scores
+every candidate against the question and only the best few go into the prompt.
+Candidates are scored in batches, in vector search order, under a latency
+budget that also covers the reranker's preparation (tokenizing the
+candidates for BM25). Once the budget is spent no further batch is started,
+and the unscored candidates keep their vector search order behind the
+scored ones. The scoring is pure Python for BM25, so it runs on the calling
+thread: threads would not make it faster.
+"""
+import math
+import re
+import time
+from collections import Counter
+
+WORD_PATTERN = re.compile(r'\w+')
+
+# Russian words are compared by their first letters, so "панели" matches "панель"
+STEM_LENGTH = 5
+
+
+def stems(text):
+    """Lowercase word stems of a text."""
+    return [word[:STEM_LENGTH] for word in WORD_PATTERN.findall(text.lower())]
+
+
+class LexicalReranker:
+    """
+    BM25 over the candidate set, computed locally with no model to load.
+
+    Term statistics come from the candidates themselves, which is enough to
+    tell apart chunks that merely share the topic from chunks that share the
+    question's rare terms.
+    """
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+
+    def prepare(self, question, docs):
+        """Shared state for scoring the candidates of one question."""
+        doc_terms = [Counter(stems(doc.page_content)) for doc in docs]
+        average_length = sum(sum(terms.values()) for terms in doc_terms) / max(len(doc_terms), 1)
+
+        query_terms = set(stems(question))
+        idf = {}
+        for term in query_terms:
+            frequency = sum(1 for terms in doc_terms if term in terms)
+            idf[term] = math.log(1 + (len(doc_terms) - frequency + 0.5) / (frequency + 0.5))
+        return doc_terms, average_length, idf
+
+    def score(self, question, docs, indices, state):
+        """Scores of the candidates at the given indices."""
+        doc_terms, average_length, idf = state
+        scores = []
+        for i in indices:
+            terms = doc_terms[i]
+            length_norm = 1 - self.b + self.b * sum(terms.values()) / max(average_length, 1e-9)
+            score = 0.0
+            for term, weight in idf.items():
+                frequency = terms.get(term, 0)
+                if frequency:
+                    score += weight * frequency * (self.k1 + 1) / (frequency + self.k1 * length_norm)
+            scores.append(score)
+        return scores
+
+
+class CrossEncoderReranker:
+    """Scores (question, chunk) pairs with a local sentence-transformers cross-encoder."""
+
+    def __init__(self, model_name="cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"):
+        # Optional dependency, only needed for this reranker
+        try:
+            from sentence_transformers import CrossEncoder
+        except ImportError as e:
+            raise ImportError("The cross-encoder reranker needs sentence-transformers: "
+                              "pip install sentence-transformers") from e
+        self.model = CrossEncoder(model_name)
+
+    def prepare(self, question, docs):
+        return None
+
+    def score(self, question, docs, indices, state):
+        pairs = [(question, docs[i].page_content) for i in indices]
+        return [float(score) for score in self.model.predict(pairs)]
+
+
+RERANKERS = {
+    "lexical": LexicalReranker,
+    "cross-encoder": CrossEncoderReranker,
+}
+
+
+class RerankStage:
+    """Runs a reranker over retrieval candidates within a latency budget."""
+
+    def __init__(self, reranker, top_n=3, budget_ms=200, batch_size=8):
+        """
+        Args:
+            reranker: A reranker from RERANKERS, or its name
+            top_n: Candidates kept for the prompt
+            budget_ms: Time preparation and scoring may take before unscored candidates are given up on
+            batch_size: Candidates scored between two budget checks
+        """
+        self.reranker = RERANKERS[reranker]() if isinstance(reranker, str) else reranker
+        self.top_n = top_n
+        self.budget_ms = budget_ms
+        self.batch_size = batch_size
+
+    def rerank(self, question, docs, top_n=None):
+        """
+        Reorder candidates by reranker score and keep the best top_n (self.top_n if None).
+
+        Returns:
+            tuple: (kept docs, number of candidates scored within the budget)
+        """
+        top_n = top_n or self.top_n
+        if len(docs) <= 1:
+            return list(docs), len(docs)
+
+        # Preparation is part of the stage, so it counts against the budget
+        deadline = time.perf_counter() + self.budget_ms / 1000
+        state = self.reranker.prepare(question, docs)
+
+        # Score batches in vector search order, so the best candidates are scored first;
+        # the budget is checked before each batch, a started batch always finishes
+        scores = {}
+        for start in range(0, len(docs), self.batch_size):
+            if time.perf_counter() >= deadline:
+                break
+            indices = range(start, min(start + self.batch_size, len(docs)))
+            scores.update(zip(indices, self.reranker.score(question, docs, indices, state)))
+
+        # Scored candidates by score, then the rest in their original order
+        order = sorted(range(len(docs)), key=lambda i: (i not in scores, -scores.get(i, 0.0), i))
+        return [docs[i] for i in order[:top_n]], len(scores)
@@ -0,0 +1,21 @@
+import pytest
+
+pytest.importorskip("langchain_core")
+
+from cached_embeddings import CachedEmbeddings, HashingEmbeddings
+
+
+def test_repeated_texts_are_one_lookup(tmp_path):
+    embeddings = CachedEmbeddings(HashingEmbeddings(16), path=str(tmp_path / "cache.sqlite"),
+                                  requests_per_minute=None)
+
+    vectors = embeddings.embed_documents(["как", "что", "как", "как"])
+    assert vectors[0] == vectors[2] == vectors[3]
+    assert embeddings.stats()["misses"] == 2
+    assert embeddings.stats()["hits"] == 0
+
+    embeddings.embed_documents(["как", "как", "где"])
+    stats = embeddings.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 3)
+    assert stats["hit_rate"] == 0.25
+    embeddings.close()
@@ -0,0 +1,96 @@
+import random
+
+import pytest
+
+pytest.importorskip("langchain")
+pytest.importorskip("langchain_community")
+
+from langchain.docstore.document import Document
+
+from custom_splitter import ChapterAwareMaxSplitter
+
+DOCUMENT = (
+    "Вступление без главы\n"
+    "--Основы моделирования--\n"
+    "1. Как создать сплайн?\nОтвет: Откройте панель Create. 2. Не вопрос.\n"
+    "2. Каким образом включить привязки?\nОтвет: Нажмите S.\n"
+    "3. В чем разница между Edit Poly и Editable Poly?\nОтвет: В стеке модификаторов.\n"
+    "--Интерфейс--\n"
+    "1.1. Главное меню\nСодержит команды.\n"
+    "1.2. Панель команд\nСодержит вкладки. 12. Как? нет\n"
+    "--Благодарности--\n"
+    "Спасибо всем.\n"
+)
+
+# Pieces the random documents are made of: markers, numbers, question words, separators
+TOKENS = ["--", "-", "Глава", "1", "2", "12", ".", " ", " ", "\n", "Как", "Что", "Каким", "?", "x",
+          "В чем", "1.1.", "2.3. ", "3. ", "Ответ:", "\t"]
+
+
+def reference_split(splitter, text, metadata):
+    """Chunks of the chapter-by-chapter path the scanner replaced"""
+    chapters = splitter._identify_chapters(text)
+    if not chapters:
+        return [Document(page_content=text, metadata=metadata)]
+
+    chunks = []
+    for name, content in chapters:
+        if splitter._is_qa_chapter(content):
+            chunks += splitter._process_qa_content(name, content, metadata)
+        elif splitter._is_ui_chapter(content):
+            chunks += splitter._process_ui_content(name, content, metadata)
+        else:
+            chunks.append(Document(page_content=content, metadata={**metadata, "chapter": name, "type": "general"}))
+    return chunks
+
+
+def as_tuples(chunks):
+    return [(chunk.page_content, chunk.metadata) for chunk in chunks]
+
+
+def random_documents(count, seed=0):
+    rng = random.Random(seed)
+    return ["".join(rng.choice(TOKENS) for _ in range(rng.randint(0, 60))) for _ in range(count)]
+
+
+def test_scanner_matches_reference_split():
+    splitter = ChapterAwareMaxSplitter(verbose=False)
+    chunks = splitter.split_documents([Document(page_content=DOCUMENT, metadata={"source": "s"})])
+
+    assert as_tuples(chunks) == as_tuples(reference_split(splitter, DOCUMENT, {"source": "s"}))
+    assert [chunk.metadata["type"] for chunk in chunks] == ["qa"] * 3 + ["ui_explanation"] * 2 + ["general"]
+
+
+def test_scanner_matches_reference_split_on_random_documents(capsys):
+    splitter = ChapterAwareMaxSplitter(verbose=False)
+    for text in random_documents(2000):
+        document = Document(page_content=text, metadata={"source": "s"})
+        expected = as_tuples(reference_split(splitter, text, {"source": "s"}))
+        assert as_tuples(splitter.split_documents([document])) == expected, text
+        assert as_tuples(splitter.lazy_split_documents([document])) == expected, text
+
+
+def assert_pages_same_as_joined(splitter, pages, delimiter):
+    document = Document(page_content=delimiter.join(pages), metadata={"source": "s"})
+    expected = as_tuples(splitter.lazy_split_documents([document]))
+    assert as_tuples(splitter.split_pages(iter(pages), {"source": "s"}, delimiter=delimiter)) == expected, \
+        (pages, delimiter)
+    return expected
+
+
+def test_split_pages_across_seams(capsys):
+    splitter = ChapterAwareMaxSplitter(verbose=False)
+    # Cut inside both chapter markers, an answer and a question
+    pages = [DOCUMENT[:30], DOCUMENT[30:70], DOCUMENT[70:200], DOCUMENT[200:260], "", DOCUMENT[260:]]
+
+    chunks = assert_pages_same_as_joined(splitter, pages, "")
+    assert chunks == as_tuples(splitter.split_documents([Document(page_content=DOCUMENT, metadata={"source": "s"})]))
+    assert_pages_same_as_joined(splitter, pages, "\n")
+
+
+def test_split_pages_on_random_pages(capsys):
+    splitter = ChapterAwareMaxSplitter(verbose=False)
+    rng = random.Random(1)
+    for _ in range(2000):
+        pages = ["".join(rng.choice(TOKENS) for _ in range(rng.randint(0, 15))) for _ in range(rng.randint(1, 8))]
+        assert_pages_same_as_joined(splitter, pages, rng.choice(["\n", "\n\f", "-", ""]))
@@ -0,0 +1,43 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("langchain")
+pytest.importorskip("langchain_chroma")
+
+from eval_rag import check_thresholds, evaluate_question, summarize
+
+
+def row(rank, **extra):
+    return {"question": "Как?", "expected": {"chapter": "Интерфейс"}, "rank": rank, "cached": False,
+            "latency_ms": 1.0, "retrieval_ms": 1.0, "generation_ms": 1.0, "input_tokens": 10,
+            "output_tokens": 5, "total_tokens": 15, "context_tokens": 8, **extra}
+
+
+def error_row():
+    return {"question": "Где?", "expected": {"chapter": "Интерфейс"}, "error": "timeout", "rank": None,
+            "latency_ms": 1.0}
+
+
+class FailingRAG:
+    async def aask_detailed(self, question, k=None):
+        raise TimeoutError("timeout")
+
+
+def test_failed_questions_count_as_misses():
+    item = {"question": "Где?", "chapter": "Интерфейс"}
+    failed = asyncio.run(evaluate_question(FailingRAG(), item, 5, asyncio.Semaphore(1)))
+    summary = summarize([row(1), row(1), failed, failed], [1, 3], wall_time=1.0)
+
+    assert summary["labeled"] == 4
+    assert summary["errors"] == 2
+    assert summary["hit_at_1"] == 0.5
+    assert summary["mrr"] == 0.5
+
+
+def test_errors_fail_the_thresholds():
+    summary = summarize([row(1), error_row()], [1], wall_time=1.0)
+
+    assert check_thresholds(summary, 1) == ["1 questions failed, at most 0 allowed"]
+    assert check_thresholds(summary, 1, max_errors=1) == []
+    assert check_thresholds(summarize([row(1)], [1], wall_time=1.0), 1) == []
@@ -0,0 +1,56 @@
+import random
+
+import pytest
+
+pytest.importorskip("langchain")
+pytest.importorskip("pypdf")
+
+from qa_extractor import PAGES_DELIMITER, extract_qa_pairs, iter_qa_pairs
+
+# Pieces the random pages are made of, including parts of question words
+TOKENS = ["1", "2", "12", ".", ". ", " ", "  ", "\n", "Как", "Какой", "Ка", "к", "им", " образом", "Что",
+          "В", " ч", "ем", "Скол", "ько", "?", "x", "Ответ:", "В чем", "-"]
+
+
+def as_tuples(chunks):
+    return [(chunk.page_content, chunk.metadata) for chunk in chunks]
+
+
+def assert_same_as_joined(pages, delimiter=PAGES_DELIMITER):
+    expected = as_tuples(extract_qa_pairs(delimiter.join(pages)))
+    assert as_tuples(iter_qa_pairs(iter(pages), delimiter)) == expected, (pages, delimiter)
+    return expected
+
+
+def test_question_split_across_pages(capsys):
+    pages = [
+        "Оглавление\n1. Как открыть",
+        "файл сцены?\nОтвет: Через меню File. 2. Каким образом со",
+        "хранить сцену?\nОтвет: Нажмите Ctrl+S.",
+        "3. В чем разница между",
+        "",
+        "Save и Save As?\nОтвет: Save As спрашивает имя.",
+    ]
+    pairs = assert_same_as_joined(pages)
+    assert [metadata["question_number"] for _, metadata in pairs] == ["1", "2", "3"]
+
+
+def test_question_start_split_across_pages(capsys):
+    # Without a delimiter a number and question word cut by the page seam join up again
+    pages = ["1. Как открыть файл?\nОтвет: Через меню. 1", "2", ". Ка", "ким образом сохранить?\nОтвет: Ctrl+S."]
+    pairs = assert_same_as_joined(pages, "")
+    assert [metadata["question_number"] for _, metadata in pairs] == ["1", "12"]
+
+
+def test_long_stretch_without_questions(capsys):
+    front_matter = ["Оглавление. Глава 1. Введение, 2. Интерфейс. " * 20] * 300
+    questions = [f"{i}. Как сделать шаг {i}?\nОтвет: Так." for i in range(1, 6)]
+    pages = questions[:2] + front_matter + questions[2:]
+    assert len(assert_same_as_joined(pages)) == 5
+
+
+def test_same_as_joined_on_random_pages(capsys):
+    rng = random.Random(0)
+    for _ in range(3000):
+        pages = ["".join(rng.choice(TOKENS) for _ in range(rng.randint(0, 15))) for _ in range(rng.randint(1, 10))]
+        assert_same_as_joined(pages, rng.choice([PAGES_DELIMITER, "", " ", "?"]))
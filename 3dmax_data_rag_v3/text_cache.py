@@ -0,0 +1,129 @@
+"""
+Content-addressed cache of text extracted from the 3D Max documentation.
+
+Parsing the PDF is the slowest step of every index rebuild and splitter
+experiment, although the source rarely changes. Extracted text is stored under
+a key made of the file's SHA-256, the loader name and the loader options, as a
+gzip file of the concatenated pages next to a JSON index of page offsets and
+metadata. A changed file or loader option gives a new key, so stale text is
+never returned; old entries can simply be deleted.
+"""
+import gzip
+import hashlib
+import json
+import os
+
+from langchain.docstore.document import Document
+
+DEFAULT_CACHE_DIR = "./.text_cache"
+
+# Bytes hashed per read when fingerprinting a source file
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def file_hash(path):
+    """SHA-256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class TextCache:
+    """Extracted pages keyed on (file hash, loader, loader options)"""
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, path, loader, options=None):
+        """Cache key of a source file read with a loader and its options"""
+        fingerprint = json.dumps(
+            {"file": file_hash(path), "loader": loader, "options": options or {}}, sort_keys=True
+        )
+        return hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + ".txt.gz", base + ".json"
+
+    def _read_index(self, key):
+        """Index of a complete entry, or None on a miss"""
+        _, index_path = self._paths(key)
+        if not os.path.exists(index_path):
+            return None
+        with open(index_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def _read_pages(self, key, lengths):
+        """Yield the cached pages of an entry one at a time"""
+        text_path, _ = self._paths(key)
+        # Text mode reads count characters, so page lengths work as offsets
+        with gzip.open(text_path, "rt", encoding="utf-8", errors="surrogatepass", newline="") as f:
+            for length in lengths:
+                yield f.read(length)
+
+    def _write_pages(self, key, pages, index):
+        """Yield pages while writing them to a new entry, recording index once all are in"""
+        text_path, index_path = self._paths(key)
+
+        lengths = []
+        with gzip.open(text_path + ".tmp", "wt", encoding="utf-8", errors="surrogatepass", newline="") as f:
+            for page in pages:
+                f.write(page)
+                lengths.append(len(page))
+                yield page
+
+        # The index is written last and marks the entry as complete
+        os.replace(text_path + ".tmp", text_path)
+        with open(index_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(dict(index, lengths=lengths), f, ensure_ascii=False, default=str)
+        os.replace(index_path + ".tmp", index_path)
+
+    def pages(self, path, loader, options, extract):
+        """
+        Yield the page texts of a source file
+
+        On a hit the pages are read back from the cache one at a time. On a
+        miss they come from extract() and are written to the cache as they
+        pass through; the entry only becomes visible once all pages are in.
+
+        Args:
+            path: Source file
+            loader: Name of the extraction method, part of the key
+            options: Options of the extraction method that change its output
+            extract: Function returning an iterable of page texts
+        """
+        key = self.key(path, loader, options)
+        index = self._read_index(key)
+        if index is not None:
+            yield from self._read_pages(key, index["lengths"])
+            return
+
+        index = {"source": os.path.basename(path), "loader": loader, "options": options or {}}
+        yield from self._write_pages(key, extract(), index)
+
+    def documents(self, path, loader, options, load):
+        """
+        Return the documents a LangChain loader produces for a source file
+
+        Args:
+            path: Source file
+            loader: Name of the loader, part of the key
+            options: Loader options that change its output
+            load: Function returning the loaded documents
+        """
+        key = self.key(path, loader, options)
+        index = self._read_index(key)
+        if index is not None:
+            texts = self._read_pages(key, index["lengths"])
+            return [Document(page_content=text, metadata=metadata)
+                    for text, metadata in zip(texts, index["metadata"])]
+
+        documents = load()
+        index = {"source": os.path.basename(path), "loader": loader, "options": options or {},
+                 "metadata": [doc.metadata for doc in documents]}
+        for _ in self._write_pages(key, (doc.page_content for doc in documents), index):
+            pass
+        return documents